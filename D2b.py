@@ -6,6 +6,9 @@ from pygments.token import Number
 load_dotenv()
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
+# The benchmark cells start MCP servers and park up to 100k invocations; set RUN_BENCHMARKS=1 to run them
+RUN_BENCHMARKS = os.getenv("RUN_BENCHMARKS") == "1"
+
 print("Gemini API key setup complete.")
 
 # %%
@@ -114,6 +117,202 @@ for event in response:
 #     ),
 # )
 
+# %%
+## Benchmark: MCP Transports (stdio vs Streamable HTTP)
+# A local Python stand-in for the MCP servers above, so both transports serve identical tools
+import subprocess
+import sys
+
+MCP_STANDIN_PORT = 8765
+
+mcp_standin_server_code = '''
+import base64
+import functools
+import os
+import sys
+
+from mcp.server.fastmcp import FastMCP, Image
+
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+mcp = FastMCP(
+    "standin", host = "127.0.0.1", port = int(os.getenv("MCP_STANDIN_PORT", "8765")), log_level = "WARNING"
+)
+
+@functools.lru_cache(maxsize = 8)
+def _blob(size_bytes: int) -> str:
+    return base64.b64encode(os.urandom(size_bytes)).decode()
+
+@mcp.tool()
+def echo(text: str) -> str:
+    """Returns the text unchanged."""
+    return text
+
+@mcp.tool()
+def getTinyImage() -> Image:
+    """Returns a 1x1 PNG image."""
+    return Image(data = TINY_PNG, format = "png")
+
+@mcp.tool()
+def get_blob(size_bytes: int) -> str:
+    """Returns `size_bytes` random bytes, base64 encoded."""
+    return _blob(size_bytes)
+
+if __name__ == "__main__":
+    mcp.run(transport = sys.argv[1] if len(sys.argv) > 1 else "stdio")
+'''
+
+with open("/tmp/mcp_standin_server.py", "w") as f:
+    f.write(mcp_standin_server_code)
+
+print("MCP stand-in server saved to /tmp/mcp_standin_server.py")
+
+# %%
+import asyncio
+import json
+import statistics
+import time
+from contextlib import asynccontextmanager
+
+from mcp import ClientSession
+from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+
+@asynccontextmanager
+async def open_mcp_session(transport: str):
+    """Open an initialized MCP client session to the stand-in server over `transport`."""
+    if transport == "stdio":
+        server_params = StdioServerParameters(
+            command = sys.executable, args = ["/tmp/mcp_standin_server.py", "stdio"]
+        )
+        async with stdio_client(server_params) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                yield session
+    else:
+        async with streamablehttp_client(f"http://127.0.0.1:{MCP_STANDIN_PORT}/mcp") as (read, write, _):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                yield session
+
+def summarize_latencies(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+    }
+
+async def benchmark_mcp_transport(
+    transport: str,
+    num_calls: int = 500,
+    concurrency_levels = (1, 8, 32),
+    payload_sizes = (1_024, 100 * 1_024, 1_024 * 1_024, 5 * 1_024 * 1_024),
+    payload_repeats: int = 10,
+) -> dict:
+    """Measure per-call latency, throughput under concurrency and payload-size scaling."""
+    results = {"transport": transport}
+    async with open_mcp_session(transport) as session:
+        # Warm up (process start / connection setup is not part of the per-call cost)
+        await session.call_tool("echo", {"text": "warmup"})
+
+        # 1. Per-call latency for a tiny request
+        latencies = []
+        for i in range(num_calls):
+            start = time.perf_counter()
+            await session.call_tool("echo", {"text": f"ping-{i}"})
+            latencies.append(time.perf_counter() - start)
+        results["latency"] = summarize_latencies(latencies)
+
+        # 2. Throughput with many requests in flight on one session
+        results["throughput"] = {}
+        for concurrency in concurrency_levels:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def call(i):
+                async with semaphore:
+                    await session.call_tool("echo", {"text": f"ping-{i}"})
+
+            start = time.perf_counter()
+            await asyncio.gather(*(call(i) for i in range(num_calls)))
+            results["throughput"][concurrency] = round(num_calls / (time.perf_counter() - start), 1)
+
+        # 3. Payload-size scaling, from the tiny image up to multi-megabyte blobs
+        results["payload"] = {}
+        cases = [("tiny_image", "getTinyImage", {})] + [
+            (f"blob_{size // 1_024}KB", "get_blob", {"size_bytes": size}) for size in payload_sizes
+        ]
+        for label, tool_name, args in cases:
+            await session.call_tool(tool_name, args)  # prime the server-side cache
+            latencies = []
+            for _ in range(payload_repeats):
+                start = time.perf_counter()
+                await session.call_tool(tool_name, args)
+                latencies.append(time.perf_counter() - start)
+            results["payload"][label] = summarize_latencies(latencies)
+    return results
+
+async def port_accepts_connections(port: int) -> bool:
+    try:
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+    except OSError:
+        return False
+    writer.close()
+    await writer.wait_closed()
+    return True
+
+async def start_mcp_http_server(timeout: float = 30.0) -> subprocess.Popen:
+    """Start the stand-in over streamable HTTP and return once it accepts connections."""
+    if await port_accepts_connections(MCP_STANDIN_PORT):
+        # Something else would answer the benchmark's requests
+        raise RuntimeError(f"Port {MCP_STANDIN_PORT} is already in use; stop whatever is listening on it first")
+    process = subprocess.Popen(
+        [sys.executable, "/tmp/mcp_standin_server.py", "streamable-http"],
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL,
+        env = {**os.environ, "MCP_STANDIN_PORT": str(MCP_STANDIN_PORT)},
+    )
+    deadline = time.monotonic() + timeout
+    while not await port_accepts_connections(MCP_STANDIN_PORT):
+        if process.poll() is not None:
+            raise RuntimeError(f"MCP stand-in server exited with code {process.returncode} before listening")
+        if time.monotonic() > deadline:
+            process.terminate()
+            process.wait()
+            raise TimeoutError(f"MCP stand-in server wasn't listening on port {MCP_STANDIN_PORT} after {timeout} s")
+        await asyncio.sleep(0.05)
+    return process
+
+print("MCP transport benchmark defined")
+
+# %%
+if RUN_BENCHMARKS:
+    # Streamable HTTP needs the server running; stdio spawns its own process per session
+    mcp_http_server_process = await start_mcp_http_server()
+    try:
+        mcp_transport_results = [
+            await benchmark_mcp_transport("stdio"),
+            await benchmark_mcp_transport("streamable-http"),
+        ]
+    finally:
+        mcp_http_server_process.terminate()
+        mcp_http_server_process.wait()
+
+    for result in mcp_transport_results:
+        print(f"\n--- {result['transport']} ---")
+        print(f"  Latency: {result['latency']}")
+        for concurrency, calls_per_second in result["throughput"].items():
+            print(f"  Throughput @ concurrency {concurrency}: {calls_per_second} calls/s")
+        for label, latency in result["payload"].items():
+            print(f"  {label}: {latency}")
+
+    with open("mcp_transport_benchmark.json", "w") as f:
+        json.dump(mcp_transport_results, f, indent = 2)
+
+    print("\nResults saved to mcp_transport_benchmark.json")
+
 # %%
 ## Long-Running Operations (LRO) - (Human-in-the-Loop)
 # The Shipping Tool with Approval Logic
@@ -211,6 +410,109 @@ shipping_runner = Runner(
 
 print("Runner created!")
 
+# %%
+## Durable Paused Invocations
+# InMemorySessionService loses every paused order when the kernel restarts.
+# Park each paused invocation in SQLite, keyed by its invocation_id, so it can be resumed later.
+import sqlite3
+import time
+
+from google.adk.sessions import Session
+
+class PausedInvocationStore:
+    """SQLite-backed store of paused invocations, looked up by invocation_id."""
+
+    def __init__(self, db_path: str = "paused_invocations.db") -> None:
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        # invocation_id is the primary key of a WITHOUT ROWID table, so a resume is a single index probe
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS paused_invocations (
+                invocation_id TEXT PRIMARY KEY,
+                approval_id TEXT NOT NULL,
+                app_name TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                session_json TEXT NOT NULL,
+                parked_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.commit()
+
+    def park(self, approval_info: dict, session: Session) -> None:
+        """Persist a paused invocation together with a snapshot of its session."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO paused_invocations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    approval_info["invocation_id"],
+                    approval_info["approval_id"],
+                    session.app_name,
+                    session.user_id,
+                    session.id,
+                    session.model_dump_json(),
+                    time.time(),
+                ),
+            )
+
+    def get(self, invocation_id: str) -> dict | None:
+        """Return the parked invocation for `invocation_id`, or None if it is not parked."""
+        row = self.connection.execute(
+            "SELECT approval_id, app_name, user_id, session_id, session_json, parked_at "
+            "FROM paused_invocations WHERE invocation_id = ?",
+            (invocation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "invocation_id": invocation_id,
+            "approval_id": row[0],
+            "app_name": row[1],
+            "user_id": row[2],
+            "session_id": row[3],
+            "session": Session.model_validate_json(row[4]),
+            "parked_at": row[5],
+        }
+
+    def remove(self, invocation_id: str) -> None:
+        """Forget a parked invocation once it has been resumed."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM paused_invocations WHERE invocation_id = ?", (invocation_id,)
+            )
+
+    def list_pending(self, limit: int = 100) -> list[str]:
+        """Return the invocation ids of the oldest parked invocations."""
+        rows = self.connection.execute(
+            "SELECT invocation_id FROM paused_invocations ORDER BY parked_at LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    def pending_count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM paused_invocations").fetchone()[0]
+
+    def iter_deadlines(self, page_size: int = 1_000):
+        """Yield (invocation_id, approval_id, parked_at) of every parked invocation, page by page."""
+        last_id = ""
+        while True:
+            rows = self.connection.execute(
+                "SELECT invocation_id, approval_id, parked_at FROM paused_invocations "
+                "WHERE invocation_id > ? ORDER BY invocation_id LIMIT ?",
+                (last_id, page_size),
+            ).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+
+paused_store = PausedInvocationStore()
+
+print(f"Paused invocation store ready! ({paused_store.pending_count()} parked)")
+
 # %%
 ## Building the Workflow
 def check_for_approval(events):
@@ -254,11 +556,227 @@ def create_approval_response(approval_info, approved):
 print("Helper function defined")
 
 # %%
-async def run_shipping_workflow(query: str, auto_approve: bool = True):
+async def restore_parked_session(record: dict) -> Session:
+    """Put a parked session back into the session service if it was lost (e.g. after a restart)."""
+    session = await session_service.get_session(
+        app_name = record["app_name"], user_id = record["user_id"], session_id = record["session_id"]
+    )
+    if session:
+        return session
+
+    snapshot = record["session"]
+    session = await session_service.create_session(
+        app_name = snapshot.app_name,
+        user_id = snapshot.user_id,
+        session_id = snapshot.id,
+        state = snapshot.state,
+    )
+    # Replay the events so the runner can find the paused invocation again
+    for event in snapshot.events:
+        await session_service.append_event(session, event)
+    return session
+
+async def resume_parked_invocation(invocation_id: str, approved: bool):
+    """Resume a parked invocation with the human decision, even after a kernel restart."""
+    record = paused_store.get(invocation_id)
+    if record is None:
+        print(f"No parked invocation found for {invocation_id}")
+        return
+
+    approval_scheduler.resolve(invocation_id)
+    await restore_parked_session(record)
+    print(f"Resuming {invocation_id} - Human Decision: {'APPROVE' if approved else 'REJECT'}\n")
+
+    async for event in shipping_runner.run_async(
+        user_id = record["user_id"],
+        session_id = record["session_id"],
+        new_message = create_approval_response(record, approved),
+        invocation_id = invocation_id,
+    ):
+        if event.content and event.content.parts:
+            for part in event.content.parts:
+                if part.text:
+                    print(f"Agent > {part.text}")
+
+    paused_store.remove(invocation_id)
+
+print("Resume helpers defined")
+
+# %%
+## Approval Deadlines
+# A pending approval must not wait forever. All deadlines live in ONE timer heap,
+# served by a single background task instead of one sleeping task per approval.
+import asyncio
+import heapq
+import itertools
+import logging
+
+APPROVAL_TIMEOUT_SECONDS = 15 * 60  # Reject or escalate approvals nobody answered within 15 minutes
+
+class ApprovalScheduler:
+    """Expires pending approvals at their deadline using a heap (O(log n) schedule/expire)."""
+
+    def __init__(
+        self,
+        on_reject,
+        on_escalate = None,
+        timeout: float = APPROVAL_TIMEOUT_SECONDS,
+        max_escalations: int = 0,
+        max_concurrent_expiries: int = 32,
+    ) -> None:
+        self.on_reject = on_reject  # async fn(approval) - called when an approval finally expires
+        self.on_escalate = on_escalate  # async fn(approval) - called instead while escalations remain
+        self.timeout = timeout
+        self.max_escalations = max_escalations
+        self.expired_count: int = 0
+        self.escalated_count: int = 0
+        self._heap: list[tuple[float, int, str]] = []
+        self._pending: dict[str, dict] = {}
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Expiries resume LLM invocations, so they run as tasks: a slow resume can't hold up later deadlines
+        self._expiring: set[asyncio.Task] = set()
+        self._expiry_slots = asyncio.Semaphore(max_concurrent_expiries)
+
+    def schedule(self, approval_info: dict, deadline: float | None = None) -> None:
+        """Start (or restart) the clock for an approval. `deadline` is a wall-clock timestamp."""
+        invocation_id = approval_info["invocation_id"]
+        now = time.time()
+        # Rescheduling (e.g. after an escalation) keeps the original age and escalation count
+        previous = self._pending.get(invocation_id, approval_info)
+        approval = {
+            **approval_info,
+            "created_at": previous.get("created_at", now),
+            "deadline": deadline if deadline is not None else now + self.timeout,
+            "escalations": previous.get("escalations", 0),
+        }
+        self._pending[invocation_id] = approval
+        heapq.heappush(self._heap, (approval["deadline"], next(self._sequence), invocation_id))
+        # Only wake the sweeper if this approval is now the earliest deadline
+        if self._heap[0][2] == invocation_id:
+            self._wakeup.set()
+
+    def resolve(self, invocation_id: str) -> bool:
+        """Mark an approval as answered. Its heap entry is dropped lazily when it surfaces."""
+        resolved = self._pending.pop(invocation_id, None) is not None
+        # Rebuild the heap once stale entries dominate, so abandoned entries can't pile up
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._pending):
+            self._heap = [
+                entry for entry in self._heap
+                if entry[2] in self._pending and self._pending[entry[2]]["deadline"] == entry[0]
+            ]
+            heapq.heapify(self._heap)
+        return resolved
+
+    # Gauges
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def oldest_pending_age(self) -> float:
+        """Age in seconds of the oldest unanswered approval (0 if none are pending)."""
+        if not self._pending:
+            return 0.0
+        return time.time() - min(approval["created_at"] for approval in self._pending.values())
+
+    def gauges(self) -> dict:
+        return {
+            "pending": self.pending_count(),
+            "oldest_pending_age_seconds": round(self.oldest_pending_age(), 3),
+            "expired_total": self.expired_count,
+            "escalated_total": self.escalated_count,
+        }
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._expiring:
+            task.cancel()
+        await asyncio.gather(*self._expiring, return_exceptions = True)
+
+    async def _expire(self, approval: dict) -> None:
+        if approval["escalations"] < self.max_escalations and self.on_escalate:
+            approval["escalations"] += 1
+            self.escalated_count += 1
+            self.schedule(approval, deadline = time.time() + self.timeout)
+            await self.on_escalate(approval)
+        else:
+            self.expired_count += 1
+            await self.on_reject(approval)
+
+    async def _expire_in_background(self, approval: dict) -> None:
+        async with self._expiry_slots:
+            try:
+                await self._expire(approval)
+            except Exception:
+                logging.exception(f"Failed to expire approval {approval['invocation_id']}")
+
+    def _dispatch_expiry(self, approval: dict) -> None:
+        task = asyncio.create_task(self._expire_in_background(approval))
+        self._expiring.add(task)
+        task.add_done_callback(self._expiring.discard)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, invocation_id = heapq.heappop(self._heap)
+                approval = self._pending.get(invocation_id)
+                # Skip entries for approvals that were answered or rescheduled
+                if approval is None or approval["deadline"] != deadline:
+                    continue
+                del self._pending[invocation_id]
+                self._dispatch_expiry(approval)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout = timeout)
+            except asyncio.TimeoutError:
+                pass
+
+# %%
+async def auto_reject_approval(approval: dict):
+    """Nobody answered in time - resume the parked invocation with a rejection."""
+    print(f"Approval for {approval['invocation_id']} timed out - auto-rejecting")
+    await resume_parked_invocation(approval["invocation_id"], approved = False)
+
+async def escalate_approval(approval: dict):
+    """Give the approval another window and notify someone more senior."""
+    print(f"Approval for {approval['invocation_id']} escalated (#{approval['escalations']})")
+    logging.warning(f"[Approval] Escalated {approval['invocation_id']}")
+
+approval_scheduler = ApprovalScheduler(
+    on_reject = auto_reject_approval,
+    on_escalate = escalate_approval,
+    max_escalations = 1,
+)
+approval_scheduler.start()
+
+# Re-arm deadlines for anything parked before a restart
+for invocation_id, approval_id, parked_at in paused_store.iter_deadlines():
+    approval_scheduler.schedule(
+        {"invocation_id": invocation_id, "approval_id": approval_id},
+        deadline = parked_at + approval_scheduler.timeout,
+    )
+
+print(f"Approval scheduler running: {approval_scheduler.gauges()}")
+
+# %%
+async def run_shipping_workflow(query: str, auto_approve: bool | None = True):
     """Runs a shipping workflow with approval handling.
     Args:
         query: User's shipping request
-        auto_approve: Whether to auto-approve large orders (simulates human decision)
+        auto_approve: Whether to auto-approve large orders (simulates human decision).
+            None simulates nobody answering - the approval stays parked until its deadline.
     """
     
     print(f"\n{'='*60}")
@@ -289,6 +807,19 @@ async def run_shipping_workflow(query: str, auto_approve: bool = True):
         # STEP 3: If the event is present, it's a large order - HANDLE APPROVAL WORKFLOW
         if approval_info:
             print(f"Pausing for approval...")
+
+            # Park the paused invocation so it survives a restart
+            session = await session_service.get_session(
+                app_name = "shipping_coordinator", user_id = "test_user", session_id = session_id
+            )
+            paused_store.park(approval_info, session)
+            print(f"Parked invocation {approval_info['invocation_id']}")
+
+            if auto_approve is None:
+                # Nobody answers - the scheduler rejects or escalates it at the deadline
+                approval_scheduler.schedule(approval_info)
+                print("No human decision - waiting for approval deadline\n")
+                continue
             print(f"Human Decision: {'APPROVE' if auto_approve else 'REJECT'}\n")
             
             # PATH A: Resume the agent by calling run_async() again with the approval decision
@@ -306,6 +837,8 @@ async def run_shipping_workflow(query: str, auto_approve: bool = True):
                     for part in event.content.parts:
                         if part.text:
                             print(f"Agent > {part.text}")
+
+            paused_store.remove(approval_info["invocation_id"])
         
     # -----------------------------------------------------------------------------------------------
     # -----------------------------------------------------------------------------------------------
@@ -327,6 +860,69 @@ await run_shipping_workflow("Ship 10 containers to Rotterdam", auto_approve = Tr
 # Deme 3: Workflow simulates human decision: REJECT
 await run_shipping_workflow("Ship 8 containers to Los Angeles", auto_approve = False)
 
+# %%
+# After a kernel restart, a parked invocation is resumed by its invocation_id once someone decides.
+# Every other parked invocation stays parked, and the approval scheduler still enforces its deadline.
+pending = paused_store.list_pending(limit = 1)
+if pending:
+    invocation_id = pending[0]
+    await resume_parked_invocation(invocation_id, approved = True)
+
+# %%
+# Demo 4: Nobody answers. With a short timeout the approval is escalated once, then auto-rejected.
+approval_scheduler.timeout = 5
+await run_shipping_workflow("Ship 12 containers to Hamburg", auto_approve = None)
+print(f"Gauges: {approval_scheduler.gauges()}")
+
+await asyncio.sleep(12)
+print(f"Gauges: {approval_scheduler.gauges()}")
+approval_scheduler.timeout = APPROVAL_TIMEOUT_SECONDS
+
+# %%
+## Benchmark: Resume Latency with Many Parked Invocations
+import random
+import statistics
+
+def benchmark_resume_latency(
+    parked_sizes = (1_000, 10_000, 100_000), num_lookups = 1_000, db_path = "paused_invocations_bench.db"
+):
+    """Measure parked-invocation lookup latency as the number of parked invocations grows."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    store = PausedInvocationStore(db_path)
+    snapshot = Session(
+        id = "bench", app_name = "shipping_coordinator", user_id = "bench_user"
+    ).model_dump_json()
+
+    parked = 0
+    print(f"{'parked':>10} {'p50 (us)':>10} {'p99 (us)':>10}")
+    for size in parked_sizes:
+        with store.connection:
+            store.connection.executemany(
+                "INSERT INTO paused_invocations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (f"inv-{i}", f"approval-{i}", "shipping_coordinator", "bench_user", f"order_{i}", snapshot, time.time())
+                    for i in range(parked, size)
+                ),
+            )
+        parked = size
+
+        latencies = []
+        for _ in range(num_lookups):
+            invocation_id = f"inv-{random.randrange(parked)}"
+            start = time.perf_counter()
+            store.get(invocation_id)
+            latencies.append((time.perf_counter() - start) * 1e6)
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{parked:>10} {statistics.median(latencies):>10.1f} {p99:>10.1f}")
+
+    store.connection.close()
+    os.remove(db_path)
+
+if RUN_BENCHMARKS:
+    benchmark_resume_latency()
+
 # %%
 # Exercise: Build an Image Generation Agent with Cost Approval¶
 # The scenario:
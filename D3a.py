@@ -9,9 +9,14 @@ from sqlalchemy.sql.coercions import TruncatedLabelImpl
 load_dotenv()
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
+# The benchmark cells take minutes and write large scratch databases; set
+# RUN_BENCHMARKS=1 to run them
+RUN_BENCHMARKS = os.getenv("RUN_BENCHMARKS") == "1"
+
 print("Gemini API key setup complete.")
 
 # %%
+from datetime import datetime
 from typing import Any, Dict
 
 from google.adk.agents import Agent, LlmAgent
@@ -37,15 +42,10 @@ async def run_session(
     # Get app name from the Runner
     app_name = runner_instance.app_name
 
-    # Attempt to create a new session or retrieve an existing one
-    try:
-        session = await session_service.create_session(
-            app_name=app_name, user_id=USER_ID, session_id=session_name
-        )
-    except:
-        session = await session_service.get_session(
-            app_name=app_name, user_id=USER_ID, session_id=session_name
-        )
+    # Retrieve the session, or create it if this is the first turn (one round trip)
+    session = await session_service.get_or_create_session(
+        app_name=app_name, user_id=USER_ID, session_id=session_name
+    )
 
     # Process queries if provided
     if user_queries:
@@ -86,6 +86,57 @@ retry_config = types.HttpRetryOptions(
     http_status_codes=[429, 500, 503, 504],  # Retry on these HTTP errors
 )
 
+# %%
+## Compact Event Encoding
+# The events table stores each event as verbose JSON, mostly the same keys over and
+# over. Payloads can instead be packed with msgpack and compressed with zstd, using a
+# dictionary trained on each session's own events.
+# pip install msgpack zstandard
+# The session services live in session_storage.py, so worker processes can import them
+# without running this notebook
+from google.adk.events import Event
+
+from session_storage import (
+    CompactEventCodec,
+    LazyEvent,
+    compact_events_table,
+    event_dictionaries_table,
+)
+
+print("Compact event codec defined")
+
+# %%
+## Fast Session Services
+# Creating a session that already exists raises, so "try create, except get" pays for
+# a failed lookup + exception + a second lookup on every turn.
+# FastInMemorySessionService and FastDatabaseSessionService resolve both cases with a
+# single operation instead, and the database one adds tuned SQLite, write-behind
+# batching, windowed loading, event queries and compaction bookkeeping.
+import logging
+from datetime import timezone
+from typing import Iterator, NamedTuple
+
+from google.adk.sessions import Session
+from google.adk.sessions.database_session_service import (
+    StorageAppState,
+    StorageEvent,
+    StorageSession,
+    StorageUserState,
+)
+from sqlalchemy import insert, select
+
+from session_storage import (
+    EVENT_QUERY_INDEXES,
+    FastDatabaseSessionService,
+    FastInMemorySessionService,
+    WindowedSessionConfig,
+    compaction_token_delta,
+    estimate_event_tokens,
+    storage_event_to_event,
+)
+
+print("Fast session services defined")
+
 # %%
 ## InMemorySessionService
 APP_NAME = "default"  # Application
@@ -103,7 +154,7 @@ root_agent = Agent(
 
 # Step 2: Set up Session Management
 # INMemorySessionService stores conversations in RAM (temporary)
-session_service = InMemorySessionService()
+session_service = FastInMemorySessionService()
 
 # Step 3: Create the Runner
 runner = Runner(agent=root_agent, app_name=APP_NAME, session_service=session_service)
@@ -145,13 +196,13 @@ chatbot_agent = LlmAgent(
 # Step 2: Switch to DatabaseSessionService
 # SQLite database will be created automatically
 db_url = "sqlite:///my_agent_data.db"  # Local SQLite file
-session_service = DatabaseSessionService(db_url=db_url)
+session_service = FastDatabaseSessionService(db_url=db_url, tune_sqlite=True)
 
 # Step 3: Create a new runner with persistent storage
 runner = Runner(agent=chatbot_agent, app_name=APP_NAME, session_service=session_service)
 
 print("Upgraded to persistent session!")
-print(f"  - Database: my_agent_data.db")
+print(f"  - Database: my_agent_data.db (WAL mode)")
 print(f"  - Session will survive restarts!")
 
 # %%
@@ -176,22 +227,546 @@ await run_session(
     runner, ["Hello! What is my name?"], "test-db-session-02"
 )  # Note, we are using new session name
 
+
+# %%
+def check_data_in_db():
+    # Streams rows through query_events() instead of fetching the whole events table
+    print(["app_name", "session_id", "author", "content"])
+    for record in session_service.query_events(app_name=APP_NAME, include_content=True):
+        print((record.app_name, record.session_id, record.author, record.content))
+
+
+check_data_in_db()
+
+# %%
+## Benchmark: get-or-create vs try/except
+import os
+import time
+
+
+async def try_create_then_get(service, **key):
+    """The old pattern: attempt a create and fall back to a get when it fails."""
+    try:
+        return await service.create_session(**key)
+    except:
+        return await service.get_session(**key)
+
+
+async def get_or_create(service, **key):
+    return await service.get_or_create_session(**key)
+
+
+async def benchmark_session_turns(
+    service, open_session, num_turns=500, num_sessions=10
+):
+    """Simulate turns (open session + append user/model events) and return turns/sec."""
+    start = time.perf_counter()
+    for turn in range(num_turns):
+        session = await open_session(
+            service,
+            app_name="bench",
+            user_id=USER_ID,
+            session_id=f"bench-{turn % num_sessions}",
+        )
+        for author in ("user", "text_chat_bot"):
+            await service.append_event(
+                session,
+                Event(
+                    invocation_id=f"turn-{turn}",
+                    author=author,
+                    content=types.Content(
+                        role="user", parts=[types.Part(text="Hello!")]
+                    ),
+                ),
+            )
+    return num_turns / (time.perf_counter() - start)
+
+
+backends = {
+    "InMemory": lambda: FastInMemorySessionService(),
+    "Database": lambda: FastDatabaseSessionService(
+        db_url="sqlite:///bench_sessions.db"
+    ),
+}
+if RUN_BENCHMARKS:
+    for backend_name, make_service in backends.items():
+        for label, open_session in [
+            ("try/except", try_create_then_get),
+            ("get_or_create", get_or_create),
+        ]:
+            if os.path.exists("bench_sessions.db"):
+                os.remove("bench_sessions.db")
+
+            turns_per_sec = await benchmark_session_turns(make_service(), open_session)
+            print(f"{backend_name:>8} | {label:>13}: {turns_per_sec:,.0f} turns/sec")
+
+    os.remove("bench_sessions.db")
+
+# %%
+## Benchmark: SQLite Tuning and Write-Behind Batching
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def remove_sqlite_files(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def benchmark_append_throughput(
+    make_service, concurrency: int, total_events: int = 2000
+) -> float:
+    """Append events from `concurrency` sessions in parallel threads and return
+    events/sec."""
+    remove_sqlite_files("bench_events.db")
+    service = make_service("sqlite:///bench_events.db")
+    events_per_session = max(1, total_events // concurrency)
+
+    async def open_session(session_index: int):
+        return await service.get_or_create_session(
+            app_name="bench",
+            user_id=f"user-{session_index}",
+            session_id=f"session-{session_index}",
+        )
+
+    async def worker(session_index: int):
+        session = await open_session(session_index)
+        for i in range(events_per_session):
+            await service.append_event(
+                session,
+                Event(
+                    invocation_id=f"inv-{i}",
+                    author="user",
+                    content=types.Content(
+                        role="user", parts=[types.Part(text=f"Message {i}")]
+                    ),
+                ),
+            )
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Create the sessions first so only event appends are timed
+        list(pool.map(lambda i: asyncio.run(open_session(i)), range(concurrency)))
+        start = time.perf_counter()
+        list(pool.map(lambda i: asyncio.run(worker(i)), range(concurrency)))
+        service.close()  # Includes the final group commit
+        elapsed = time.perf_counter() - start
+
+    service.db_engine.dispose()
+    remove_sqlite_files("bench_events.db")
+    return events_per_session * concurrency / elapsed
+
+
+configurations = {
+    "default": lambda url: FastDatabaseSessionService(db_url=url),
+    "tuned": lambda url: FastDatabaseSessionService(db_url=url, tune_sqlite=True),
+    "tuned+write-behind": lambda url: FastDatabaseSessionService(
+        db_url=url, tune_sqlite=True, write_behind=True
+    ),
+}
+if RUN_BENCHMARKS:
+    print(
+        f"{'configuration':>20} | {'1 session':>10} | {'16 sessions':>11} | "
+        f"{'128 sessions':>12}"
+    )
+    for name, make_service in configurations.items():
+        results = [benchmark_append_throughput(make_service, c) for c in (1, 16, 128)]
+        print(
+            f"{name:>20} | "
+            + " | ".join(f"{r:>{w},.0f}" for r, w in zip(results, (10, 11, 12)))
+            + "  events/sec"
+        )
+
+
+# %%
+## Migrating to Compact Event Encoding
+def vacuum_sqlite(service: FastDatabaseSessionService) -> None:
+    """Rebuild the SQLite file so space freed by deleted rows is returned to the OS."""
+    raw_connection = service.db_engine.raw_connection()
+    try:
+        raw_connection.driver_connection.execute("VACUUM")
+    finally:
+        raw_connection.close()
+
+
+def migrate_event_encoding(
+    service: FastDatabaseSessionService, vacuum: bool = True
+) -> int:
+    """Move every JSON event into the compact table, one session per transaction.
+
+    Each session's dictionary is trained on its full history first, so migrated
+    sessions compress better than ones that grew event by event. Returns the number
+    of events migrated. Safe to re-run: already-migrated sessions have no JSON events
+    left.
+    """
+    if service.event_codec is None:
+        raise ValueError("The session service was created without an event_codec.")
+    with service.database_session_factory() as sql_session:
+        keys = sql_session.query(
+            StorageSession.app_name, StorageSession.user_id, StorageSession.id
+        ).all()
+
+    migrated = 0
+    for app_name, user_id, session_id in keys:
+        key = (app_name, user_id, session_id)
+        with service.database_session_factory() as sql_session:
+            json_events = sql_session.query(StorageEvent).filter(
+                StorageEvent.app_name == app_name,
+                StorageEvent.user_id == user_id,
+                StorageEvent.session_id == session_id,
+            )
+            events = [
+                storage_event_to_event(storage_event)
+                for storage_event in json_events.order_by(StorageEvent.timestamp)
+            ]
+            if not events:
+                continue
+            service._insert_compact_events(sql_session, key, events)
+            json_events.delete()
+            sql_session.commit()
+        migrated += len(events)
+
+    if vacuum and service.db_engine.dialect.name == "sqlite":
+        vacuum_sqlite(service)
+    return migrated
+
+
+print("Migration tool defined")
+
+# %%
+## Benchmark: Compact Event Encoding
+import random
+import threading
+import time
+import tracemalloc
+
+import psutil
+from google.adk.events import EventActions
+
+
+def make_synthetic_event(i: int, rng: random.Random) -> Event:
+    """A mix of user messages, tool calls and model replies, like a real support
+    session. Order numbers come from `rng`, so a seeded one gives the same events on
+    every run."""
+    kind = i % 3
+    if kind == 0:
+        content = types.Content(
+            role="user",
+            parts=[
+                types.Part(
+                    text=(
+                        f"Question {i}: what is the status of order "
+                        f"{rng.randint(1000, 9999)}?"
+                    )
+                )
+            ],
+        )
+    elif kind == 1:
+        content = types.Content(
+            role="model",
+            parts=[
+                types.Part(
+                    function_call=types.FunctionCall(
+                        name="lookup_order",
+                        args={"order_id": str(i), "include_history": True},
+                    )
+                )
+            ],
+        )
+    else:
+        content = types.Content(
+            role="model",
+            parts=[
+                types.Part(
+                    text=f"Order {i} shipped on day {i % 28 + 1} and is in transit. "
+                    * 3
+                )
+            ],
+        )
+    return Event(
+        invocation_id=f"inv-{i // 3}",
+        author="user" if kind == 0 else "text_chat_bot",
+        content=content,
+        actions=EventActions(state_delta={"last_order": str(i)} if kind == 2 else {}),
+        usage_metadata=(
+            types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=100 + i, candidates_token_count=40
+            )
+            if kind
+            else None
+        ),
+    )
+
+
+async def load_all_sessions(service, keys, touch_events: int = 0) -> float:
+    """Load every session, reading the content of the last `touch_events` events.
+    Returns seconds."""
+    start = time.perf_counter()
+    for app_name, user_id, session_id in keys:
+        session = await service.get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id
+        )
+        for event in (
+            session.events[len(session.events) - touch_events :] if touch_events else []
+        ):
+            event.content
+    return time.perf_counter() - start
+
+
+async def measure_load(
+    service, keys, touch_events: int = 0
+) -> tuple[float, float, float]:
+    """Return (seconds, peak RSS growth MB, peak heap MB) for loading every session.
+
+    Seconds and RSS come from an untraced pass, sampling RSS every 5 ms (the process
+    high-water mark can't be reset); the heap peak from a second pass under tracemalloc.
+    """
+    process = psutil.Process()
+    baseline_rss = peak_rss = process.memory_info().rss
+    done = threading.Event()
+
+    def sample_rss():
+        nonlocal peak_rss
+        while not done.wait(0.005):
+            peak_rss = max(peak_rss, process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    seconds = await load_all_sessions(service, keys, touch_events)
+    done.set()
+    sampler.join()
+    peak_rss = max(peak_rss, process.memory_info().rss)
+
+    tracemalloc.start()
+    await load_all_sessions(service, keys, touch_events)
+    peak_heap = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return seconds, (peak_rss - baseline_rss) / 1e6, peak_heap
+
+
+async def benchmark_compact_encoding(
+    num_sessions: int = 20, events_per_session: int = 1000
+):
+    remove_sqlite_files("bench_codec.db")
+    json_service = FastDatabaseSessionService(
+        db_url="sqlite:///bench_codec.db", tune_sqlite=True, write_behind=True
+    )
+    keys = []
+    rng = random.Random(0)
+    for s in range(num_sessions):
+        session = await json_service.get_or_create_session(
+            app_name="bench", user_id=f"user-{s % 5}", session_id=f"session-{s}"
+        )
+        keys.append(("bench", session.user_id, session.id))
+        for i in range(events_per_session):
+            await json_service.append_event(session, make_synthetic_event(i, rng))
+    json_service.close()
+    vacuum_sqlite(json_service)
+    json_size = os.path.getsize("bench_codec.db") / 1e6
+    json_seconds, json_rss, json_peak = await measure_load(json_service, keys)
+    json_service.db_engine.dispose()
+
+    compact_service = FastDatabaseSessionService(
+        db_url="sqlite:///bench_codec.db",
+        tune_sqlite=True,
+        event_codec=CompactEventCodec(),
+    )
+    start = time.perf_counter()
+    migrated = migrate_event_encoding(compact_service)
+    print(f"Migrated {migrated:,} events in {time.perf_counter() - start:.1f}s")
+    compact_size = os.path.getsize("bench_codec.db") / 1e6
+    lazy_seconds, lazy_rss, lazy_peak = await measure_load(
+        compact_service, keys, touch_events=10
+    )
+    compact_service.lazy_decode = False
+    eager_seconds, eager_rss, eager_peak = await measure_load(compact_service, keys)
+    compact_service.db_engine.dispose()
+    remove_sqlite_files("bench_codec.db")
+
+    print(
+        f"{'':>26} {'DB size (MB)':>13} {'load all (s)':>13} {'peak RSS +MB':>13} "
+        f"{'peak heap (MB)':>15}"
+    )
+    print(
+        f"{'JSON':>26} {json_size:>13.1f} {json_seconds:>13.2f} {json_rss:>13.1f} "
+        f"{json_peak:>15.1f}"
+    )
+    print(
+        f"{'compact, eager decode':>26} {compact_size:>13.1f} {eager_seconds:>13.2f} "
+        f"{eager_rss:>13.1f} {eager_peak:>15.1f}"
+    )
+    print(
+        f"{'compact, lazy (last 10)':>26} {compact_size:>13.1f} {lazy_seconds:>13.2f} "
+        f"{lazy_rss:>13.1f} {lazy_peak:>15.1f}"
+    )
+
+
+if RUN_BENCHMARKS:
+    await benchmark_compact_encoding()
 # %%
+## Benchmark: Analytics Queries
+import json
+import pickle
 import sqlite3
+import time
+from datetime import timedelta
 
+from google.adk.events import EventActions
 
-def check_data_in_db():
-    with sqlite3.connect("my_agent_data.db") as connection:
-        cursor = connection.cursor()
-        result = cursor.execute(
-            "select app_name, session_id, author, content from events"
+
+def build_synthetic_event_db(
+    path: str,
+    num_events: int,
+    events_per_session: int = 100,
+    sessions_per_user: int = 10,
+) -> None:
+    """Bulk-load `num_events` JSON events straight into the events table.
+
+    Goes through sqlite3 directly (the session service would take hours for 10M
+    events) and builds the query indexes once at the end instead of per insert.
+    """
+    remove_sqlite_files(path)
+    FastDatabaseSessionService(
+        db_url=f"sqlite:///{path}"
+    ).db_engine.dispose()  # Creates the schema
+    actions = pickle.dumps(EventActions())
+    start = datetime(2025, 11, 1)
+    authors = ("user", "text_chat_bot", "search_agent")
+    num_sessions = max(1, num_events // events_per_session)
+
+    def sessions():
+        for s in range(num_sessions):
+            yield (
+                "bench",
+                f"user-{s // sessions_per_user}",
+                f"session-{s}",
+                "{}",
+                str(start),
+                str(start),
+            )
+
+    def events():
+        for i in range(num_events):
+            s, n = divmod(i, events_per_session)
+            # Sessions are spread over 30 days; events within a session are 10s apart
+            timestamp = start + timedelta(
+                seconds=(s * 2_592_000 // num_sessions) + n * 10
+            )
+            content = json.dumps(
+                {"role": "user", "parts": [{"text": f"Message {n} in session {s}"}]}
+            )
+            author = authors[n % 3]
+            yield (
+                f"event-{i}",
+                "bench",
+                f"user-{s // sessions_per_user}",
+                f"session-{s}",
+                f"inv-{n // 3}",
+                author,
+                actions,
+                timestamp.isoformat(" ", "microseconds"),
+                content,
+            )
+
+    with sqlite3.connect(path) as connection:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=OFF")
+        for index in EVENT_QUERY_INDEXES:
+            connection.execute(f"DROP INDEX IF EXISTS {index.name}")
+        connection.executemany(
+            "insert into sessions values (?, ?, ?, ?, ?, ?)", sessions()
+        )
+        connection.executemany(
+            "insert into events (id, app_name, user_id, session_id, invocation_id, "
+            "author, actions, timestamp, content) values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            events(),
         )
-        print([_[0] for _ in result.description])
-        for each in result.fetchall():
-            print(each)
+    FastDatabaseSessionService(
+        db_url=f"sqlite:///{path}"
+    ).db_engine.dispose()  # Builds the indexes
+
+
+def time_query(run_query) -> tuple[int, float, float, float]:
+    """Run a query and drain its rows. Returns (rows, ms to first row, total seconds,
+    peak heap MB)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_row = None
+    rows = 0
+    for _ in run_query():
+        if first_row is None:
+            first_row = time.perf_counter() - start
+        rows += 1
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return rows, (first_row or seconds) * 1000, seconds, peak
+
+
+def benchmark_analytics_queries(
+    num_events: int = 10_000_000, path: str = "bench_analytics.db"
+):
+    start = time.perf_counter()
+    build_synthetic_event_db(path, num_events)
+    print(
+        f"Built {num_events:,} events ({os.path.getsize(path) / 1e9:.2f} GB) in "
+        f"{time.perf_counter() - start:.0f}s"
+    )
 
+    service = FastDatabaseSessionService(db_url=f"sqlite:///{path}", tune_sqlite=True)
+    day = datetime(2025, 11, 15).timestamp()
+    num_users = max(1, num_events // 1000)
+    queries = {
+        "one session": dict(
+            user_id=f"user-{num_users // 2}", session_id=f"session-{num_users * 5}"
+        ),
+        "one user, all time": dict(user_id=f"user-{num_users // 2}"),
+        "one author, 1 hour": dict(
+            author="search_agent", start_time=day, end_time=day + 3600
+        ),
+        "whole app, 1 day": dict(start_time=day, end_time=day + 86400),
+        "whole app, all time": dict(),
+        "one day, with content": dict(
+            start_time=day, end_time=day + 86400, include_content=True
+        ),
+    }
+    print(
+        f"{'query':>28} {'rows':>11} {'first row (ms)':>15} {'total (s)':>10} "
+        f"{'rows/sec':>11} {'peak heap (MB)':>15}"
+    )
+    for name, filters in queries.items():
+        rows, first_ms, seconds, peak = time_query(
+            lambda: service.query_events(app_name="bench", **filters)
+        )
+        print(
+            f"{name:>28} {rows:>11,} {first_ms:>15.2f} {seconds:>10.2f} "
+            f"{rows / seconds:>11,.0f} {peak:>15.1f}"
+        )
 
-check_data_in_db()
+    # The old check_data_in_db() pattern for comparison: fetchall() of one day. Fetching
+    # the whole table this way needs more RAM than most notebooks have at 10M events.
+    with sqlite3.connect(path) as connection:
+        rows, first_ms, seconds, peak = time_query(
+            lambda: connection.execute(
+                "select app_name, session_id, author, content from events where "
+                "app_name = 'bench' and timestamp >= ? and timestamp < ?",
+                (
+                    str(datetime.fromtimestamp(day)),
+                    str(datetime.fromtimestamp(day + 86400)),
+                ),
+            ).fetchall()
+        )
+    print(
+        f"{'whole app, 1 day, fetchall()':>28} {rows:>11,} {first_ms:>15.2f} "
+        f"{seconds:>10.2f} {rows / seconds:>11,.0f} {peak:>15.1f}"
+    )
+    service.db_engine.dispose()
+    remove_sqlite_files(path)
+
+
+if RUN_BENCHMARKS:
+    benchmark_analytics_queries()
 # %%
 ## Context Compaction
 # Re-define our app with Events Compaction enabled
@@ -206,7 +781,9 @@ research_app_compacting = App(
 )
 
 db_url = "sqlite:///my_agent_data.db"  # Local SQLite file
-session_service = DatabaseSessionService(db_url=db_url)
+session_service = FastDatabaseSessionService(db_url=db_url)
+# Index summaries written by earlier runs of this notebook (safe to re-run)
+await session_service.rebuild_compaction_checkpoints()
 
 # Create a new runner for our upgraded app
 research_runner_compacting = Runner(
@@ -253,21 +830,723 @@ final_session = await session_service.get_session(
 )
 
 print("--- Searching for Compaction Summary Event ---")
-found_summary = False
-for event in final_session.events:
-    # Compaction evetns have a 'compaction' attribute
-    if event.actions and event.actions.compaction:
-        print("\n SUCCESS! Found the Compaction Event:")
-        print(f"  Author: {event.author}")
-        print(f"\n Compacted information: {event}")
-        found_summary = True
-        break
-
-if not found_summary:
+# The checkpoint index points straight at the newest summary - no scan over the events
+summary_event = await session_service.get_latest_compaction(
+    app_name=research_runner_compacting.app_name,
+    user_id=USER_ID,
+    session_id="compaction_demo",
+)
+if summary_event:
+    print("\n SUCCESS! Found the Compaction Event:")
+    print(f"  Author: {summary_event.author}")
+    print(f"\n Compacted information: {summary_event}")
+else:
     print(
         "\n No compaction event found. Try increasing the number of turns in the demo."
     )
 
+# %%
+# Long sessions don't need their whole history loaded for the next turn:
+# the newest summary plus what came after it is enough.
+windowed_session = await session_service.get_session(
+    app_name=research_runner_compacting.app_name,
+    user_id=USER_ID,
+    session_id="compaction_demo",
+    config=WindowedSessionConfig(since_last_compaction=True),
+)
+recent_session = await session_service.get_session(
+    app_name=research_runner_compacting.app_name,
+    user_id=USER_ID,
+    session_id="compaction_demo",
+    config=WindowedSessionConfig(num_recent_events=3),
+)
+print(f"Full session: {len(final_session.events)} events")
+print(f"Since last compaction: {len(windowed_session.events)} events")
+print(f"Last 3 events: {len(recent_session.events)} events")
+
+# Older history is still available, one page at a time
+async for page in session_service.iter_event_pages(
+    app_name=research_runner_compacting.app_name,
+    user_id=USER_ID,
+    session_id="compaction_demo",
+    page_size=4,
+):
+    print(f"  Page: {[event.author for event in page]}")
+
+# %%
+## Token-Budget Compaction
+# compaction_interval counts invocations, not tokens: it summarizes small sessions that
+# were nowhere near full and lets a few huge turns overflow the context. A TokenBudget
+# triggers on the session's running token count instead (count_tokens=True).
+
+# Context windows (tokens) for the models used in this course
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-2.5-flash-lite": 1_048_576,
+    "gemini-2.5-flash": 1_048_576,
+    "gemini-2.5-pro": 1_048_576,
+    "gemini-2.0-flash": 1_048_576,
+}
+
+
+class TokenBudget:
+    """When to compact a session, as fractions of a model's context window.
+
+    Args:
+        context_window: The model's context window in tokens.
+        high_watermark: Compact once the session's live tokens pass this fraction.
+        low_watermark: Summarize the oldest turns until the rest fits under this
+            fraction.
+    """
+
+    def __init__(
+        self,
+        context_window: int,
+        high_watermark: float = 0.8,
+        low_watermark: float = 0.5,
+    ):
+        if not 0 < low_watermark < high_watermark <= 1:
+            raise ValueError(
+                "Watermarks must satisfy 0 < low_watermark < high_watermark <= 1."
+            )
+        self.context_window = context_window
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+    @classmethod
+    def for_model(cls, model: str, **kwargs) -> "TokenBudget":
+        return cls(MODEL_CONTEXT_WINDOWS[model], **kwargs)
+
+    @property
+    def high_tokens(self) -> int:
+        return int(self.context_window * self.high_watermark)
+
+    @property
+    def low_tokens(self) -> int:
+        return int(self.context_window * self.low_watermark)
+
+    def events_to_compact(self, events: list[Event]) -> list[Event]:
+        """The oldest unsummarized events, leaving the newest turns that fit under
+        the low watermark."""
+        summaries = [
+            event for event in events if event.actions and event.actions.compaction
+        ]
+        previous_end = max(
+            (event.actions.compaction.end_timestamp for event in summaries), default=0.0
+        )
+        live = [
+            event
+            for event in events
+            if not (event.actions and event.actions.compaction)
+            and event.timestamp > previous_end
+        ]
+        # Earlier summaries stay in the context too, so they count against the low
+        # watermark
+        cut, tail_tokens = len(live), sum(
+            estimate_event_tokens(event) for event in summaries
+        )
+        while (
+            cut > 0
+            and tail_tokens + estimate_event_tokens(live[cut - 1]) <= self.low_tokens
+        ):
+            cut -= 1
+            tail_tokens += estimate_event_tokens(live[cut])
+        # Never split an invocation between the summary and the turns that are kept
+        while (
+            0 < cut < len(live)
+            and live[cut].invocation_id == live[cut - 1].invocation_id
+        ):
+            cut += 1
+        return live[:cut]
+
+
+print("Token budget defined")
+
+# %%
+## Background Compaction
+# Summarizing is a full model call. ADK's Runner already keeps it out of the turn: it
+# starts a fire-and-forget task per invocation. Those tasks aren't bounded, coalesced,
+# awaited on shutdown or coordinated between replicas sharing a database.
+# CompactionWorkerPool queues sessions instead: a fixed set of workers folds every turn
+# since the last pass into one, takes a lease on the session in the store, summarizes,
+# and publishes the compaction event in one transaction.
+import asyncio
+import time
+import uuid
+
+from google.adk.apps.compaction import _run_compaction_for_sliding_window
+from google.adk.apps.llm_event_summarizer import LlmEventSummarizer
+
+
+class _LeasedCompactionPublisher:
+    """Stands in for the session service inside ADK's compaction routine, so the
+    summary it produces is published under the worker's lease."""
+
+    def __init__(
+        self, service: FastDatabaseSessionService, key: tuple[str, str, str], owner: str
+    ):
+        self.service = service
+        self.key = key
+        self.owner = owner
+        self.published = False
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        # Slot the summary in right after the range it covers. Turns that finished while
+        # it was being written are newer than the range and must not look summarized.
+        event.timestamp = event.actions.compaction.end_timestamp + 1e-6
+        token_delta = compaction_token_delta(session.events, event)
+        self.published = self.service.publish_compaction_event(
+            self.key, event, self.owner, token_delta
+        )
+        return event
+
+
+class CompactionWorkerPool:
+    """Runs events compaction for many sessions in background worker tasks.
+
+    Args:
+        app: The App whose events_compaction_config (interval, overlap, summarizer)
+            to apply.
+        session_service: Leases and publishing go through this store, so workers in
+            several processes can share one database.
+        num_workers: Maximum concurrent summarizations.
+        lease_seconds: How long a worker may hold a session before another can take
+            over.
+        retry_delay: Wait before re-checking a session leased by another process.
+        token_budget: Compact on the session's token count instead of every
+            compaction_interval invocations. Needs a service with count_tokens=True.
+    """
+
+    def __init__(
+        self,
+        app: App,
+        session_service: FastDatabaseSessionService,
+        num_workers: int = 4,
+        lease_seconds: float = 120.0,
+        retry_delay: float = 1.0,
+        token_budget: TokenBudget | None = None,
+    ):
+        if token_budget and not session_service.count_tokens:
+            raise ValueError(
+                "token_budget needs a session service created with count_tokens=True."
+            )
+        self.app = app
+        self.session_service = session_service
+        self.num_workers = num_workers
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.token_budget = token_budget
+        self._default_summarizer = None
+        self.owner_prefix = uuid.uuid4().hex[:12]
+        self.stats = {
+            "queued": 0,
+            "compacted": 0,
+            "not_needed": 0,
+            "lease_busy": 0,
+            "failed": 0,
+        }
+        self._queue: asyncio.Queue | None = None
+        self._queued: dict[tuple[str, str, str], float] = {}
+        self._running: set[tuple[str, str, str]] = set()
+        self._workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._work(f"{self.owner_prefix}-{i}"))
+            for i in range(self.num_workers)
+        ]
+
+    async def stop(self) -> None:
+        """Finish queued work, then stop the workers."""
+        await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    def submit(
+        self,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        completed_until: float | None = None,
+    ) -> None:
+        """Queue a session for a compaction check. Never blocks the caller.
+
+        Only events up to `completed_until` (default: now) are considered, so a turn
+        that starts while the session waits in the queue is never summarized half-done.
+        """
+        key = (app_name, user_id, session_id)
+        completed_until = completed_until or time.time()
+        if key in self._queued:
+            # Already waiting - one pass covers every turn since
+            self._queued[key] = max(self._queued[key], completed_until)
+            return
+        self._queued[key] = completed_until
+        self.stats["queued"] += 1
+        if key not in self._running:
+            self._queue.put_nowait(key)
+
+    async def _work(self, owner: str) -> None:
+        while True:
+            key = await self._queue.get()
+            completed_until = self._queued.pop(key)
+            self._running.add(key)
+            try:
+                await self._compact(key, owner, completed_until)
+            except Exception:
+                self.stats["failed"] += 1
+                logging.exception("Background compaction failed for %s", key)
+            finally:
+                self._running.discard(key)
+                if key in self._queued:
+                    self._queue.put_nowait(key)  # Turns finished while this one ran
+                self._queue.task_done()
+
+    async def _compact(
+        self, key: tuple[str, str, str], owner: str, completed_until: float
+    ) -> None:
+        service = self.session_service
+        if self.token_budget:
+            live_tokens = service.session_token_count(
+                app_name=key[0], user_id=key[1], session_id=key[2]
+            )
+            if live_tokens < self.token_budget.high_tokens:
+                self.stats["not_needed"] += 1  # Decided without loading the session
+                return
+        if not service.acquire_compaction_lease(key, owner, self.lease_seconds):
+            # Someone else is summarizing this session; look again once they're done
+            self.stats["lease_busy"] += 1
+            await asyncio.sleep(self.retry_delay)
+            self.submit(*key, completed_until=completed_until)
+            return
+        publisher = _LeasedCompactionPublisher(service, key, owner)
+        try:
+            session = await service.get_session(
+                app_name=key[0], user_id=key[1], session_id=key[2]
+            )
+            if session is not None:
+                session.events = [
+                    event
+                    for event in session.events
+                    if event.timestamp <= completed_until
+                ]
+                if self.token_budget:
+                    await self._compact_to_budget(session, publisher)
+                else:
+                    await _run_compaction_for_sliding_window(
+                        self.app, session, publisher
+                    )
+        finally:
+            if not publisher.published:
+                service.release_compaction_lease(key, owner)
+        self.stats["compacted" if publisher.published else "not_needed"] += 1
+
+    async def _compact_to_budget(
+        self, session: Session, publisher: _LeasedCompactionPublisher
+    ) -> None:
+        events_to_compact = self.token_budget.events_to_compact(session.events)
+        if not events_to_compact:
+            return
+        compaction_event = await self._summarizer().maybe_summarize_events(
+            events=events_to_compact
+        )
+        if compaction_event:
+            await publisher.append_event(session, compaction_event)
+
+    def _summarizer(self):
+        config = self.app.events_compaction_config
+        if config and config.summarizer:
+            return config.summarizer
+        if self._default_summarizer is None:
+            self._default_summarizer = LlmEventSummarizer(
+                llm=self.app.root_agent.canonical_model
+            )
+        return self._default_summarizer
+
+
+class BackgroundCompactionRunner(Runner):
+    """Runner that hands compaction to a CompactionWorkerPool instead of summarizing
+    itself."""
+
+    def __init__(self, *, app: App, compaction_pool: CompactionWorkerPool, **kwargs):
+        super().__init__(
+            app=app.model_copy(update={"events_compaction_config": None}), **kwargs
+        )
+        self.compaction_pool = compaction_pool
+
+    async def run_async(self, *, user_id: str, session_id: str, **kwargs):
+        async for event in super().run_async(
+            user_id=user_id, session_id=session_id, **kwargs
+        ):
+            yield event
+        self.compaction_pool.submit(self.app_name, user_id, session_id)
+
+
+print("Background compaction defined")
+
+# %%
+compaction_pool = CompactionWorkerPool(
+    research_app_compacting, session_service, num_workers=2
+)
+compaction_pool.start()
+background_runner = BackgroundCompactionRunner(
+    app=research_app_compacting,
+    session_service=session_service,
+    compaction_pool=compaction_pool,
+)
+
+for query in [
+    "What is the latest news about AI in healthcare?",
+    "Are there any new developments in drug discovery?",
+    "Tell me more about the second development you found.",
+    "Who are the main companies involved in that?",
+]:
+    await run_session(background_runner, query, "background_compaction_demo")
+
+await compaction_pool.stop()  # Wait for the summaries before looking for them
+print(compaction_pool.stats)
+
+# %%
+## Benchmark: Turn Latency with Background Compaction
+import time
+
+from google.adk.apps.llm_event_summarizer import LlmEventSummarizer
+from google.adk.models import BaseLlm, LlmResponse
+
+
+class SimulatedLlm(BaseLlm):
+    """A stand-in model that answers after a fixed delay, so runs are repeatable and
+    free."""
+
+    latency: float = 0.05
+    reply: str = "A short simulated answer."
+
+    async def generate_content_async(self, llm_request, stream: bool = False):
+        await asyncio.sleep(self.latency)
+        yield LlmResponse(
+            content=types.Content(role="model", parts=[types.Part(text=self.reply)])
+        )
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def benchmark_compaction_latency(
+    num_sessions: int = 16,
+    turns_per_session: int = 12,
+    model_latency: float = 0.05,
+    summary_latency: float = 0.5,
+):
+    """Concurrent users chatting with ADK's own background compaction (the stock
+    Runner) vs the worker pool. Both keep summaries out of the turn; they differ in how
+    many summaries get written and whether a summary can fail the next turn."""
+    app = App(
+        name="bench_compaction",
+        root_agent=LlmAgent(
+            model=SimulatedLlm(model="simulated-chat", latency=model_latency),
+            name="bench_agent",
+        ),
+        events_compaction_config=EventsCompactionConfig(
+            compaction_interval=3,
+            overlap_size=1,
+            summarizer=LlmEventSummarizer(
+                llm=SimulatedLlm(model="simulated-summarizer", latency=summary_latency)
+            ),
+        ),
+    )
+    results = {}
+    for mode in ("adk runner", "worker pool"):
+        remove_sqlite_files("bench_compaction.db")
+        service = FastDatabaseSessionService(
+            db_url="sqlite:///bench_compaction.db", tune_sqlite=True
+        )
+        pool = CompactionWorkerPool(app, service, num_workers=4)
+        if mode == "worker pool":
+            pool.start()
+            runner = BackgroundCompactionRunner(
+                app=app, session_service=service, compaction_pool=pool
+            )
+        else:
+            runner = Runner(app=app, session_service=service)
+        latencies = []
+        failed_turns = 0
+
+        async def chat(session_index: int):
+            nonlocal failed_turns
+            session = await service.get_or_create_session(
+                app_name=app.name,
+                user_id=USER_ID,
+                session_id=f"session-{session_index}",
+            )
+            for turn in range(turns_per_session):
+                start = time.perf_counter()
+                message = types.Content(
+                    role="user", parts=[types.Part(text=f"Question {turn}")]
+                )
+                try:
+                    async for _ in runner.run_async(
+                        user_id=USER_ID, session_id=session.id, new_message=message
+                    ):
+                        pass
+                except ValueError:
+                    # A summary appended mid-turn bumped the session's update_time,
+                    # so ADK rejects the turn's events as written to a stale session
+                    failed_turns += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(chat(i) for i in range(num_sessions)))
+        drain_start = time.perf_counter()
+        if mode == "worker pool":
+            await pool.stop()
+        else:
+            # The Runner keeps no handle on its compaction tasks; find them by coroutine
+            await asyncio.gather(
+                *(
+                    task
+                    for task in asyncio.all_tasks()
+                    if task.get_coro().__name__ == "_run_compaction_for_sliding_window"
+                ),
+                return_exceptions=True,
+            )
+        drain = time.perf_counter() - drain_start
+        summaries = 0
+        for i in range(num_sessions):
+            session = await service.get_session(
+                app_name=app.name, user_id=USER_ID, session_id=f"session-{i}"
+            )
+            summaries += sum(1 for event in session.events if event.actions.compaction)
+        results[mode] = (
+            percentile(latencies, 50),
+            percentile(latencies, 99),
+            summaries,
+            drain,
+            failed_turns,
+        )
+        service.db_engine.dispose()
+    remove_sqlite_files("bench_compaction.db")
+
+    print(
+        f"{'compaction':>12} {'p50 turn (ms)':>14} {'p99 turn (ms)':>14} "
+        f"{'summaries':>10} {'drain (ms)':>11} {'failed turns':>13}"
+    )
+    for mode, (p50, p99, summaries, drain, failed) in results.items():
+        print(
+            f"{mode:>12} {p50 * 1000:>14.0f} {p99 * 1000:>14.0f} {summaries:>10} "
+            f"{drain * 1000:>11.0f} {failed:>13}"
+        )
+
+
+if RUN_BENCHMARKS:
+    await benchmark_compaction_latency()
+
+# %%
+## Benchmark: Token Budget vs Invocation Interval
+from google.adk.flows.llm_flows.contents import _process_compaction_events
+
+
+async def simulate_compaction_policy(
+    token_budget: TokenBudget | None, message_tokens: int, num_turns: int = 30
+):
+    """Chat with `message_tokens`-sized messages; returns (summaries, peak live
+    tokens, counter, recount)."""
+    remove_sqlite_files("bench_budget.db")
+    service = FastDatabaseSessionService(
+        db_url="sqlite:///bench_budget.db", tune_sqlite=True, count_tokens=True
+    )
+    summarizer = LlmEventSummarizer(
+        llm=SimulatedLlm(
+            model="simulated-summarizer", latency=0, reply="Summary. " * 50
+        )
+    )
+    app = App(
+        name="bench_budget",
+        root_agent=LlmAgent(
+            model=SimulatedLlm(model="simulated-chat", latency=0), name="bench_agent"
+        ),
+        events_compaction_config=EventsCompactionConfig(
+            compaction_interval=3, overlap_size=1, summarizer=summarizer
+        ),
+    )
+    pool = CompactionWorkerPool(app, service, token_budget=token_budget)
+    pool.start()
+    runner = BackgroundCompactionRunner(
+        app=app, session_service=service, compaction_pool=pool
+    )
+    key = dict(app_name=app.name, user_id=USER_ID, session_id="budget")
+    await service.get_or_create_session(**key)
+
+    peak = 0
+    for turn in range(num_turns):
+        message = types.Content(
+            role="user", parts=[types.Part(text="word " * int(message_tokens * 0.8))]
+        )
+        async for _ in runner.run_async(
+            user_id=USER_ID, session_id="budget", new_message=message
+        ):
+            pass
+        # What the next turn would send
+        peak = max(peak, service.session_token_count(**key))
+        await pool.join()
+    await pool.stop()
+
+    # The running counter should match a full recount of the assembled context
+    session = await service.get_session(**key)
+    counter = service.session_token_count(**key)
+    recount = sum(
+        estimate_event_tokens(event)
+        for event in _process_compaction_events(session.events)
+    )
+    summaries = sum(1 for event in session.events if event.actions.compaction)
+    service.db_engine.dispose()
+    remove_sqlite_files("bench_budget.db")
+    return summaries, peak, counter, recount
+
+
+async def benchmark_token_budget(context_window: int = 8000):
+    # The high watermark has to leave room for one more turn: the check runs after a
+    # turn ends
+    policies = {
+        "every 3 invocations": None,
+        "token budget 60%/30%": TokenBudget(
+            context_window, high_watermark=0.6, low_watermark=0.3
+        ),
+    }
+    sessions = {"small turns": 20, "large turns": 2500}
+    print(f"Context window: {context_window:,} tokens")
+    print(
+        f"{'policy':>22} {'session':>12} {'summaries':>10} {'peak tokens':>12} "
+        f"{'overflowed':>11} {'counter == recount':>19}"
+    )
+    for policy, budget in policies.items():
+        for session_kind, message_tokens in sessions.items():
+            summaries, peak, counter, recount = await simulate_compaction_policy(
+                budget, message_tokens
+            )
+            print(
+                f"{policy:>22} {session_kind:>12} {summaries:>10} {peak:>12,} "
+                f"{str(peak > context_window):>11} {str(counter == recount):>19}"
+            )
+
+
+if RUN_BENCHMARKS:
+    await benchmark_token_budget()
+
+# %%
+## Benchmark: Compaction Checkpoints
+import statistics
+import time
+
+from google.adk.events import EventActions
+from google.adk.events.event_actions import EventCompaction
+
+
+async def build_compacted_session(
+    service,
+    session_id: str,
+    num_events: int,
+    compact_every: int = 100,
+    overlap: int = 10,
+):
+    """A long session with a summary every `compact_every` events, like a busy chat
+    thread."""
+    session = await service.get_or_create_session(
+        app_name="bench", user_id=USER_ID, session_id=session_id
+    )
+    timestamps = []
+    rng = random.Random(0)
+    for i in range(num_events):
+        event = make_synthetic_event(i, rng)
+        await service.append_event(session, event)
+        timestamps.append(event.timestamp)
+        if (
+            i % compact_every == compact_every - 1
+            and i < num_events - compact_every // 2
+        ):
+            compaction = EventCompaction(
+                start_timestamp=timestamps[max(0, i + 1 - compact_every - overlap)],
+                end_timestamp=timestamps[i],
+                compacted_content=types.Content(
+                    role="model", parts=[types.Part(text=f"Summary up to event {i}.")]
+                ),
+            )
+            await service.append_event(
+                session,
+                Event(
+                    author="user",
+                    invocation_id=Event.new_id(),
+                    actions=EventActions(compaction=compaction),
+                ),
+            )
+    service.flush()
+
+
+async def median_ms(run, repeats: int = 5) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+async def benchmark_compaction_checkpoints(session_sizes=(10_000, 50_000)):
+    remove_sqlite_files("bench_checkpoints.db")
+    service = FastDatabaseSessionService(
+        db_url="sqlite:///bench_checkpoints.db", tune_sqlite=True, write_behind=True
+    )
+    print(f"{'events':>8} {'approach':>34} {'median (ms)':>12}")
+    for num_events in session_sizes:
+        session_id = f"session-{num_events}"
+        await build_compacted_session(service, session_id, num_events)
+        key = dict(app_name="bench", user_id=USER_ID, session_id=session_id)
+
+        async def full_scan():
+            session = await service.get_session(**key)
+            return next(
+                event for event in reversed(session.events) if event.actions.compaction
+            )
+
+        async def page_walk():
+            async for page in service.iter_event_pages(**key, page_size=100):
+                for event in reversed(page):
+                    if event.actions.compaction:
+                        return event
+
+        async def full_context():
+            return _process_compaction_events((await service.get_session(**key)).events)
+
+        async def windowed_context():
+            config = WindowedSessionConfig(since_last_compaction=True)
+            return _process_compaction_events(
+                (await service.get_session(**key, config=config)).events
+            )
+
+        approaches = {
+            "latest summary: load + scan": full_scan,
+            "latest summary: page walk": page_walk,
+            "latest summary: checkpoint index": lambda: service.get_latest_compaction(
+                **key
+            ),
+            "context: full load": full_context,
+            "context: checkpoint + overlap": windowed_context,
+        }
+        for name, run in approaches.items():
+            print(f"{num_events:>8,} {name:>34} {await median_ms(run):>12.2f}")
+    service.close()
+    service.db_engine.dispose()
+    remove_sqlite_files("bench_checkpoints.db")
+
+
+if RUN_BENCHMARKS:
+    await benchmark_compaction_checkpoints()
+
 # %%
 ## Working with Session
 # Define scope levels for state keys (following best practices)
@@ -326,7 +1605,7 @@ root_agent = LlmAgent(
 )
 
 # Set up session service and runner
-session_service = InMemorySessionService()
+session_service = FastInMemorySessionService()
 runner = Runner(agent=root_agent, session_service=session_service, app_name="default")
 
 print("Agent with session state tools initialized!")
@@ -373,3 +1652,1467 @@ print(session.state)
 
 # Note: Depending on implementation, you might see shared state here.
 # This is where the distincetion between session-specific and user-specific state becomes important.
+
+# %%
+## Cached User and App State
+# `user:` and `app:` keys live in their own tables and are shared by every session of
+# that user/app. With state_cache_size each of them is kept once in memory, so a profile
+# read doesn't need a session load. An update is seen by every later read through the
+# cache (get_user_state/get_app_state and the next session load); Session objects that
+# are already loaded keep the state they were loaded with.
+session_service = FastDatabaseSessionService(
+    db_url="sqlite:///my_agent_data.db",
+    tune_sqlite=True,
+    write_behind=True,
+    state_cache_size=1024,
+)
+runner = Runner(agent=root_agent, session_service=session_service, app_name=APP_NAME)
+
+await run_session(runner, ["My name is Sam. I'm from Poland."], "cached-state-session")
+
+# Read the user's profile without loading any session or its events
+print(
+    "User profile:",
+    await session_service.get_user_state(app_name=APP_NAME, user_id=USER_ID),
+)
+
+# Update it directly; the next session load sees the change
+await session_service.update_user_state(
+    app_name=APP_NAME, user_id=USER_ID, state_delta={"country": "Portugal"}
+)
+await run_session(runner, ["Which country am I from?"], "cached-state-session-2")
+session_service.flush()
+
+# %%
+## Benchmark: Profile Reads
+import os
+import time
+
+
+def remove_state_bench_db():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(f"bench_state.db{suffix}"):
+            os.remove(f"bench_state.db{suffix}")
+
+
+async def benchmark_profile_reads(
+    num_sessions=20, events_per_session=200, num_reads=500, num_updates=2_000
+):
+    """Per-read latency of a user profile via get_session vs the state tables, plus
+    update throughput."""
+    remove_state_bench_db()
+    loader = FastDatabaseSessionService(
+        db_url="sqlite:///bench_state.db", tune_sqlite=True, write_behind=True
+    )
+    for s in range(num_sessions):
+        session = await loader.get_or_create_session(
+            app_name="bench",
+            user_id="sam",
+            session_id=f"session-{s}",
+            state={"user:name": "Sam"},
+        )
+        for i in range(events_per_session):
+            await loader.append_event(
+                session,
+                Event(
+                    invocation_id=f"turn-{i}",
+                    author="user",
+                    content=types.Content(
+                        role="user", parts=[types.Part(text=f"Message {i}")]
+                    ),
+                ),
+            )
+    loader.close()
+
+    uncached = FastDatabaseSessionService(
+        db_url="sqlite:///bench_state.db", tune_sqlite=True, write_behind=True
+    )
+    cached = FastDatabaseSessionService(
+        db_url="sqlite:///bench_state.db",
+        tune_sqlite=True,
+        write_behind=True,
+        state_cache_size=1024,
+    )
+    key = {"app_name": "bench", "user_id": "sam"}
+    reads = {
+        "get_session().state": lambda i: uncached.get_session(
+            **key, session_id=f"session-{i % num_sessions}"
+        ),
+        "get_user_state (no cache)": lambda i: uncached.get_user_state(**key),
+        "get_user_state (cached)": lambda i: cached.get_user_state(**key),
+    }
+    for label, read in reads.items():
+        start = time.perf_counter()
+        for i in range(num_reads):
+            await read(i)
+        print(
+            f"{label:>26}: {(time.perf_counter() - start) / num_reads * 1000:8.3f} "
+            "ms/read"
+        )
+
+    for label, service in [("no cache", uncached), ("cached", cached)]:
+        start = time.perf_counter()
+        for i in range(num_updates):
+            await service.update_user_state(**key, state_delta={"last_seen": i})
+        service.flush()
+        updates_per_sec = num_updates / (time.perf_counter() - start)
+        print(
+            f"{'update_user_state (' + label + ')':>26}: {updates_per_sec:10,.0f} "
+            "updates/sec"
+        )
+
+    assert (await uncached.get_user_state(**key))["last_seen"] == num_updates - 1
+    uncached.close()
+    cached.close()
+    remove_state_bench_db()
+
+
+if RUN_BENCHMARKS:
+    await benchmark_profile_reads()
+
+# %%
+## Sharded Session Storage
+# SQLite has one writer per file, so a single my_agent_data.db serializes every user's
+# turns. ShardedSessionService gives each (app_name, user_id) a home among N database
+# files by consistent hashing: all of a user's sessions and `user:` state stay in one
+# file, and changing N only moves the users whose home changed (about 1/N of them).
+from session_storage import ShardedSessionService, rebalance_shards
+
+print("Sharded session service defined")
+
+# %%
+## Benchmark: Sharded Writes
+# Several worker processes (like several API server replicas) append events for their
+# own users. With one file they all queue for its write lock; with N shards up to N
+# commits run at once.
+import importlib
+import multiprocessing
+import time
+
+# Workers run in spawned processes: forking a kernel that has live threads (IOPub,
+# write-behind, compaction) can deadlock the child. A spawned child starts a fresh
+# interpreter and can't see the notebook's globals, so the worker lives in a module on
+# disk and imports the session service from session_storage.py.
+shard_append_worker_code = '''
+import asyncio
+import time
+
+from google.adk.events import Event
+from google.genai import types
+
+from session_storage import ShardedSessionService
+
+
+def append_events(db_urls, user_ids, events_per_user):
+    """Open this worker's users' sessions, then append their events.
+
+    Returns (start, end).
+    """
+
+    async def run():
+        service = ShardedSessionService(db_urls, tune_sqlite=True)
+        sessions = [
+            await service.get_or_create_session(
+                app_name="bench", user_id=user_id, session_id="session"
+            )
+            for user_id in user_ids
+        ]
+        start = time.time()
+        for i in range(events_per_user):
+            for session in sessions:
+                await service.append_event(
+                    session,
+                    Event(
+                        invocation_id=f"inv-{i}",
+                        author="user",
+                        content=types.Content(
+                            role="user", parts=[types.Part(text=f"Message {i}")]
+                        ),
+                    ),
+                )
+        end = time.time()
+        service.close()
+        return start, end
+
+    return asyncio.run(run())
+
+
+def run_and_report(worker, args, results):
+    """Entry point of a spawned process: put worker(*args), or its error, on
+    `results`."""
+    try:
+        results.put(worker(*args))
+    except BaseException as error:
+        # Don't leave the parent waiting
+        results.put(RuntimeError(f"worker failed: {error!r}"))
+        raise
+'''
+
+with open("shard_append_worker.py", "w") as f:
+    f.write(shard_append_worker_code)
+importlib.invalidate_caches()
+shard_append_worker = importlib.reload(importlib.import_module("shard_append_worker"))
+
+
+def run_in_processes(worker, args_list: list[tuple]) -> list:
+    """Run worker(*args) in a spawned process per args and collect the results.
+
+    `worker` must be importable by the child, e.g. a function of shard_append_worker.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=shard_append_worker.run_and_report, args=(worker, args, results)
+        )
+        for args in args_list
+    ]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    for result in collected:
+        if isinstance(result, Exception):
+            raise result
+    return collected
+
+
+def shard_urls(num_shards: int) -> list[str]:
+    return [f"sqlite:///bench_shard_{shard}.db" for shard in range(num_shards)]
+
+
+def remove_shard_files(num_shards: int) -> None:
+    for shard in range(num_shards):
+        remove_sqlite_files(f"bench_shard_{shard}.db")
+
+
+def create_empty_shards(num_shards: int) -> list[str]:
+    remove_shard_files(num_shards)
+    urls = shard_urls(num_shards)
+    ShardedSessionService(urls).close()  # Create the schemas before the workers race to
+    return urls
+
+
+async def benchmark_sharded_writes(
+    shard_counts=(1, 2, 4, 8), num_workers=8, num_users=64, events_per_user=50
+) -> None:
+    print(f"{os.cpu_count()} CPUs, {num_workers} worker processes, {num_users} users")
+    user_ids = [f"user-{u}" for u in range(num_users)]
+    for num_shards in shard_counts:
+        urls = create_empty_shards(num_shards)
+        spans = run_in_processes(
+            shard_append_worker.append_events,
+            [
+                (urls, user_ids[w::num_workers], events_per_user)
+                for w in range(num_workers)
+            ],
+        )
+        elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+        print(
+            f"{num_shards:>2} shard(s): {num_users * events_per_user / elapsed:8,.0f} "
+            "events/sec"
+        )
+        remove_shard_files(num_shards)
+
+    # Grow 4 -> 5 shards: only the users whose home changed are moved
+    remove_shard_files(5)
+    urls = create_empty_shards(4)
+    run_in_processes(
+        shard_append_worker.append_events,
+        [(urls, user_ids[w::num_workers], 5) for w in range(num_workers)],
+    )
+    start = time.perf_counter()
+    moved = rebalance_shards(urls, shard_urls(5))
+    print(
+        f"rebalance 4 -> 5 shards: moved {moved} of {num_users} users in "
+        f"{time.perf_counter() - start:.2f} s"
+    )
+    service = ShardedSessionService(shard_urls(5))
+    listed = await service.list_sessions(app_name="bench")
+    for user_id in user_ids:
+        session = await service.get_session(
+            app_name="bench", user_id=user_id, session_id="session"
+        )
+        assert len(session.events) == 5
+    print(
+        f"after rebalance: {len(listed.sessions)} sessions listed across shards, every "
+        "user found on its new shard"
+    )
+    service.close()
+    remove_shard_files(5)
+
+
+if RUN_BENCHMARKS:
+    await benchmark_sharded_writes()
+
+# %%
+## Bounded In-Memory Sessions
+# InMemorySessionService keeps every session in RAM until the process exits. This
+# version keeps at most `max_memory_bytes` of sessions resident, spills the least
+# recently used ones to a local directory and loads them back the next time they are
+# touched.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any
+
+import zstandard
+from google.adk.events import Event
+from google.adk.sessions import Session
+
+
+class BoundedInMemorySessionService(FastInMemorySessionService):
+    """FastInMemorySessionService with a memory cap and LRU spill to disk.
+
+    Args:
+        max_memory_bytes: Cap on the serialized (JSON) size of resident sessions. Live
+            Session objects take several times that much heap. The session in use
+            always stays resident, even if it alone is larger.
+        spill_dir: Directory for spilled sessions (zstd-compressed JSON, one file each).
+            Defaults to a new temporary directory. Only the files this service spilled
+            are ever removed from it.
+
+    `app:` and `user:` state are small and stay in memory.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_memory_bytes: int = 256 * 1024 * 1024,
+        spill_dir: str | None = None,
+    ):
+        super().__init__()
+        self.max_memory_bytes = max_memory_bytes
+        self._owns_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="spilled_sessions_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # LRU order -> size
+        self._resident: OrderedDict[tuple[str, str, str], int] = OrderedDict()
+        self._resident_bytes = 0
+        self._spilled: dict[tuple[str, str, str], str] = {}
+        self._compressor = zstandard.ZstdCompressor(level=1)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self.evictions = 0
+        self.reload_seconds: list[float] = []
+
+    def _spill_path(self, key: tuple[str, str, str]) -> str:
+        return os.path.join(
+            self.spill_dir,
+            hashlib.sha1("\0".join(key).encode()).hexdigest() + ".json.zst",
+        )
+
+    def _read_spilled(self, key: tuple[str, str, str]) -> Session:
+        with open(self._spilled[key], "rb") as f:
+            return Session.model_validate_json(self._decompressor.decompress(f.read()))
+
+    def _track(self, key: tuple[str, str, str], size: int) -> None:
+        """Record `size` more bytes for a resident session, mark it most recently used
+        and spill others until the rest fits."""
+        self._resident[key] = self._resident.get(key, 0) + size
+        self._resident.move_to_end(key)
+        self._resident_bytes += size
+        while self._resident_bytes > self.max_memory_bytes and len(self._resident) > 1:
+            self._spill(next(iter(self._resident)))
+
+    def _spill(self, key: tuple[str, str, str]) -> None:
+        app_name, user_id, session_id = key
+        session = self.sessions[app_name][user_id].pop(session_id)
+        path = self._spill_path(key)
+        with open(path, "wb") as f:
+            f.write(self._compressor.compress(session.model_dump_json().encode()))
+        self._spilled[key] = path
+        self._resident_bytes -= self._resident.pop(key)
+        self.evictions += 1
+
+    def _ensure_resident(self, app_name: str, user_id: str, session_id: str) -> None:
+        key = (app_name, user_id, session_id)
+        if key in self._resident:
+            self._resident.move_to_end(key)
+        elif key in self._spilled:
+            start = time.perf_counter()
+            session = self._read_spilled(key)
+            os.remove(self._spilled.pop(key))
+            self.sessions.setdefault(app_name, {}).setdefault(user_id, {})[
+                session_id
+            ] = session
+            self.reload_seconds.append(time.perf_counter() - start)
+            self._track(key, len(session.model_dump_json()))
+
+    def _create_session_impl(
+        self, *, app_name, user_id, state=None, session_id=None
+    ) -> Session:
+        session = super()._create_session_impl(
+            app_name=app_name, user_id=user_id, state=state, session_id=session_id
+        )
+        stored = self.sessions[app_name][user_id][session.id]
+        self._track((app_name, user_id, session.id), len(stored.model_dump_json()))
+        return session
+
+    def _get_session_impl(self, *, app_name, user_id, session_id, config=None):
+        self._ensure_resident(app_name, user_id, session_id)
+        return super()._get_session_impl(
+            app_name=app_name, user_id=user_id, session_id=session_id, config=config
+        )
+
+    async def get_or_create_session(
+        self, *, app_name, user_id, session_id, state=None
+    ) -> Session:
+        self._ensure_resident(app_name, user_id, session_id)
+        return await super().get_or_create_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, state=state
+        )
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        key = (session.app_name, session.user_id, session.id)
+        self._ensure_resident(*key)
+        event = await super().append_event(session, event)
+        if not event.partial and key in self._resident:
+            self._track(key, len(event.model_dump_json()))
+        return event
+
+    def _list_sessions_impl(self, *, app_name, user_id=None):
+        response = super()._list_sessions_impl(app_name=app_name, user_id=user_id)
+        for key in self._spilled:
+            if key[0] == app_name and user_id in (None, key[1]):
+                # Listed from disk, without making it resident
+                session = self._read_spilled(key)
+                session.events = []
+                response.sessions.append(self._merge_state(key[0], key[1], session))
+        return response
+
+    def _delete_session_impl(self, *, app_name, user_id, session_id) -> None:
+        key = (app_name, user_id, session_id)
+        if key in self._spilled:
+            os.remove(self._spilled.pop(key))
+            return
+        super()._delete_session_impl(
+            app_name=app_name, user_id=user_id, session_id=session_id
+        )
+        if key in self._resident:
+            self._resident_bytes -= self._resident.pop(key)
+
+    def memory_stats(self) -> dict[str, Any]:
+        return {
+            "resident_sessions": len(self._resident),
+            "spilled_sessions": len(self._spilled),
+            "resident_mb": self._resident_bytes / 1e6,
+            "evictions": self.evictions,
+            "reloads": len(self.reload_seconds),
+            "reload_p50_ms": (
+                percentile(self.reload_seconds, 50) * 1000
+                if self.reload_seconds
+                else 0.0
+            ),
+            "reload_p99_ms": (
+                percentile(self.reload_seconds, 99) * 1000
+                if self.reload_seconds
+                else 0.0
+            ),
+        }
+
+    def close(self) -> None:
+        """Remove the spilled sessions, and the spill directory if the service made
+        it."""
+        for path in self._spilled.values():
+            os.remove(path)
+        self._spilled.clear()
+        if self._owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+print("Bounded in-memory session service defined")
+
+# %%
+## Benchmark: Bounded In-Memory Sessions
+import random
+import time
+import tracemalloc
+
+
+async def benchmark_bounded_memory(
+    num_sessions=2_000, events_per_session=50, num_reads=5_000, max_memory_mb=16
+):
+    """Fill both services with the same sessions, then read with a skewed (hot/cold)
+    pattern."""
+    for label, service in [
+        ("unbounded", FastInMemorySessionService()),
+        (
+            f"{max_memory_mb} MB cap",
+            BoundedInMemorySessionService(max_memory_bytes=max_memory_mb * 1_000_000),
+        ),
+    ]:
+        tracemalloc.start()
+        rng = random.Random(0)
+        for s in range(num_sessions):
+            session = await service.create_session(
+                app_name="bench", user_id=f"user-{s % 100}", session_id=f"session-{s}"
+            )
+            for i in range(events_per_session):
+                await service.append_event(session, make_synthetic_event(i, rng))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for _ in range(num_reads):
+            # 80% of reads go to the 10% most recently created sessions
+            s = (
+                rng.randrange(num_sessions * 9 // 10, num_sessions)
+                if rng.random() < 0.8
+                else rng.randrange(num_sessions)
+            )
+            session = await service.get_session(
+                app_name="bench", user_id=f"user-{s % 100}", session_id=f"session-{s}"
+            )
+            assert len(session.events) == events_per_session
+        read_ms = (time.perf_counter() - start) / num_reads * 1000
+
+        print(
+            f"{label:>12}: peak heap {peak / 1e6:7.1f} MB, {read_ms:.3f} ms/get_session"
+        )
+        if isinstance(service, BoundedInMemorySessionService):
+            stats = service.memory_stats()
+            print(
+                f"{'':>14}{stats['resident_sessions']:,} resident "
+                f"({stats['resident_mb']:.1f} MB), "
+                f"{stats['spilled_sessions']:,} spilled, {stats['evictions']:,} "
+                f"evictions, {stats['reloads']:,} reloads "
+                f"(p50 {stats['reload_p50_ms']:.2f} ms, p99 "
+                f"{stats['reload_p99_ms']:.2f} ms)"
+            )
+            service.close()
+
+
+if RUN_BENCHMARKS:
+    await benchmark_bounded_memory()
+
+# %%
+## Bulk Export and Import
+# Streams a session database out to numbered JSONL or Parquet files - sessions, events
+# and app/user state - and back into any FastDatabaseSessionService. Rows are read with
+# server-side cursors and written in fixed-size chunks, so memory doesn't grow with the
+# database. Good for analytics, migrating between backends and seeding benchmarks.
+import glob
+import json
+import shutil
+
+from google.adk.events import EventActions
+
+# Column types for Parquet; JSON-valued columns (state, event) are stored as strings
+EXPORT_SCHEMAS = {
+    "sessions": {
+        "app_name": "string",
+        "user_id": "string",
+        "session_id": "string",
+        "state": "string",
+        "create_time": "float64",
+        "update_time": "float64",
+    },
+    "events": {
+        "app_name": "string",
+        "user_id": "string",
+        "session_id": "string",
+        "id": "string",
+        "invocation_id": "string",
+        "author": "string",
+        "timestamp": "float64",
+        "event": "string",
+    },
+    "app_states": {"app_name": "string", "state": "string"},
+    "user_states": {"app_name": "string", "user_id": "string", "state": "string"},
+}
+
+
+class ChunkedFileWriter:
+    """Writes rows to `{name}-00000.{jsonl|parquet}`, `{name}-00001...`, `chunk_rows`
+    rows per file.
+
+    Parquet rows are buffered `row_group_rows` at a time; JSONL rows go straight to the
+    file.
+    """
+
+    def __init__(
+        self,
+        out_dir: str,
+        name: str,
+        file_format: str = "jsonl",
+        chunk_rows: int = 1_000_000,
+        row_group_rows: int = 10_000,
+    ):
+        if file_format == "parquet":
+            import pyarrow as pa  # Only needed for Parquet
+
+            self._schema = pa.schema(
+                [(column, type_) for column, type_ in EXPORT_SCHEMAS[name].items()]
+            )
+        self.out_dir, self.name, self.file_format = out_dir, name, file_format
+        self.chunk_rows, self.row_group_rows = chunk_rows, row_group_rows
+        self.rows = 0
+        self._file = None
+        self._buffer: list[dict[str, Any]] = []
+
+    def write(self, row: dict[str, Any]) -> None:
+        if self.rows % self.chunk_rows == 0:
+            self._next_file()
+        self.rows += 1
+        if self.file_format == "jsonl":
+            self._file.write(json.dumps(row) + "\n")
+            return
+        self._buffer.append(row)
+        if len(self._buffer) >= self.row_group_rows:
+            self._write_row_group()
+
+    def _next_file(self) -> None:
+        self.close()
+        path = os.path.join(
+            self.out_dir,
+            f"{self.name}-{self.rows // self.chunk_rows:05d}.{self.file_format}",
+        )
+        if self.file_format == "jsonl":
+            self._file = open(path, "w")
+        else:
+            import pyarrow.parquet as pq
+
+            self._file = pq.ParquetWriter(path, self._schema, compression="zstd")
+
+    def _write_row_group(self) -> None:
+        import pyarrow as pa
+
+        self._file.write_table(pa.Table.from_pylist(self._buffer, schema=self._schema))
+        self._buffer = []
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self._buffer:
+            self._write_row_group()
+        self._file.close()
+        self._file = None
+
+
+def read_chunked_rows(
+    in_dir: str, name: str, batch_rows: int = 10_000
+) -> Iterator[dict[str, Any]]:
+    """Yield the rows of every `{name}-*` chunk file in order, a batch at a time for
+    Parquet."""
+    for path in sorted(glob.glob(os.path.join(in_dir, f"{name}-*.*"))):
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                for line in f:
+                    yield json.loads(line)
+        else:
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_rows):
+                yield from batch.to_pylist()
+
+
+def to_epoch(value: datetime) -> float:
+    """Session create/update times, which SQLite stores as naive UTC."""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def storage_row_to_event_dict(row) -> dict[str, Any]:
+    """The JSON form of a stored event (what Event.model_validate accepts), built from
+    the row's columns directly - decoding to an Event and back costs several times more.
+    """
+    event = {
+        "id": row.id,
+        "invocation_id": row.invocation_id,
+        "author": row.author,
+        "branch": row.branch,
+        "actions": row.actions.model_dump(mode="json", exclude_none=True),
+        # ADK stores event times as naive local time
+        "timestamp": row.timestamp.timestamp(),
+        "long_running_tool_ids": (
+            json.loads(row.long_running_tool_ids_json)
+            if row.long_running_tool_ids_json
+            else None
+        ),
+        "partial": row.partial,
+        "turn_complete": row.turn_complete,
+        "error_code": row.error_code,
+        "error_message": row.error_message,
+        "interrupted": row.interrupted,
+        "custom_metadata": row.custom_metadata,
+        # Stored as JSON already
+        "content": row.content,
+        "grounding_metadata": row.grounding_metadata,
+        "usage_metadata": row.usage_metadata,
+        "citation_metadata": row.citation_metadata,
+    }
+    return {name: value for name, value in event.items() if value is not None}
+
+
+def event_dict_to_storage_row(
+    key: tuple[str, str, str], event: dict[str, Any]
+) -> dict[str, Any]:
+    """The reverse: column values for the events table, for a bulk INSERT."""
+    return {
+        "app_name": key[0],
+        "user_id": key[1],
+        "session_id": key[2],
+        "id": event["id"],
+        "invocation_id": event["invocation_id"],
+        "author": event["author"],
+        "branch": event.get("branch"),
+        "actions": EventActions.model_validate(event.get("actions", {})),
+        # Naive local time, as ADK writes it
+        "timestamp": datetime.fromtimestamp(event["timestamp"]),
+        "long_running_tool_ids_json": (
+            json.dumps(event["long_running_tool_ids"])
+            if event.get("long_running_tool_ids")
+            else None
+        ),
+        **{
+            column: event.get(column)
+            for column in (
+                "partial",
+                "turn_complete",
+                "error_code",
+                "error_message",
+                "interrupted",
+                "custom_metadata",
+                "content",
+                "grounding_metadata",
+                "usage_metadata",
+                "citation_metadata",
+            )
+        },
+    }
+
+
+def export_sessions(
+    service: FastDatabaseSessionService,
+    out_dir: str,
+    *,
+    file_format: str = "jsonl",
+    chunk_rows: int = 1_000_000,
+) -> dict[str, int]:
+    """Stream every session, event (JSON and compact) and app/user state to files.
+
+    Returns the number of rows written per file kind.
+    """
+    service.flush()
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {
+        name: ChunkedFileWriter(out_dir, name, file_format, chunk_rows)
+        for name in EXPORT_SCHEMAS
+    }
+    sessions_table = StorageSession.__table__
+    # Only reads: on a tuned service, a write transaction would hold up every append
+    # and the write-behind flusher for the whole export
+    with service._reading(), service.db_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, yield_per=1_000)
+        for row in connection.execute(select(sessions_table)):
+            writers["sessions"].write(
+                {
+                    "app_name": row.app_name,
+                    "user_id": row.user_id,
+                    "session_id": row.id,
+                    "state": json.dumps(row.state),
+                    "create_time": to_epoch(row.create_time),
+                    "update_time": to_epoch(row.update_time),
+                }
+            )
+        for row in connection.execute(select(StorageAppState.__table__)):
+            writers["app_states"].write(
+                {"app_name": row.app_name, "state": json.dumps(row.state)}
+            )
+        for row in connection.execute(select(StorageUserState.__table__)):
+            writers["user_states"].write(
+                {
+                    "app_name": row.app_name,
+                    "user_id": row.user_id,
+                    "state": json.dumps(row.state),
+                }
+            )
+
+    def write_event(key: tuple[str, str, str], event: dict[str, Any]) -> None:
+        writers["events"].write(
+            {
+                "app_name": key[0],
+                "user_id": key[1],
+                "session_id": key[2],
+                "id": event["id"],
+                "invocation_id": event["invocation_id"],
+                "author": event["author"],
+                "timestamp": event["timestamp"],
+                "event": json.dumps(event),
+            }
+        )
+
+    codec = service.event_codec or CompactEventCodec()
+    with service._reading(), service.db_engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, yield_per=1_000)
+        events_table = StorageEvent.__table__
+        rows = connection.execute(
+            select(events_table).order_by(
+                events_table.c.app_name,
+                events_table.c.user_id,
+                events_table.c.session_id,
+                events_table.c.timestamp,
+            )
+        )
+        for row in rows:
+            write_event(
+                (row.app_name, row.user_id, row.session_id),
+                storage_row_to_event_dict(row),
+            )
+
+        rows = connection.execute(
+            select(compact_events_table).order_by(
+                compact_events_table.c.app_name,
+                compact_events_table.c.user_id,
+                compact_events_table.c.session_id,
+                compact_events_table.c.timestamp,
+            )
+        )
+        dictionary_key, dictionary = None, None
+        for row in rows:
+            key = (row.app_name, row.user_id, row.session_id)
+            # Rows come session by session; keep one dictionary at a time
+            if key != dictionary_key:
+                dictionary = connection.execute(
+                    select(event_dictionaries_table.c.dictionary).where(
+                        event_dictionaries_table.c.app_name == key[0],
+                        event_dictionaries_table.c.user_id == key[1],
+                        event_dictionaries_table.c.session_id == key[2],
+                    )
+                ).scalar()
+                dictionary_key = key
+            event = LazyEvent.from_row(row, codec, dictionary).materialize()
+            write_event(key, event.model_dump(mode="json", exclude_none=True))
+
+    for writer in writers.values():
+        writer.close()
+    return {name: writer.rows for name, writer in writers.items()}
+
+
+def import_sessions(
+    service: FastDatabaseSessionService, in_dir: str, *, batch_size: int = 5_000
+) -> dict[str, int]:
+    """Load an export_sessions() directory into `service`, in one transaction per batch.
+
+    Events are stored the service's way (JSON or compact). Sessions must not already
+    exist; app/user state is merged into any existing state. Running token counts aren't
+    rebuilt.
+    """
+    service.flush()
+    counts = dict.fromkeys(EXPORT_SCHEMAS, 0)
+
+    def batches(name: str) -> Iterator[list[dict[str, Any]]]:
+        batch = []
+        for row in read_chunked_rows(in_dir, name):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def to_datetime(epoch: float) -> datetime:
+        return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+    for batch in batches("sessions"):
+        with service.database_session_factory() as sql_session:
+            sql_session.execute(
+                insert(StorageSession.__table__),
+                [
+                    {
+                        "app_name": row["app_name"],
+                        "user_id": row["user_id"],
+                        "id": row["session_id"],
+                        "state": json.loads(row["state"]),
+                        "create_time": to_datetime(row["create_time"]),
+                        "update_time": to_datetime(row["update_time"]),
+                    }
+                    for row in batch
+                ],
+            )
+            sql_session.commit()
+        counts["sessions"] += len(batch)
+
+    for name, scope in (("app_states", "app"), ("user_states", "user")):
+        for batch in batches(name):
+            with service.database_session_factory() as sql_session:
+                for row in batch:
+                    scope_key = (
+                        ("app", row["app_name"])
+                        if scope == "app"
+                        else ("user", row["app_name"], row["user_id"])
+                    )
+                    service._apply_scoped_delta(
+                        sql_session, scope_key, json.loads(row["state"])
+                    )
+                service._write_dirty_state(sql_session)
+                sql_session.commit()
+            counts[name] += len(batch)
+
+    for batch in batches("events"):
+        events_by_session: dict[tuple[str, str, str], list[dict[str, Any]]] = {}
+        for row in batch:
+            key = (row["app_name"], row["user_id"], row["session_id"])
+            events_by_session.setdefault(key, []).append(json.loads(row["event"]))
+        with service.database_session_factory() as sql_session:
+            for key, events in events_by_session.items():
+                if service.event_codec:
+                    service._insert_events(
+                        sql_session,
+                        key,
+                        [Event.model_validate(event) for event in events],
+                    )
+                    continue
+                # JSON rows go in with one executemany, skipping Event and ORM objects
+                sql_session.execute(
+                    insert(StorageEvent.__table__),
+                    [event_dict_to_storage_row(key, event) for event in events],
+                )
+                compactions = [
+                    Event.model_validate(event)
+                    for event in events
+                    if "compaction" in event.get("actions", {})
+                ]
+                service._insert_checkpoints(sql_session, key, compactions)
+            sql_session.commit()
+        counts["events"] += len(batch)
+    return counts
+
+
+print("Bulk export/import defined")
+
+# %%
+## Benchmark: Bulk Export and Import
+import time
+import tracemalloc
+
+
+def peak_heap_mb(run) -> float:
+    """Peak Python heap while `run()` executes (timed separately - tracemalloc slows
+    it down)."""
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return peak
+
+
+async def check_round_trip_timestamps(tz: str = "America/Los_Angeles") -> None:
+    """Export and re-import a session under a non-UTC local zone; its event times
+    must not shift."""
+    previous_tz = os.environ.get("TZ")
+    os.environ["TZ"] = tz
+    time.tzset()
+    try:
+        remove_sqlite_files("bench_tz.db")
+        source = FastDatabaseSessionService(db_url="sqlite:///bench_tz.db")
+        session = await source.create_session(
+            app_name="bench", user_id="user", session_id="tz"
+        )
+        rng = random.Random(0)
+        for i in range(3):
+            await source.append_event(session, make_synthetic_event(i, rng))
+        expected = [event.timestamp for event in session.events]
+        shutil.rmtree("bench_tz_export", ignore_errors=True)
+        export_sessions(source, "bench_tz_export")
+        source.db_engine.dispose()
+        for label, codec in [("JSON", None), ("compact", CompactEventCodec())]:
+            remove_sqlite_files("bench_tz.db")
+            target = FastDatabaseSessionService(
+                db_url="sqlite:///bench_tz.db", event_codec=codec
+            )
+            import_sessions(target, "bench_tz_export")
+            loaded = await target.get_session(
+                app_name="bench", user_id="user", session_id="tz"
+            )
+            actual = [event.timestamp for event in loaded.events]
+            assert len(actual) == len(expected) and all(
+                abs(a - e) < 1e-3 for a, e in zip(actual, expected)
+            ), f"{label} import shifted event times under TZ={tz}"
+            target.db_engine.dispose()
+        print(f"Event timestamps survive export/import under TZ={tz}")
+    finally:
+        if previous_tz is None:
+            os.environ.pop("TZ")
+        else:
+            os.environ["TZ"] = previous_tz
+        time.tzset()
+        shutil.rmtree("bench_tz_export", ignore_errors=True)
+        remove_sqlite_files("bench_tz.db")
+
+
+def benchmark_bulk_export_import(
+    num_events: int = 200_000, chunk_rows: int = 50_000
+) -> None:
+    build_synthetic_event_db("bench_export.db", num_events)
+    source = FastDatabaseSessionService(db_url="sqlite:///bench_export.db")
+    print(f"{'':>28} {'events/sec':>11} {'peak heap (MB)':>15} {'files (MB)':>11}")
+    for file_format in ("jsonl", "parquet"):
+        out_dir = f"bench_export_{file_format}"
+
+        def export():
+            shutil.rmtree(out_dir, ignore_errors=True)
+            return export_sessions(
+                source, out_dir, file_format=file_format, chunk_rows=chunk_rows
+            )
+
+        start = time.perf_counter()
+        counts = export()
+        seconds = time.perf_counter() - start
+        peak = peak_heap_mb(export)
+        size = (
+            sum(os.path.getsize(path) for path in glob.glob(os.path.join(out_dir, "*")))
+            / 1e6
+        )
+        print(
+            f"{'export ' + file_format:>28} {counts['events'] / seconds:>11,.0f} "
+            f"{peak:>15.1f} {size:>11.1f}"
+        )
+
+        for label, codec in [("JSON", None), ("compact", CompactEventCodec())]:
+
+            def import_():
+                remove_sqlite_files("bench_import.db")
+                target = FastDatabaseSessionService(
+                    db_url="sqlite:///bench_import.db",
+                    tune_sqlite=True,
+                    event_codec=codec,
+                )
+                imported = import_sessions(target, out_dir)
+                target.close()
+                target.db_engine.dispose()
+                return imported
+
+            start = time.perf_counter()
+            imported = import_()
+            seconds = time.perf_counter() - start
+            assert (
+                imported["events"] == counts["events"]
+                and imported["sessions"] == counts["sessions"]
+            )
+            peak = peak_heap_mb(import_)
+            print(
+                f"{'import ' + file_format + ' -> ' + label:>28} "
+                f"{imported['events'] / seconds:>11,.0f} {peak:>15.1f}"
+            )
+        shutil.rmtree(out_dir)
+
+    source.db_engine.dispose()
+    remove_sqlite_files("bench_export.db")
+    remove_sqlite_files("bench_import.db")
+
+
+if RUN_BENCHMARKS:
+    await check_round_trip_timestamps()
+    benchmark_bulk_export_import()
+
+# %%
+## Session Service Benchmark Suite
+# Runs the same workload against every session backend and writes a JSON report, so the
+# choice between them (and regressions between versions) comes down to numbers:
+#   - create_session with small and large initial state
+#   - append_event (plain messages) and state updates (events carrying a state_delta)
+#   - get_session on sessions of 10 to 100k events
+#   - list_sessions over a user's sessions
+# Writes run at several concurrency levels, one thread per concurrent caller. Backends
+# that aren't thread-safe (the in-memory ones) only run with one caller.
+import json
+import platform
+import tempfile
+import threading
+import time
+from importlib.metadata import version
+
+from google.adk.events import EventActions
+
+
+class BackendSpec(NamedTuple):
+    name: str
+    make_service: Any  # (work_dir) -> session service
+    thread_safe: bool
+
+
+BENCHMARK_BACKENDS = [
+    BackendSpec(
+        "InMemory", lambda work_dir: InMemorySessionService(), thread_safe=False
+    ),
+    BackendSpec(
+        "BoundedInMemory(64MB)",
+        lambda work_dir: BoundedInMemorySessionService(
+            max_memory_bytes=64_000_000, spill_dir=os.path.join(work_dir, "spill")
+        ),
+        thread_safe=False,
+    ),
+    BackendSpec(
+        "Database",
+        lambda work_dir: DatabaseSessionService(
+            db_url=f"sqlite:///{work_dir}/sessions.db"
+        ),
+        thread_safe=True,
+    ),
+    BackendSpec(
+        "FastDatabase(tuned,write-behind)",
+        lambda work_dir: FastDatabaseSessionService(
+            db_url=f"sqlite:///{work_dir}/sessions.db",
+            tune_sqlite=True,
+            write_behind=True,
+        ),
+        thread_safe=True,
+    ),
+    BackendSpec(
+        "Sharded(4,tuned,write-behind)",
+        lambda work_dir: ShardedSessionService(
+            [f"sqlite:///{work_dir}/shard_{shard}.db" for shard in range(4)],
+            tune_sqlite=True,
+            write_behind=True,
+        ),
+        thread_safe=True,
+    ),
+]
+
+# Initial session state: one key, or ~32 KB spread over 64 keys
+STATE_SIZES = {
+    "small": {"user:name": "Sam"},
+    "large": {f"key_{k}": "x" * 500 for k in range(64)},
+}
+
+
+async def seed_session(
+    service,
+    key: tuple[str, str, str],
+    num_events: int,
+    work_dir: str,
+    seed: int = 0,
+) -> None:
+    """Give a session `num_events` synthetic events, by bulk import where the backend
+    allows. The events are generated from `seed`."""
+    rng = random.Random(seed)
+    if isinstance(service, ShardedSessionService):
+        service = service.shard_for(key[0], key[1])
+    if not isinstance(service, DatabaseSessionService):
+        session = await service.create_session(
+            app_name=key[0], user_id=key[1], session_id=key[2]
+        )
+        for i in range(num_events):
+            await service.append_event(session, make_synthetic_event(i, rng))
+        return
+
+    export_dir = tempfile.mkdtemp(dir=work_dir)
+    sessions = ChunkedFileWriter(export_dir, "sessions")
+    sessions.write(
+        {
+            "app_name": key[0],
+            "user_id": key[1],
+            "session_id": key[2],
+            "state": "{}",
+            "create_time": time.time(),
+            "update_time": time.time(),
+        }
+    )
+    sessions.close()
+    events = ChunkedFileWriter(export_dir, "events")
+    start = time.time() - num_events
+    for i in range(num_events):
+        event = make_synthetic_event(i, rng)
+        event.timestamp = start + i
+        event_dict = event.model_dump(mode="json", exclude_none=True)
+        events.write(
+            {
+                "app_name": key[0],
+                "user_id": key[1],
+                "session_id": key[2],
+                "id": event.id,
+                "invocation_id": event.invocation_id,
+                "author": event.author,
+                "timestamp": event.timestamp,
+                "event": json.dumps(event_dict),
+            }
+        )
+    events.close()
+    # Plain DatabaseSessionServices are loaded through a FastDatabaseSessionService on
+    # the same database
+    loader = (
+        service
+        if isinstance(service, FastDatabaseSessionService)
+        else FastDatabaseSessionService(
+            db_url=service.db_engine.url.render_as_string(hide_password=False)
+        )
+    )
+    import_sessions(loader, export_dir)
+    shutil.rmtree(export_dir)
+
+
+def run_concurrently(
+    service, concurrency: int, num_ops: int, operation
+) -> dict[str, float]:
+    """Split `num_ops` calls of `await operation(service, caller, i)` over
+    `concurrency` threads, each running its own event loop.
+
+    Returns throughput and latency percentiles of the calls that succeeded, and how many
+    failed. Write-behind buffers are flushed inside the timed window.
+    """
+    latencies: list[float] = []
+    errors = []
+    lock = threading.Lock()
+
+    def caller(caller_index: int) -> None:
+        async def run():
+            own, failed = [], []
+            for i in range(caller_index, num_ops, concurrency):
+                start = time.perf_counter()
+                try:
+                    await operation(service, caller_index, i)
+                except (
+                    Exception
+                ) as error:  # Counted, so one backend's failures don't stop the suite
+                    failed.append(error)
+                    continue
+                own.append(time.perf_counter() - start)
+            return own, failed
+
+        own, failed = asyncio.run(run())
+        with lock:
+            latencies.extend(own)
+            errors.extend(failed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(c,)) for c in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if hasattr(service, "flush"):
+        service.flush()
+    seconds = time.perf_counter() - start
+    return {
+        "ops": num_ops,
+        "errors": len(errors),
+        "seconds": seconds,
+        "ops_per_sec": len(latencies) / seconds,
+        "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+async def benchmark_backend(
+    spec: BackendSpec,
+    *,
+    session_sizes=(10, 1_000, 100_000),
+    concurrency_levels=(1, 8),
+    num_writes: int = 1_000,
+    num_reads: int = 20,
+    sessions_per_user: int = 100,
+    seed: int = 0,
+) -> list[dict[str, Any]]:
+    results = []
+
+    def record(operation: str, measured: dict[str, float], **params) -> None:
+        results.append(
+            {"backend": spec.name, "operation": operation, **params, **measured}
+        )
+        latency = (
+            f"p50 {measured['p50_ms']:7.2f} ms  p99 {measured['p99_ms']:8.2f} ms"
+            if measured["p50_ms"] is not None
+            else ""
+        )
+        errors = f"  {measured['errors']} errors" if measured["errors"] else ""
+        print(
+            f"{spec.name:>32} {operation:>14} {json.dumps(params):<40} "
+            f"{measured['ops_per_sec']:>9,.0f} ops/s  {latency}{errors}"
+        )
+
+    levels = concurrency_levels if spec.thread_safe else (1,)
+    for concurrency in levels:
+        for state_size, state in STATE_SIZES.items():
+            with tempfile.TemporaryDirectory() as work_dir:
+                service = spec.make_service(work_dir)
+
+                async def create(service, caller, i, state=state):
+                    await service.create_session(
+                        app_name="bench",
+                        user_id=f"user-{i % 50}",
+                        state=state,
+                        session_id=f"s-{i}",
+                    )
+
+                measured = run_concurrently(
+                    service, concurrency, num_writes // 5, create
+                )
+                record(
+                    "create_session",
+                    measured,
+                    state=state_size,
+                    concurrency=concurrency,
+                )
+                if hasattr(service, "close"):
+                    service.close()
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            service = spec.make_service(work_dir)
+            sessions = [
+                await service.create_session(
+                    app_name="bench", user_id=f"user-{c}", session_id=f"writer-{c}"
+                )
+                for c in range(concurrency)
+            ]
+
+            # One generator per caller thread, each of which appends a fixed run of i
+            rngs = [random.Random(seed + c) for c in range(concurrency)]
+
+            async def append(service, caller, i):
+                await service.append_event(
+                    sessions[caller], make_synthetic_event(i, rngs[caller])
+                )
+
+            async def update_state(service, caller, i):
+                delta = {"turns": i, "user:last_seen": i, "temp:scratch": "x" * 100}
+                await service.append_event(
+                    sessions[caller],
+                    Event(
+                        invocation_id=f"inv-{i}",
+                        author="user",
+                        actions=EventActions(state_delta=delta),
+                    ),
+                )
+
+            record(
+                "append_event",
+                run_concurrently(service, concurrency, num_writes, append),
+                concurrency=concurrency,
+            )
+            record(
+                "update_state",
+                run_concurrently(service, concurrency, num_writes, update_state),
+                concurrency=concurrency,
+            )
+            if hasattr(service, "close"):
+                service.close()
+
+    for num_events in session_sizes:
+        with tempfile.TemporaryDirectory() as work_dir:
+            service = spec.make_service(work_dir)
+            await seed_session(
+                service, ("bench", "reader", "big"), num_events, work_dir, seed
+            )
+
+            async def get(service, caller, i):
+                session = await service.get_session(
+                    app_name="bench", user_id="reader", session_id="big"
+                )
+                assert len(session.events) == num_events
+
+            # Fewer reads of the biggest sessions
+            reads = max(3, min(num_reads, 100_000 // num_events))
+            record(
+                "get_session",
+                run_concurrently(service, 1, reads, get),
+                session_events=num_events,
+            )
+            if hasattr(service, "close"):
+                service.close()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        service = spec.make_service(work_dir)
+        for s in range(sessions_per_user):
+            await service.create_session(
+                app_name="bench", user_id="lister", session_id=f"s-{s}"
+            )
+
+        async def list_(service, caller, i):
+            assert (
+                len(
+                    (
+                        await service.list_sessions(app_name="bench", user_id="lister")
+                    ).sessions
+                )
+                == sessions_per_user
+            )
+
+        record(
+            "list_sessions",
+            run_concurrently(service, 1, num_reads, list_),
+            sessions=sessions_per_user,
+        )
+        if hasattr(service, "close"):
+            service.close()
+    return results
+
+
+async def run_session_benchmark_suite(
+    report_path: str = "session_benchmark_report.json",
+    backends=None,
+    seed: int = 0,
+    **options,
+) -> dict:
+    """Benchmark every backend and write a machine-readable report to `report_path`.
+
+    The synthetic events come from `seed`, so two runs with the same seed store the
+    same events."""
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "google-adk": version("google-adk"),
+            "sqlalchemy": version("sqlalchemy"),
+        },
+        "options": {"seed": seed, **options},
+        "results": [],
+    }
+    for spec in backends or BENCHMARK_BACKENDS:
+        report["results"] += await benchmark_backend(spec, seed=seed, **options)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {report_path}")
+    return report
+
+
+def compare_benchmark_reports(
+    baseline_path: str, current_path: str, tolerance: float = 0.2
+) -> list[dict]:
+    """Print and return the results whose throughput dropped by more than
+    `tolerance`."""
+
+    def by_key(path):
+        with open(path) as f:
+            results = json.load(f)["results"]
+        metrics = ("ops", "errors", "seconds", "ops_per_sec", "p50_ms", "p99_ms")
+        return {
+            tuple(sorted((k, v) for k, v in result.items() if k not in metrics)): result
+            for result in results
+        }
+
+    baseline, current = by_key(baseline_path), by_key(current_path)
+    regressions = []
+    for key, result in current.items():
+        before = baseline.get(key)
+        if before and result["ops_per_sec"] < before["ops_per_sec"] * (1 - tolerance):
+            change = result["ops_per_sec"] / before["ops_per_sec"] - 1
+            regressions.append(
+                {
+                    **dict(key),
+                    "baseline_ops_per_sec": before["ops_per_sec"],
+                    "ops_per_sec": result["ops_per_sec"],
+                    "change": change,
+                }
+            )
+            print(
+                f"REGRESSION {dict(key)}: {before['ops_per_sec']:,.0f} -> "
+                f"{result['ops_per_sec']:,.0f} ops/s ({change:+.0%})"
+            )
+    if not regressions:
+        print(f"No throughput regressions beyond {tolerance:.0%}")
+    return regressions
+
+
+print("Session benchmark suite defined")
+
+# %%
+if RUN_BENCHMARKS:
+    await run_session_benchmark_suite()
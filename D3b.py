@@ -11,6 +11,10 @@ from Implementation.D3a import retry_config, session_service
 load_dotenv()
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
+# The benchmark cells take minutes and write large scratch databases; set
+# RUN_BENCHMARKS=1 to run them
+RUN_BENCHMARKS = os.getenv("RUN_BENCHMARKS") == "1"
+
 print("Gemini API key setup complete.")
 
 # %%
@@ -32,15 +36,10 @@ async def run_session(
     """Helper funciton to run queries in a session and display responses."""
     print(f"\n### Session: {session_id}")
 
-    # Create or retrieve session
-    try:
-        session = await session_service.create_session(
-            app_name=APP_NAME, user_id=USER_ID, session_id=session_id
-        )
-    except:
-        session = await session_service.get_session(
-            app_name=APP_NAME, user_id=USER_ID, session_id=session_id
-        )
+    # Retrieve the session, or create it on the first turn (one round trip)
+    session = await session_service.get_or_create_session(
+        app_name=APP_NAME, user_id=USER_ID, session_id=session_id
+    )
 
     # Convert single query to list
     if isinstance(user_queries, str):
@@ -71,6 +70,15 @@ retry_config = types.HttpRetryOptions(
     http_status_codes=[429, 500, 503, 504],  # Retry on these HTTP errors
 )
 
+# %%
+from google.adk.sessions import Session
+
+# Same single-probe get_or_create_session as in the sessions notebook, which keeps its
+# session services in session_storage.py
+from session_storage import FastInMemorySessionService
+
+print("Session service defined.")
+
 # %%
 ## Initialize MemoryService
 memory_service = (
@@ -92,7 +100,7 @@ print("Agent created")
 
 # %%
 # Create Session Service
-session_service = InMemorySessionService()  # Handles conversations
+session_service = FastInMemorySessionService()  # Handles conversations
 
 # Create runner with BOTH services
 runner = Runner(
@@ -196,6 +204,1078 @@ for memory in search_response.memories:
         print(f"  [{memory.author}]: {text}...")
 
 
+# %%
+## Ranked Memory Search with BM25
+# InMemoryMemoryService re-tokenizes every stored event of the user on each search and
+# returns every event sharing any word with the query, so latency grows with the size
+# of the memory and "What is the user's favorite color?" matches almost everything
+# through "what", "is" and "the". BM25MemoryService keeps an inverted index per user,
+# updated as sessions are added, scores only the memories containing a query term and
+# returns the top_k best.
+import math
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+from google.adk.events import Event
+from google.adk.memory import BaseMemoryService
+from google.adk.memory.base_memory_service import SearchMemoryResponse
+from google.adk.memory.memory_entry import MemoryEntry
+
+STOPWORDS = frozenset(
+    "a about an and any are as at be been but by can could did do does for from had has"
+    " have he her him his how i if in into is it its me my no not of on or our she so"
+    " than that the their them then there they this to too us was we were what when"
+    " where which who why will with would you your".split()
+)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase words and numbers, without stopwords and single characters."""
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+def new_memory_events(partition, session: Session) -> list[tuple[Event, str]]:
+    """Text events of `session` not yet in `partition`, advancing its watermark.
+
+    Sessions only grow, so each call reads just the events appended since the last
+    one. If the session no longer matches its watermark (it was rebuilt or rewound),
+    all its events are read again and the stored event ids keep them from being
+    ingested twice. Callers hold the partition lock.
+    """
+    events = session.events
+    start, last_id = partition.watermarks.get(session.id, (0, None))
+    if start > len(events) or (start and events[start - 1].id != last_id):
+        start = 0
+    new = []
+    for event in events[start:]:
+        if event.id in partition.event_ids or not (
+            event.content and event.content.parts
+        ):
+            continue
+        text = " ".join(part.text for part in event.content.parts if part.text)
+        if text:
+            new.append((event, text))
+    if events:
+        partition.watermarks[session.id] = (len(events), events[-1].id)
+    return new
+
+
+class MemoryPartition:
+    """Inverted index over the memories of one user.
+
+    Postings are compact arrays of memory ids and term frequencies, appended to as
+    memories arrive. Callers hold `lock` around every method.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings: dict[str, tuple[array, array]] = {}  # term -> (ids, frequencies)
+        self.lengths = array("I")
+        self.total_length = 0
+        self.texts: list[str] = []
+        self.roles: list[str | None] = []
+        self.authors: list[str | None] = []
+        self.timestamps = array("d")
+        self.retired = bytearray()  # 1 for memories merged away by consolidation
+        self.retired_count = 0
+        self.mentions = array("I")  # Memories each one stands for, itself included
+        self.event_ids: set[str] = set()
+        # Session id -> (event count, last event id) at the last ingestion
+        self.watermarks: dict[str, tuple[int, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, text: str, role: str | None, author: str | None, timestamp: float):
+        terms = Counter(tokenize(text))
+        memory_id = len(self.texts)
+        for term, count in terms.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array("I"), array("I"))
+            postings[0].append(memory_id)
+            postings[1].append(count)
+        length = sum(terms.values())
+        self.lengths.append(length)
+        self.total_length += length
+        self.texts.append(text)
+        self.roles.append(role)
+        self.authors.append(author)
+        self.timestamps.append(timestamp)
+        self.retired.append(0)
+        self.mentions.append(1)
+
+    def retire(self, memory_id: int) -> None:
+        """Exclude a memory from searches until compaction drops it from the index."""
+        if not self.retired[memory_id]:
+            self.retired[memory_id] = 1
+            self.retired_count += 1
+
+    def merge(self, memory_id: int, into: int) -> None:
+        """Retire a memory repeated by `into`, which takes over its mentions."""
+        self.mentions[into] += self.mentions[memory_id]
+        self.retire(memory_id)
+
+    def compacted(self, upto: int) -> tuple["MemoryPartition", dict[int, int]]:
+        """A new index of the first `upto` memories minus the retired ones.
+
+        Also returns old id -> new id. Only reads, so it can run without the lock
+        while new memories arrive; adopt() then switches over to it.
+        """
+        fresh = MemoryPartition()
+        remap = {}
+        for i in range(upto):
+            if not self.retired[i]:
+                remap[i] = len(fresh)
+                fresh.add(
+                    self.texts[i], self.roles[i], self.authors[i], self.timestamps[i]
+                )
+                fresh.mentions[-1] = self.mentions[i]
+        return fresh, remap
+
+    def adopt(self, fresh: "MemoryPartition", remap: dict[int, int], upto: int):
+        """Switch to a compacted index, carrying over memories added after `upto`."""
+        for i in range(upto, len(self.texts)):
+            remap[i] = len(fresh)
+            fresh.add(self.texts[i], self.roles[i], self.authors[i], self.timestamps[i])
+            fresh.mentions[-1] = self.mentions[i]
+            if self.retired[i]:
+                fresh.retire(remap[i])
+        index_fields = "postings lengths total_length texts roles authors timestamps"
+        for name in (index_fields + " retired retired_count mentions").split():
+            setattr(self, name, getattr(fresh, name))
+
+    def top_k(
+        self,
+        terms: list[str],
+        k: int,
+        k1: float,
+        b: float,
+        collection: tuple[int, float, dict[str, int]] | None = None,
+    ) -> list[tuple[int, float]]:
+        """(memory id, BM25 score) of the k best matches for `terms`, best first.
+
+        `collection` is (memory count, average length, term -> memories containing
+        it) to score with instead of this partition's own, when it is one segment of
+        a larger index.
+        """
+        terms = [term for term in set(terms) if term in self.postings]
+        if not terms:
+            return []
+        count, average_length, documents = collection or (
+            len(self.texts),
+            self.total_length / len(self.texts),
+            {term: len(self.postings[term][0]) for term in terms},
+        )
+        lengths = np.frombuffer(self.lengths, dtype=np.uintc)
+        ids, scores = [], []
+        for term in terms:
+            term_ids, frequencies = self.postings[term]
+            term_ids = np.frombuffer(term_ids, dtype=np.uintc)
+            tf = np.frombuffer(frequencies, dtype=np.uintc).astype(np.float64)
+            idf = math.log(
+                1 + (count - documents[term] + 0.5) / (documents[term] + 0.5)
+            )
+            norm = k1 * (1 - b + b * lengths[term_ids] / average_length)
+            ids.append(term_ids)
+            scores.append(idf * tf * (k1 + 1) / (tf + norm))
+
+        # Sum the per-term scores of each memory, then keep the k highest
+        if len(ids) == 1:
+            candidates, totals = ids[0].copy(), scores[0]
+        else:
+            totals = np.bincount(np.concatenate(ids), weights=np.concatenate(scores))
+            candidates = np.flatnonzero(totals)
+            totals = totals[candidates]
+        if self.retired_count:
+            alive = np.frombuffer(self.retired, dtype=np.uint8)[candidates] == 0
+            candidates, totals = candidates[alive], totals[alive]
+        if len(candidates) > k:
+            best = np.argpartition(totals, -k)[-k:]
+            candidates, totals = candidates[best], totals[best]
+        order = np.argsort(-totals, kind="stable")
+        return list(zip(candidates[order].tolist(), totals[order].tolist()))
+
+    def index_bytes(self) -> int:
+        """Size of the postings and per-memory arrays."""
+        arrays = [self.lengths, self.timestamps]
+        arrays += [a for postings in self.postings.values() for a in postings]
+        return sum(a.buffer_info()[1] * a.itemsize for a in arrays)
+
+
+class BM25MemoryService(BaseMemoryService):
+    """Memory service with per-user inverted indexes and BM25 top-k search.
+
+    Adding a session indexes only the events appended since it was last added, so it
+    can be called after every turn. Each user's partition has its own lock; searches of
+    different users never wait on each other.
+    """
+
+    def __init__(self, *, top_k: int = 5, k1: float = 1.2, b: float = 0.75):
+        self.top_k = top_k
+        self.k1 = k1
+        self.b = b
+        self._partitions: dict[str, MemoryPartition] = {}
+        self._lock = threading.Lock()
+
+    def _partition(
+        self, app_name: str, user_id: str, create: bool = False
+    ) -> MemoryPartition | None:
+        key = f"{app_name}/{user_id}"
+        partition = self._partitions.get(key)
+        if partition is None and create:
+            with self._lock:
+                partition = self._partitions.setdefault(key, MemoryPartition())
+        return partition
+
+    async def add_session_to_memory(self, session: Session):
+        partition = self._partition(session.app_name, session.user_id, create=True)
+        with partition.lock:
+            for event, text in new_memory_events(partition, session):
+                partition.event_ids.add(event.id)
+                partition.add(text, event.content.role, event.author, event.timestamp)
+
+    def add_texts(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        texts,
+        author: str = "user",
+        timestamp: float | None = None,
+    ) -> None:
+        """Index plain texts as memories of one user (bulk loading and benchmarks)."""
+        partition = self._partition(app_name, user_id, create=True)
+        timestamp = time.time() if timestamp is None else timestamp
+        with partition.lock:
+            for text in texts:
+                partition.add(text, "user", author, timestamp)
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        response = SearchMemoryResponse()
+        partition = self._partition(app_name, user_id)
+        if partition is None:
+            return response
+        terms = tokenize(query)
+        with partition.lock:
+            hits = partition.top_k(terms, self.top_k, self.k1, self.b)
+            found = [
+                (
+                    partition.texts[i],
+                    partition.roles[i],
+                    partition.authors[i],
+                    partition.timestamps[i],
+                )
+                for i, _ in hits
+            ]
+        for text, role, author, timestamp in found:
+            response.memories.append(
+                MemoryEntry(
+                    content=types.Content(role=role, parts=[types.Part(text=text)]),
+                    author=author,
+                    timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+                )
+            )
+        return response
+
+
+print("BM25 memory service defined.")
+
+# %%
+# Same sessions, same question: ranked top hits instead of every keyword overlap
+bm25_memory_service = BM25MemoryService(top_k=3)
+await bm25_memory_service.add_session_to_memory(session)
+await bm25_memory_service.add_session_to_memory(birthday_session)
+
+search_response = await bm25_memory_service.search_memory(
+    app_name=APP_NAME, user_id=USER_ID, query="What is the user's favorite color?"
+)
+print(f"BM25 found {len(search_response.memories)} memories:")
+for memory in search_response.memories:
+    print(f"  [{memory.author}]: {memory.content.parts[0].text[:80]}...")
+
+# %%
+## Benchmark: Memory Search at Scale
+# Indexes up to 1M synthetic memories (Zipf-distributed words, like real text) for one
+# user and times searches of 2-3 words drawn from stored memories. The keyword scan of
+# InMemoryMemoryService is measured up to 100k memories; it grows linearly from there.
+
+
+def synthetic_memories(count: int, seed: int = 0, vocabulary_size: int = 50_000):
+    """Yield `count` texts of 5-30 words made of random letters."""
+    rng = np.random.default_rng(seed)
+    letters = rng.integers(
+        ord("a"), ord("z") + 1, (vocabulary_size, 10), dtype=np.uint8
+    )
+    word_lengths = rng.integers(3, 11, vocabulary_size)
+    vocabulary = [
+        bytes(row[:length]).decode() for row, length in zip(letters, word_lengths)
+    ]
+    for start in range(0, count, 100_000):
+        lengths = rng.integers(5, 31, min(100_000, count - start))
+        word_ids = ((rng.zipf(1.2, lengths.sum()) - 1) % vocabulary_size).tolist()
+        offset = 0
+        for length in lengths.tolist():
+            yield " ".join([vocabulary[i] for i in word_ids[offset : offset + length]])
+            offset += length
+
+
+def sample_queries(count: int, memory_count: int, seed: int = 1) -> list[str]:
+    """Queries of 2-3 words taken from random stored memories."""
+    rng = np.random.default_rng(seed)
+    picks = set(rng.choice(memory_count, count, replace=False).tolist())
+    queries = []
+    for i, text in enumerate(synthetic_memories(max(picks) + 1)):
+        if i in picks:
+            words = text.split()
+            queries.append(
+                " ".join(rng.choice(words, min(len(words), 3), replace=False))
+            )
+    return queries
+
+
+async def time_searches(service, queries: list[str]) -> tuple[list[float], float]:
+    """Per-query latencies in seconds, and the mean number of memories returned."""
+    latencies, returned = [], 0
+    for query in queries:
+        start = time.perf_counter()
+        response = await service.search_memory(
+            app_name="bench", user_id="user", query=query
+        )
+        latencies.append(time.perf_counter() - start)
+        returned += len(response.memories)
+    return latencies, returned / len(queries)
+
+
+async def benchmark_memory_search(
+    sizes=(10_000, 100_000, 1_000_000), scan_limit: int = 100_000, num_queries=200
+):
+    print(
+        f"{'memories':>10} {'service':>10} {'index/s':>10} {'index MB':>9}"
+        f" {'p50 ms':>9} {'p99 ms':>9} {'results':>8}"
+    )
+    for size in sizes:
+        queries = sample_queries(num_queries, size)
+
+        service = BM25MemoryService(top_k=10)
+        start = time.perf_counter()
+        service.add_texts(
+            app_name="bench", user_id="user", texts=synthetic_memories(size)
+        )
+        rate = size / (time.perf_counter() - start)
+        latencies, returned = await time_searches(service, queries)
+        index_mb = service._partition("bench", "user").index_bytes() / 1e6
+        print(
+            f"{size:>10,} {'BM25':>10} {rate:>10,.0f} {index_mb:>9.1f}"
+            f" {np.percentile(latencies, 50) * 1000:>9.2f}"
+            f" {np.percentile(latencies, 99) * 1000:>9.2f} {returned:>8.1f}"
+        )
+        del service
+
+        if size > scan_limit:
+            continue
+        scan_service = InMemoryMemoryService()
+        texts = synthetic_memories(size)
+        for s in range(0, size, 1_000):
+            events = [
+                Event(
+                    author="user",
+                    content=types.Content(role="user", parts=[types.Part(text=text)]),
+                )
+                for _, text in zip(range(1_000), texts)
+            ]
+            await scan_service.add_session_to_memory(
+                Session(id=f"s-{s}", app_name="bench", user_id="user", events=events)
+            )
+        latencies, returned = await time_searches(scan_service, queries[:20])
+        print(
+            f"{size:>10,} {'scan':>10} {'':>10} {'':>9}"
+            f" {np.percentile(latencies, 50) * 1000:>9.2f}"
+            f" {np.percentile(latencies, 99) * 1000:>9.2f} {returned:>8.1f}"
+        )
+        del scan_service
+
+
+if RUN_BENCHMARKS:
+    await benchmark_memory_search()
+
+
+# %%
+## Semantic Memory with Local Embeddings
+# Keyword search only finds "My birthday is on March 15th." when the query repeats its
+# words. VectorMemoryService embeds memories offline by hashing words and character
+# trigrams into a fixed-size vector, so "colour" still finds "color" and "birthdays"
+# finds "birthday", and ranks memories by cosine similarity. Small stores are searched
+# exactly with one matrix product; past `exact_limit` memories an HNSW graph (hnswlib)
+# answers approximately. With a `directory`, each user's vectors live in a
+# memory-mapped .npy file and survive restarts.
+import json
+import zlib
+
+EMBEDDING_DIM = 256
+
+
+def embed_texts(texts: list[str], dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """Unit-length hashed embeddings of words and their character trigrams."""
+    rows, columns, signs = [], [], []
+    for row, text in enumerate(texts):
+        for token in tokenize(text):
+            padded = f"#{token}#"
+            features = [token] + [padded[i : i + 3] for i in range(len(padded) - 2)]
+            for feature in features:
+                h = zlib.crc32(feature.encode())
+                rows.append(row)
+                columns.append(h % dim)
+                signs.append(1.0 if h & 0x80000000 else -1.0)
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    np.add.at(vectors, (rows, columns), signs)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorPartition:
+    """Embeddings and records of one user's memories. Callers hold `lock`."""
+
+    def __init__(self, dim: int, directory: str | None = None):
+        self.lock = threading.Lock()
+        self.dim = dim
+        self.directory = directory
+        self.records: list[tuple[str, str | None, str | None, float]] = []
+        self.event_ids: set[str] = set()
+        # Session id -> (event count, last event id) at the last ingestion
+        self.watermarks: dict[str, tuple[int, str]] = {}
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)
+        self.hnsw = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path("records.jsonl")):
+            self.vectors = np.lib.format.open_memmap(
+                self._path("vectors.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(1024, self.dim),
+            )
+            return
+        with open(self._path("records.jsonl")) as f:
+            for line in f:
+                event_id, *record = json.loads(line)
+                self.records.append(tuple(record))
+                if event_id:
+                    self.event_ids.add(event_id)
+        self.vectors = np.load(self._path("vectors.npy"), mmap_mode="r+")
+
+    def _grow(self, needed: int) -> None:
+        capacity = len(self.vectors)
+        while capacity < needed:
+            capacity *= 2
+        if capacity == len(self.vectors):
+            return
+        if self.directory:
+            self.vectors.flush()
+            grown = np.lib.format.open_memmap(
+                self._path("vectors.tmp.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(capacity, self.dim),
+            )
+            grown[: len(self)] = self.vectors[: len(self)]
+            grown.flush()
+            del self.vectors, grown
+            os.replace(self._path("vectors.tmp.npy"), self._path("vectors.npy"))
+            self.vectors = np.load(self._path("vectors.npy"), mmap_mode="r+")
+        else:
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[: len(self)] = self.vectors[: len(self)]
+            self.vectors = grown
+        if self.hnsw is not None:
+            self.hnsw.resize_index(capacity)
+
+    def add(
+        self, vectors: np.ndarray, records: list[tuple], event_ids: list[str | None]
+    ):
+        start = len(self)
+        self._grow(start + len(records))
+        self.vectors[start : start + len(records)] = vectors
+        self.records += records
+        self.event_ids.update(event_id for event_id in event_ids if event_id)
+        if self.hnsw is not None:
+            self.hnsw.add_items(vectors, np.arange(start, start + len(records)))
+        if self.directory:
+            self.vectors.flush()
+            with open(self._path("records.jsonl"), "a") as f:
+                for event_id, record in zip(event_ids, records):
+                    f.write(json.dumps([event_id, *record]) + "\n")
+
+    def build_hnsw(self, m: int = 16, ef_construction: int = 200) -> None:
+        """Index every stored vector in an HNSW graph, or reload a saved one."""
+        import hnswlib  # Only needed for the approximate mode
+
+        self.hnsw = hnswlib.Index(space="ip", dim=self.dim)
+        saved = self.directory and os.path.exists(self._path("hnsw.bin"))
+        if saved:
+            self.hnsw.load_index(self._path("hnsw.bin"), max_elements=len(self.vectors))
+        else:
+            self.hnsw.init_index(
+                len(self.vectors), ef_construction=ef_construction, M=m
+            )
+        indexed = self.hnsw.get_current_count()
+        if indexed < len(self):  # Memories added after the graph was last saved
+            self.hnsw.add_items(
+                self.vectors[indexed : len(self)], np.arange(indexed, len(self))
+            )
+
+    def save(self) -> None:
+        if self.directory and self.hnsw is not None:
+            self.hnsw.save_index(self._path("hnsw.bin"))
+
+    def search_exact(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        scores = self.vectors[: len(self)] @ query
+        if len(scores) > k:
+            best = np.argpartition(scores, -k)[-k:]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return best, scores[best]
+
+    def search_hnsw(
+        self, query: np.ndarray, k: int, ef: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        self.hnsw.set_ef(max(ef, k))
+        labels, distances = self.hnsw.knn_query(query, k=min(k, len(self)))
+        return labels[0], 1 - distances[0]
+
+
+class VectorMemoryService(BaseMemoryService):
+    """Memory service with offline embeddings and exact or HNSW vector search.
+
+    `mode` is "exact", "hnsw", or "auto" (exact until a user has `exact_limit`
+    memories, then HNSW). `ef_search` trades HNSW recall for latency.
+    """
+
+    def __init__(
+        self,
+        *,
+        directory: str | None = None,
+        mode: str = "auto",
+        exact_limit: int = 20_000,
+        top_k: int = 5,
+        dim: int = EMBEDDING_DIM,
+        ef_search: int = 128,
+    ):
+        if mode not in ("exact", "hnsw", "auto"):
+            raise ValueError(f"Unknown search mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.exact_limit = exact_limit
+        self.top_k = top_k
+        self.dim = dim
+        self.ef_search = ef_search
+        self._partitions: dict[str, VectorPartition] = {}
+        self._lock = threading.Lock()
+
+    def _partition(
+        self, app_name: str, user_id: str, create: bool = False
+    ) -> VectorPartition | None:
+        key = f"{app_name}/{user_id}"
+        partition = self._partitions.get(key)
+        if partition is None:
+            directory = None
+            if self.directory:
+                directory = os.path.join(self.directory, app_name, user_id)
+                if not create and not os.path.isdir(directory):
+                    return None
+            elif not create:
+                return None
+            with self._lock:
+                partition = self._partitions.get(key)
+                if partition is None:
+                    partition = self._partitions[key] = VectorPartition(
+                        self.dim, directory
+                    )
+        return partition
+
+    def _add(self, partition: VectorPartition, records: list[tuple], event_ids: list):
+        if not records:
+            return
+        vectors = embed_texts([record[0] for record in records], self.dim)
+        partition.add(vectors, records, event_ids)
+        if partition.hnsw is None and (
+            self.mode == "hnsw"
+            or (self.mode == "auto" and len(partition) >= self.exact_limit)
+        ):
+            partition.build_hnsw()
+
+    async def add_session_to_memory(self, session: Session):
+        partition = self._partition(session.app_name, session.user_id, create=True)
+        with partition.lock:
+            new = new_memory_events(partition, session)
+            records = [
+                (text, event.content.role, event.author, event.timestamp)
+                for event, text in new
+            ]
+            self._add(partition, records, [event.id for event, _ in new])
+
+    def add_texts(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        texts,
+        author: str = "user",
+        batch_size=10_000,
+    ):
+        """Embed and store plain texts as memories of one user (bulk loading)."""
+        partition = self._partition(app_name, user_id, create=True)
+        now = time.time()
+        texts = iter(texts)
+        with partition.lock:
+            while batch := [
+                (text, "user", author, now) for _, text in zip(range(batch_size), texts)
+            ]:
+                self._add(partition, batch, [None] * len(batch))
+
+    def save(self) -> None:
+        """Write HNSW graphs next to the vectors so restarts skip rebuilding them."""
+        for partition in list(self._partitions.values()):
+            with partition.lock:
+                partition.save()
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        response = SearchMemoryResponse()
+        partition = self._partition(app_name, user_id)
+        if partition is None or not len(partition):
+            return response
+        query_vector = embed_texts([query], self.dim)[0]
+        with partition.lock:
+            if (
+                partition.hnsw is None
+                and self.mode != "exact"
+                and (self.mode == "hnsw" or len(partition) >= self.exact_limit)
+            ):
+                partition.build_hnsw()  # Reopened from disk
+            if partition.hnsw is not None and self.mode != "exact":
+                ids, _ = partition.search_hnsw(query_vector, self.top_k, self.ef_search)
+            else:
+                ids, _ = partition.search_exact(query_vector, self.top_k)
+            found = [partition.records[i] for i in ids.tolist()]
+        for text, role, author, timestamp in found:
+            response.memories.append(
+                MemoryEntry(
+                    content=types.Content(role=role, parts=[types.Part(text=text)]),
+                    author=author,
+                    timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+                )
+            )
+        return response
+
+
+print("Vector memory service defined.")
+
+# %%
+# Different wording, same facts: trigrams match "colour" to "color"
+vector_memory_service = VectorMemoryService(top_k=1)
+await vector_memory_service.add_session_to_memory(session)
+await vector_memory_service.add_session_to_memory(birthday_session)
+
+for query in ["What colour do I like?", "When is my birthday?"]:
+    for name, service in [
+        ("BM25", bm25_memory_service),
+        ("vector", vector_memory_service),
+    ]:
+        response = await service.search_memory(
+            app_name=APP_NAME, user_id=USER_ID, query=query
+        )
+        top = (
+            response.memories[0].content.parts[0].text[:60]
+            if response.memories
+            else "(none)"
+        )
+        print(f"{query:<26} {name:>6}: {top}")
+
+# %%
+## Benchmark: Vector Search Recall vs Latency
+# Exact search is the ground truth: recall@10 is the share of its top 10 that HNSW also
+# returns. Raising ef_search walks more of the graph, buying recall with latency.
+import tempfile
+
+
+def exact_top_ids(vectors: np.ndarray, queries: np.ndarray, k: int) -> list[set[int]]:
+    scores = queries @ vectors.T
+    return [set(np.argpartition(row, -k)[-k:].tolist()) for row in scores]
+
+
+async def benchmark_vector_search(
+    sizes=(10_000, 100_000), ef_values=(10, 20, 40, 80, 160, 320), num_queries=200, k=10
+):
+    print(
+        f"{'memories':>10} {'search':>12} {'recall@10':>10} {'p50 ms':>8} {'p99 ms':>8}"
+    )
+    for size in sizes:
+        queries = sample_queries(num_queries, size)
+        query_vectors = embed_texts(queries)
+        with tempfile.TemporaryDirectory() as directory:
+            service = VectorMemoryService(directory=directory, mode="exact", top_k=k)
+            start = time.perf_counter()
+            service.add_texts(
+                app_name="bench", user_id="user", texts=synthetic_memories(size)
+            )
+            insert_rate = size / (time.perf_counter() - start)
+            partition = service._partition("bench", "user")
+            truth = exact_top_ids(partition.vectors[:size], query_vectors, k)
+
+            latencies = []
+            for query_vector in query_vectors:
+                start = time.perf_counter()
+                partition.search_exact(query_vector, k)
+                latencies.append(time.perf_counter() - start)
+            print(
+                f"{size:>10,} {'exact':>12} {1:>10.3f}"
+                f" {np.percentile(latencies, 50) * 1000:>8.2f}"
+                f" {np.percentile(latencies, 99) * 1000:>8.2f}"
+            )
+
+            start = time.perf_counter()
+            partition.build_hnsw()
+            build_seconds = time.perf_counter() - start
+            for ef in ef_values:
+                latencies, hits = [], 0
+                for query_vector, expected in zip(query_vectors, truth):
+                    start = time.perf_counter()
+                    ids, _ = partition.search_hnsw(query_vector, k, ef)
+                    latencies.append(time.perf_counter() - start)
+                    hits += len(expected & set(ids.tolist()))
+                print(
+                    f"{size:>10,} {f'hnsw ef={ef}':>12}"
+                    f" {hits / (k * len(truth)):>10.3f}"
+                    f" {np.percentile(latencies, 50) * 1000:>8.2f}"
+                    f" {np.percentile(latencies, 99) * 1000:>8.2f}"
+                )
+            print(
+                f"{'':>10} inserts {insert_rate:,.0f}/s,"
+                f" HNSW build {build_seconds:.1f} s"
+            )
+
+            # Reopen from the memory-mapped files, as after a restart
+            service.save()
+            start = time.perf_counter()
+            reopened = VectorMemoryService(directory=directory, mode="hnsw", top_k=k)
+            await reopened.search_memory(
+                app_name="bench", user_id="user", query=queries[0]
+            )
+            print(f"{'':>10} reopen + first search {time.perf_counter() - start:.2f} s")
+
+
+if RUN_BENCHMARKS:
+    await benchmark_vector_search()
+
+
+# %%
+## Persistent Memory with SQLite FTS5
+# Everything above lives in the kernel's memory and is gone on restart.
+# SqliteMemoryService keeps memories in a SQLite file with an FTS5 full-text index,
+# ranked by FTS5's built-in bm25(). Each memory carries a hashed app/user token in an
+# indexed `scope` column, so a search only visits that user's postings. A session's
+# new events are written in one transaction; add_texts bulk-loads in batches.
+import hashlib
+import sqlite3
+
+MEMORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY,
+    app_name TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    session_id TEXT,
+    event_id TEXT,
+    scope TEXT NOT NULL,
+    role TEXT,
+    author TEXT,
+    timestamp REAL NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (app_name, user_id, event_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+    scope, text, content='memories', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS memories_vocab USING fts5vocab(memories_fts, 'row');
+CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+    INSERT INTO memories_fts(rowid, scope, text) VALUES (new.id, new.scope, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+    INSERT INTO memories_fts(memories_fts, rowid, scope, text)
+    VALUES ('delete', old.id, old.scope, old.text);
+END;
+"""
+
+
+def memory_scope(app_name: str, user_id: str) -> str:
+    """A single FTS token standing for one app/user."""
+    digest = hashlib.blake2b(f"{app_name}/{user_id}".encode(), digest_size=8)
+    return f"scope{digest.hexdigest()}"
+
+
+class SqliteMemoryService(BaseMemoryService):
+    """Durable memory service on SQLite FTS5.
+
+    Re-adding a session inserts only the events after its watermark, and a UNIQUE
+    (app, user, event id) constraint makes repeated inserts no-ops, including after a
+    restart when the in-memory watermarks are gone.
+
+    Query terms found in more than `max_term_share` of all memories are dropped
+    before searching (unless every term is that common): they add little to the
+    ranking but make FTS5 score most of the table.
+    """
+
+    def __init__(
+        self, db_path: str = "memory.db", *, top_k: int = 5, max_term_share: float = 0.1
+    ):
+        self.db_path = db_path
+        self.top_k = top_k
+        self.max_term_share = max_term_share
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(MEMORY_SCHEMA)
+        # Rank by the text column alone; the scope token matches every row of the user
+        self._connection.execute(
+            "INSERT INTO memories_fts(memories_fts, rank)"
+            " VALUES ('rank', 'bm25(0.0, 1.0)')"
+        )
+        # memories_vocab holds porter stems: query terms go through the same tokenizer
+        # in a scratch table before they are looked up there
+        self._connection.executescript(
+            "CREATE VIRTUAL TABLE temp.query_terms"
+            " USING fts5(text, tokenize='porter unicode61');"
+            "CREATE VIRTUAL TABLE temp.query_terms_vocab"
+            " USING fts5vocab(temp, query_terms, 'instance');"
+        )
+        self._lock = threading.Lock()
+        self._watermarks: dict[tuple[str, str, str], tuple[int, str]] = {}
+
+    def _insert(self, rows: list[tuple]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO memories (app_name, user_id, session_id,"
+                " event_id, scope, role, author, timestamp, text)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    async def add_session_to_memory(self, session: Session):
+        key = (session.app_name, session.user_id, session.id)
+        events = session.events
+        start, last_id = self._watermarks.get(key, (0, None))
+        if start > len(events) or (start and events[start - 1].id != last_id):
+            start = 0
+        scope = memory_scope(session.app_name, session.user_id)
+        rows = []
+        for event in events[start:]:
+            if not (event.content and event.content.parts):
+                continue
+            text = " ".join(part.text for part in event.content.parts if part.text)
+            if text:
+                role, author, timestamp = (
+                    event.content.role,
+                    event.author,
+                    event.timestamp,
+                )
+                rows.append((*key, event.id, scope, role, author, timestamp, text))
+        if rows:
+            self._insert(rows)
+        if events:
+            self._watermarks[key] = (len(events), events[-1].id)
+
+    def add_texts(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        texts,
+        author: str = "user",
+        batch_size: int = 5_000,
+    ) -> None:
+        """Store plain texts as memories of one user, `batch_size` per transaction."""
+        scope = memory_scope(app_name, user_id)
+        now = time.time()
+        texts = iter(texts)
+        while batch := [
+            (app_name, user_id, None, None, scope, "user", author, now, text)
+            for _, text in zip(range(batch_size), texts)
+        ]:
+            self._insert(batch)
+
+    def _stems(self, terms: list[str]) -> list[str]:
+        """`terms` as memories_fts indexes them (porter-stemmed), in the same order."""
+        with self._connection:
+            self._connection.execute("DELETE FROM query_terms")
+            self._connection.execute(
+                "INSERT INTO query_terms (text) VALUES (?)", (" ".join(terms),)
+            )
+        stems = dict(
+            self._connection.execute("SELECT offset, term FROM query_terms_vocab")
+        )
+        return [stems.get(position, term) for position, term in enumerate(terms)]
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        response = SearchMemoryResponse()
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return response
+        with self._lock:
+            # max(id) stands in for the row count, which would need a full scan
+            total = self._connection.execute("SELECT max(id) FROM memories")
+            total = total.fetchone()[0] or 0
+            stems = self._stems(terms)
+            frequencies = dict(
+                self._connection.execute(
+                    "SELECT term, doc FROM memories_vocab"
+                    f" WHERE term IN ({', '.join('?' * len(stems))})",
+                    stems,
+                ).fetchall()
+            )
+            documents = {
+                term: frequencies.get(stem, 0) for term, stem in zip(terms, stems)
+            }
+            limit = max(self.max_term_share * total, 100)  # Small stores keep all terms
+            selective = [term for term in terms if documents[term] <= limit]
+            terms = selective or [min(terms, key=documents.get)]
+            match = f'scope:"{memory_scope(app_name, user_id)}" AND ('
+            match += " OR ".join(f'"{term}"' for term in terms) + ")"
+            rows = self._connection.execute(
+                "SELECT m.text, m.role, m.author, m.timestamp FROM ("
+                "  SELECT rowid, rank FROM memories_fts WHERE memories_fts MATCH ?"
+                "  ORDER BY rank LIMIT ?"
+                ") hits JOIN memories m ON m.id = hits.rowid ORDER BY hits.rank",
+                (match, self.top_k),
+            ).fetchall()
+        for text, role, author, timestamp in rows:
+            response.memories.append(
+                MemoryEntry(
+                    content=types.Content(role=role, parts=[types.Part(text=text)]),
+                    author=author,
+                    timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+                )
+            )
+        return response
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+print("SQLite memory service defined.")
+
+# %%
+# Memories survive a restart: close the service, open the file again and search
+sqlite_memory_service = SqliteMemoryService("memory.db", top_k=3)
+await sqlite_memory_service.add_session_to_memory(session)
+await sqlite_memory_service.add_session_to_memory(birthday_session)
+sqlite_memory_service.close()
+
+sqlite_memory_service = SqliteMemoryService("memory.db", top_k=3)
+search_response = await sqlite_memory_service.search_memory(
+    app_name=APP_NAME, user_id=USER_ID, query="When is my birthday?"
+)
+for memory in search_response.memories:
+    print(f"  [{memory.author}]: {memory.content.parts[0].text[:80]}")
+
+# %%
+## Benchmark: SQLite FTS5 vs In-Memory Memory
+# Insert throughput by transaction size, then search latency against the in-memory
+# services at the same sizes, with 100 other users' memories in the same database.
+
+
+async def benchmark_sqlite_memory(
+    sizes=(10_000, 100_000), batch_sizes=(1, 100, 5_000), num_queries=200
+):
+    with tempfile.TemporaryDirectory() as directory:
+        for batch_size in batch_sizes:
+            service = SqliteMemoryService(os.path.join(directory, f"b{batch_size}.db"))
+            count = 2_000 if batch_size == 1 else 20_000
+            start = time.perf_counter()
+            service.add_texts(
+                app_name="bench",
+                user_id="user",
+                texts=synthetic_memories(count),
+                batch_size=batch_size,
+            )
+            rate = count / (time.perf_counter() - start)
+            print(f"insert, {batch_size:>5} per transaction: {rate:>9,.0f} memories/s")
+            service.close()
+
+        print(f"{'memories':>10} {'service':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        for size in sizes:
+            queries = sample_queries(num_queries, size)
+            sqlite_service = SqliteMemoryService(
+                os.path.join(directory, f"m{size}.db"), top_k=10
+            )
+            for other in range(100):
+                sqlite_service.add_texts(
+                    app_name="bench",
+                    user_id=f"other-{other}",
+                    texts=synthetic_memories(size // 100, seed=other + 1),
+                )
+            sqlite_service.add_texts(
+                app_name="bench", user_id="user", texts=synthetic_memories(size)
+            )
+            bm25_service = BM25MemoryService(top_k=10)
+            bm25_service.add_texts(
+                app_name="bench", user_id="user", texts=synthetic_memories(size)
+            )
+            services = {"SQLite": sqlite_service, "BM25": bm25_service}
+            if size <= 10_000:
+                scan_service = InMemoryMemoryService()
+                events = [
+                    Event(
+                        author="user",
+                        content=types.Content(
+                            role="user", parts=[types.Part(text=text)]
+                        ),
+                    )
+                    for text in synthetic_memories(size)
+                ]
+                await scan_service.add_session_to_memory(
+                    Session(id="s", app_name="bench", user_id="user", events=events)
+                )
+                services["scan"] = scan_service
+            for name, service in services.items():
+                latencies, _ = await time_searches(
+                    service, queries if name != "scan" else queries[:20]
+                )
+                print(
+                    f"{size:>10,} {name:>8} {np.percentile(latencies, 50) * 1000:>8.2f}"
+                    f" {np.percentile(latencies, 99) * 1000:>8.2f}"
+                )
+            sqlite_service.close()
+
+
+if RUN_BENCHMARKS:
+    await benchmark_sqlite_memory()
+
+
 # %%
 ## Automating Memory Storage
 async def auto_save_to_memory(callback_context):
@@ -207,14 +1287,1302 @@ async def auto_save_to_memory(callback_context):
 
 print("Callback created.")
 
+# %%
+## Incremental and Background Memory Ingestion
+# auto_save_to_memory hands the whole session to add_session_to_memory after every
+# turn. InMemoryMemoryService copies all of its events each time, so a conversation
+# of n turns costs O(n^2). BM25MemoryService and VectorMemoryService keep a watermark
+# per session and read only the events appended since the last call, skipping event
+# ids they already hold. BackgroundMemoryIngestor goes further and takes ingestion off
+# the response path: the callback only queues the session.
+import asyncio
+
+
+class BackgroundMemoryIngestor:
+    """Runs add_session_to_memory in a worker task instead of in the caller.
+
+    A session submitted again while it is still queued is ingested once, with all
+    its new events.
+    """
+
+    def __init__(self, memory_service: BaseMemoryService):
+        self.memory_service = memory_service
+        self._pending: dict[tuple[str, str, str], Session] = {}
+        self._worker: asyncio.Task | None = None
+        self.submitted = 0
+        self.ingested = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.last_error: Exception | None = None
+        self.ingest_seconds = 0.0
+
+    def submit(self, session: Session) -> None:
+        self.submitted += 1
+        self._pending[(session.app_name, session.user_id, session.id)] = session
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            session = self._pending.pop(next(iter(self._pending)))
+            start = time.perf_counter()
+            self.in_flight += 1
+            try:
+                await self.memory_service.add_session_to_memory(session)
+                self.ingested += 1
+            except Exception as e:
+                self.failed += 1
+                self.last_error = e
+            finally:
+                self.in_flight -= 1
+            self.ingest_seconds += time.perf_counter() - start
+            await asyncio.sleep(0)  # Let pending responses run between sessions
+
+    async def drain(self) -> None:
+        """Wait until every submitted session is ingested."""
+        while self._worker is not None and not self._worker.done():
+            await self._worker
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "submitted": self.submitted,
+            "ingested": self.ingested,
+            "coalesced": self.submitted
+            - self.ingested
+            - self.failed
+            - len(self._pending)
+            - self.in_flight,
+            "failed": self.failed,
+            "pending": len(self._pending),
+            "in_flight": self.in_flight,
+            "ingest_seconds": self.ingest_seconds,
+        }
+
+
+memory_ingestors: dict[BaseMemoryService, BackgroundMemoryIngestor] = {}
+
+
+async def auto_save_to_memory_in_background(callback_context):
+    """Queue the session for memory ingestion after each turn and return at once."""
+    memory_service = callback_context._invocation_context.memory_service
+    ingestor = memory_ingestors.get(memory_service)
+    if ingestor is None:
+        ingestor = memory_ingestors[memory_service] = BackgroundMemoryIngestor(
+            memory_service
+        )
+    ingestor.submit(callback_context._invocation_context.session)
+
+
+print("Background ingestion defined.")
+
+# %%
+## Benchmark: Memory Ingestion over a Long Conversation
+# Saves a growing session to memory after each of `num_turns` turns (one user and one
+# model event per turn) and compares the cost of early and late turns.
+
+
+def conversation_turn(turn: int, texts) -> list[Event]:
+    return [
+        Event(
+            invocation_id=f"turn-{turn}",
+            author=author,
+            content=types.Content(role=role, parts=[types.Part(text=next(texts))]),
+        )
+        for author, role in [("user", "user"), ("agent", "model")]
+    ]
+
+
+async def benchmark_memory_ingestion(num_turns: int = 2_000, window: int = 100):
+    print(
+        f"{'service':>16} {f'first {window} ms':>14} {f'last {window} ms':>13}"
+        f" {'total s':>8} {'memories':>9}"
+    )
+    services = {
+        "InMemory (full)": InMemoryMemoryService(),
+        "BM25 (delta)": BM25MemoryService(),
+        "Vector (delta)": VectorMemoryService(),
+    }
+    for name, service in services.items():
+        texts = synthetic_memories(2 * num_turns)
+        session = Session(id="long", app_name="bench", user_id="user")
+        latencies = []
+        for turn in range(num_turns):
+            session.events += conversation_turn(turn, texts)
+            start = time.perf_counter()
+            await service.add_session_to_memory(session)
+            latencies.append(time.perf_counter() - start)
+        # Saving the same session again must not add anything
+        await service.add_session_to_memory(session)
+        if isinstance(service, InMemoryMemoryService):
+            stored = len(service._session_events["bench/user"]["long"])
+        else:
+            stored = len(service._partition("bench", "user"))
+        print(
+            f"{name:>16} {np.mean(latencies[:window]) * 1000:>14.3f}"
+            f" {np.mean(latencies[-window:]) * 1000:>13.3f}"
+            f" {sum(latencies):>8.2f} {stored:>9,}"
+        )
+
+    # Time spent in the after-turn callback: ingesting inline vs queueing it
+    for mode in ("inline", "background"):
+        service = BM25MemoryService()
+        ingestor = BackgroundMemoryIngestor(service)
+        texts = synthetic_memories(2 * num_turns)
+        session = Session(id="long", app_name="bench", user_id="user")
+        latencies = []
+        for turn in range(num_turns):
+            session.events += conversation_turn(turn, texts)
+            start = time.perf_counter()
+            if mode == "inline":
+                await service.add_session_to_memory(session)
+            else:
+                ingestor.submit(session)
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0)  # The rest of the turn
+        await ingestor.drain()
+        print(
+            f"callback {mode:>10}: p50 {np.percentile(latencies, 50) * 1000:.3f} ms"
+            f"  p99 {np.percentile(latencies, 99) * 1000:.3f} ms"
+            f"  memories {len(service._partition('bench', 'user')):,}"
+        )
+    print(f"background ingestor: {ingestor.stats()}")
+
+
+if RUN_BENCHMARKS:
+    await benchmark_memory_ingestion()
+
+# %%
+## Prefetched and Cached Memory for preload_memory
+# preload_memory searches memory before every model call, including each extra call of
+# a tool-using turn, and the model waits for it. PrefetchingMemoryService wraps a
+# memory service: prefetch_memory (a before_agent_callback) starts the search as soon
+# as the user's message arrives, and CachedPreloadMemoryTool reads the result from a
+# per-session cache. A cached result is reused until the query changes meaningfully
+# (word overlap below `similarity`) or another session adds new memories for the user.
+# A new session is prefetched from its first message too: there is no query to search
+# for before it, and ADK has no earlier hook, so "when a session starts" and "on the
+# first user message" are the same point here.
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from google.adk.tools.preload_memory_tool import PreloadMemoryTool
+
+# Session whose cache search_memory should use; set by CachedPreloadMemoryTool
+current_memory_session: ContextVar[str | None] = ContextVar(
+    "current_memory_session", default=None
+)
+
+
+class PrefetchEntry(NamedTuple):
+    query: str
+    terms: frozenset[str]
+    version: int
+    task: asyncio.Task
+
+    def fits(self, terms: frozenset[str], version: int, similarity: float) -> bool:
+        if version != self.version:
+            return False
+        if self.task.done() and (self.task.cancelled() or self.task.exception()):
+            return False
+        union = self.terms | terms
+        return not union or len(self.terms & terms) / len(union) >= similarity
+
+
+class PrefetchingMemoryService(BaseMemoryService):
+    """Memory service wrapper with background prefetch and a per-session cache."""
+
+    def __init__(
+        self,
+        memory_service: BaseMemoryService,
+        *,
+        similarity: float = 0.5,
+        max_sessions: int = 1_024,
+        latency_window: int = 10_000,
+    ):
+        self.memory_service = memory_service
+        self.similarity = similarity
+        self.max_sessions = max_sessions
+        self._cache: OrderedDict[tuple[str, str, str], PrefetchEntry] = OrderedDict()
+        self._versions: dict[tuple[str, str], int] = {}
+        self.searches = 0
+        self.lookups = 0
+        self.hits = 0
+        # Lookup latencies of the most recent `latency_window` lookups
+        self.latencies: deque[float] = deque(maxlen=latency_window)
+
+    def prefetch(
+        self, *, app_name: str, user_id: str, session_id: str, query: str
+    ) -> tuple[PrefetchEntry, bool]:
+        """Start searching for `query` unless the session's cached search still fits.
+
+        Returns the entry to wait on and whether it was reused.
+        """
+        key = (app_name, user_id, session_id)
+        terms = frozenset(tokenize(query))
+        version = self._versions.get((app_name, user_id), 0)
+        entry = self._cache.get(key)
+        reused = entry is not None and entry.fits(terms, version, self.similarity)
+        if not reused:
+            self.searches += 1
+            task = asyncio.get_running_loop().create_task(
+                self.memory_service.search_memory(
+                    app_name=app_name, user_id=user_id, query=query
+                )
+            )
+            entry = self._cache[key] = PrefetchEntry(query, terms, version, task)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_sessions:
+            self._cache.popitem(last=False)
+        return entry, reused
+
+    async def add_session_to_memory(self, session: Session):
+        await self.memory_service.add_session_to_memory(session)
+        user = (session.app_name, session.user_id)
+        version = self._versions[user] = self._versions.get(user, 0) + 1
+        # The user's other sessions search again on their next lookup. This session's
+        # own events are already in its context, so its cached search stays valid.
+        key = (*user, session.id)
+        if key in self._cache:
+            self._cache[key] = self._cache[key]._replace(version=version)
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        session_id = current_memory_session.get()
+        if session_id is None:  # load_memory and other direct searches
+            return await self.memory_service.search_memory(
+                app_name=app_name, user_id=user_id, query=query
+            )
+        start = time.perf_counter()
+        entry, reused = self.prefetch(
+            app_name=app_name, user_id=user_id, session_id=session_id, query=query
+        )
+        response = await asyncio.shield(entry.task)
+        self.lookups += 1
+        self.hits += reused
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+    def stats(self) -> dict[str, float]:
+        latencies = self.latencies or [0.0]
+        return {
+            "searches": self.searches,
+            "lookups": self.lookups,
+            "hit_rate": self.hits / max(self.lookups, 1),
+            "p50_ms": np.percentile(latencies, 50) * 1000,
+            "p99_ms": np.percentile(latencies, 99) * 1000,
+            "cached_sessions": len(self._cache),
+        }
+
+
+class CachedPreloadMemoryTool(PreloadMemoryTool):
+    """preload_memory that reads the session's prefetched memory search."""
+
+    async def process_llm_request(self, *, tool_context, llm_request) -> None:
+        token = current_memory_session.set(tool_context._invocation_context.session.id)
+        try:
+            await super().process_llm_request(
+                tool_context=tool_context, llm_request=llm_request
+            )
+        finally:
+            current_memory_session.reset(token)
+
+
+cached_preload_memory = CachedPreloadMemoryTool()
+
+
+async def prefetch_memory(callback_context):
+    """Start the memory search for the new user message before the agent runs."""
+    context = callback_context._invocation_context
+    content = callback_context.user_content
+    memory_service = context.memory_service
+    while hasattr(memory_service, "memory_service") and not isinstance(
+        memory_service, PrefetchingMemoryService
+    ):
+        memory_service = memory_service.memory_service  # Look through wrappers
+    if not isinstance(memory_service, PrefetchingMemoryService) or not (
+        content and content.parts and content.parts[0].text
+    ):
+        return
+    memory_service.prefetch(
+        app_name=context.app_name,
+        user_id=context.user_id,
+        session_id=context.session.id,
+        query=content.parts[0].text,
+    )
+
+
+print("Memory prefetch defined.")
+
+# %%
+## Benchmark: Memory Retrieval per Model Call
+# Replays the same scripted conversations through ADK's preload_memory and through the
+# prefetching cache, over 100k memories in SQLite. Users mostly rephrase the current
+# topic (same or most words) and switch topics 30% of the time; a turn makes 1-3 model
+# calls and every fifth turn on average saves the session to memory.
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.models import LlmRequest
+from google.adk.tools.tool_context import ToolContext
+
+
+def conversation_script(num_sessions: int, turns: int, topics: list[str], seed=0):
+    """(session, turn, message, model calls, save afterwards) for every turn."""
+    rng = np.random.default_rng(seed)
+    script = []
+    for s in range(num_sessions):
+        topic = topics[rng.integers(len(topics))].split()
+        for turn in range(turns):
+            if turn and rng.random() < 0.3:
+                topic = topics[rng.integers(len(topics))].split()
+            words = list(rng.permutation(topic))
+            if len(words) > 2 and rng.random() < 0.5:
+                words = words[:-1]
+            calls = int(rng.integers(1, 4))
+            script.append((s, turn, " ".join(words), calls, rng.random() < 0.2))
+    return script
+
+
+async def benchmark_memory_prefetch(
+    num_sessions: int = 50, turns: int = 10, num_memories: int = 100_000
+):
+    with tempfile.TemporaryDirectory() as directory:
+        backing = SqliteMemoryService(os.path.join(directory, "memory.db"))
+        backing.add_texts(
+            app_name="bench", user_id="user", texts=synthetic_memories(num_memories)
+        )
+        script = conversation_script(
+            num_sessions, turns, sample_queries(100, num_memories)
+        )
+        agent = LlmAgent(name="bench_agent", model="gemini-2.5-flash-lite")
+        print(
+            f"{'retrieval':>18} {'calls':>6} {'searches':>9} {'p50 ms':>8}"
+            f" {'p99 ms':>8} {'waited s':>9} {'wall s':>7}"
+        )
+        for name, tool, memory in [
+            ("preload_memory", PreloadMemoryTool(), backing),
+            (
+                "prefetch + cache",
+                CachedPreloadMemoryTool(),
+                PrefetchingMemoryService(backing),
+            ),
+        ]:
+            sessions = [
+                Session(id=f"{name}-{s}", app_name="bench", user_id="user")
+                for s in range(num_sessions)
+            ]
+            latencies = []
+            wall_start = time.perf_counter()
+            for s, turn, message, calls, save in script:
+                session = sessions[s]
+                context = InvocationContext(
+                    session_service=session_service,
+                    invocation_id=f"{s}-{turn}",
+                    agent=agent,
+                    session=session,
+                    memory_service=memory,
+                    user_content=types.Content(
+                        role="user", parts=[types.Part(text=message)]
+                    ),
+                )
+                await prefetch_memory(CallbackContext(context))
+                await asyncio.sleep(
+                    0.002
+                )  # The rest of the agent's work before the model
+                for _ in range(calls):
+                    start = time.perf_counter()
+                    await tool.process_llm_request(
+                        tool_context=ToolContext(context), llm_request=LlmRequest()
+                    )
+                    latencies.append(time.perf_counter() - start)
+                if save:
+                    session.events.append(
+                        Event(
+                            invocation_id=f"{s}-{turn}",
+                            author="user",
+                            content=context.user_content,
+                        )
+                    )
+                    await memory.add_session_to_memory(session)
+            wall = time.perf_counter() - wall_start
+            searches = (
+                len(latencies) if memory is backing else memory.stats()["searches"]
+            )
+            print(
+                f"{name:>18} {len(latencies):>6} {searches:>9}"
+                f" {np.percentile(latencies, 50) * 1000:>8.2f}"
+                f" {np.percentile(latencies, 99) * 1000:>8.2f}"
+                f" {sum(latencies):>9.2f} {wall:>7.2f}"
+            )
+        backing.close()
+
+
+if RUN_BENCHMARKS:
+    await benchmark_memory_prefetch()
+
+# %%
+## Background Memory Consolidation
+# With auto-save every turn is stored, so the same facts pile up ("my favorite color
+# is blue-green" said in ten sessions is ten memories): searches get slower and the
+# top results fill with repeats. MemoryConsolidator runs next to a BM25MemoryService
+# and merges each user's near-duplicates (cosine similarity of the local embeddings
+# above `similarity`) into one fact record: the newest wording survives and counts
+# the mentions it replaced (MemoryPartition.mentions), the others are retired.
+# Memories whose numbers or proper nouns differ ("my flight is on May 3" / "on May 5")
+# are never merged, however close their embeddings are. It works through new memories
+# in batches and stops each pass at `time_budget` per user, holding the user's lock
+# only to read a batch and apply its merges. Once a quarter of a user's memories are
+# retired, a compacted index is built beside the live one and swapped in.
+
+
+# Numbers, and capitalized words that don't start a sentence
+DISTINGUISHING_PATTERN = re.compile(r"\w*\d\w*|(?<![.!?]\s)(?<!^)\b[A-Z]\w+")
+
+
+def distinguishing_tokens(text: str) -> frozenset[str]:
+    """The numbers and likely proper nouns of a memory, which name a specific fact."""
+    return frozenset(token.lower() for token in DISTINGUISHING_PATTERN.findall(text))
+
+
+class ConsolidationState:
+    """Progress of consolidation over one user's memories."""
+
+    def __init__(self, dim: int):
+        self.cursor = 0  # Memories before this one are consolidated
+        self.fact_ids: list[int] = []
+        self.fact_vectors = np.zeros((1024, dim), dtype=np.float32)
+        # Facts only merge with memories that have the same distinguishing tokens
+        self.fact_keys = np.zeros(1024, dtype=np.int64)
+        self.key_ids: dict[frozenset[str], int] = {}
+
+    def key_id(self, text: str) -> int:
+        return self.key_ids.setdefault(distinguishing_tokens(text), len(self.key_ids))
+
+    def add_fact(self, memory_id: int, vector: np.ndarray, key: int) -> None:
+        if len(self.fact_ids) == len(self.fact_vectors):
+            self.fact_vectors = np.concatenate([self.fact_vectors, self.fact_vectors])
+            self.fact_keys = np.concatenate([self.fact_keys, self.fact_keys])
+        self.fact_vectors[len(self.fact_ids)] = vector
+        self.fact_keys[len(self.fact_ids)] = key
+        self.fact_ids.append(memory_id)
+
+
+class MemoryConsolidator:
+    """Budgeted, incremental near-duplicate merging for a BM25MemoryService."""
+
+    def __init__(
+        self,
+        memory_service: BM25MemoryService,
+        *,
+        similarity: float = 0.9,
+        batch_size: int = 256,
+        time_budget: float = 0.05,
+        compact_ratio: float = 0.25,
+        dim: int = EMBEDDING_DIM,
+    ):
+        self.memory_service = memory_service
+        self.similarity = similarity
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.compact_ratio = compact_ratio
+        self.dim = dim
+        self._states: dict[str, ConsolidationState] = {}
+        self._task: asyncio.Task | None = None
+        self.passes = 0
+        self.merged = 0
+        self.compactions = 0
+        self.longest_lock_hold = 0.0
+
+    def _consolidate_batch(self, key: str, partition: MemoryPartition) -> bool:
+        """Merge the next batch of a user's memories. False when there is none."""
+        state = self._states.setdefault(key, ConsolidationState(self.dim))
+        with partition.lock:
+            start = state.cursor
+            texts = partition.texts[start : start + self.batch_size]
+        if not texts:
+            return False
+        vectors = embed_texts(texts, self.dim)
+        keys = [state.key_id(text) for text in texts]
+        known = len(state.fact_ids)
+        similarities = vectors @ state.fact_vectors[:known].T
+
+        locked_at = time.perf_counter()
+        with partition.lock:
+            for row, memory_id in enumerate(range(start, start + len(texts))):
+                # Compare with the facts known before this batch, then the batch's own,
+                # leaving out facts with other numbers or names
+                scores = np.where(
+                    state.fact_keys[:known] == keys[row], similarities[row], -1.0
+                )
+                new_scores = np.where(
+                    state.fact_keys[known : len(state.fact_ids)] == keys[row],
+                    state.fact_vectors[known : len(state.fact_ids)] @ vectors[row],
+                    -1.0,
+                )
+                best, best_score = -1, self.similarity
+                if len(scores) and scores.max() >= best_score:
+                    best, best_score = int(scores.argmax()), scores.max()
+                if len(new_scores) and new_scores.max() >= best_score:
+                    best = known + int(new_scores.argmax())
+                if best < 0:
+                    state.add_fact(memory_id, vectors[row], keys[row])
+                    continue
+                # The newer memory replaces the fact it repeats
+                partition.merge(state.fact_ids[best], into=memory_id)
+                state.fact_ids[best] = memory_id
+                state.fact_vectors[best] = vectors[row]
+                self.merged += 1
+            state.cursor = start + len(texts)
+        self.longest_lock_hold = max(
+            self.longest_lock_hold, time.perf_counter() - locked_at
+        )
+
+        if partition.retired_count > self.compact_ratio * len(partition):
+            # Rebuild without the lock, then take it only to catch up and switch
+            upto = len(partition)
+            fresh, remap = partition.compacted(upto)
+            locked_at = time.perf_counter()
+            with partition.lock:
+                partition.adopt(fresh, remap, upto)
+            self.longest_lock_hold = max(
+                self.longest_lock_hold, time.perf_counter() - locked_at
+            )
+            state.fact_ids = [remap[i] for i in state.fact_ids]
+            state.cursor = remap.get(state.cursor, len(partition))
+            self.compactions += 1
+        return True
+
+    async def run_once(self) -> None:
+        """One pass over every user, at most `time_budget` seconds each."""
+        for key, partition in list(self.memory_service._partitions.items()):
+            deadline = time.perf_counter() + self.time_budget
+            while time.perf_counter() < deadline:
+                if not self._consolidate_batch(key, partition):
+                    break
+                await asyncio.sleep(0)  # Let searches and turns run between batches
+        self.passes += 1
+
+    def pending(self) -> int:
+        """Memories not consolidated yet, over all users."""
+        return sum(
+            (
+                len(partition) - self._states[key].cursor
+                if key in self._states
+                else len(partition)
+            )
+            for key, partition in list(self.memory_service._partitions.items())
+        )
+
+    def start(self, interval: float = 1.0) -> None:
+        """Run a pass every `interval` seconds until stop()."""
+
+        async def loop():
+            while True:
+                await self.run_once()
+                await asyncio.sleep(interval)
+
+        self._task = asyncio.get_running_loop().create_task(loop())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+print("Memory consolidation defined.")
+
+# %%
+## Benchmark: Memory Consolidation
+# `num_facts` facts, each saved `mentions` times with small wording changes (a word
+# dropped or two swapped), in random order, for one user. Compares memory count,
+# search latency and how many distinct facts fill the top 10 before and after.
+
+
+def repeated_facts(num_facts: int, mentions: int, seed: int = 0):
+    """Texts of `num_facts` facts repeated with variations, and each text's fact."""
+    rng = np.random.default_rng(seed)
+    texts, fact_of = [], []
+    for fact, text in enumerate(synthetic_memories(num_facts, seed=seed)):
+        words = text.split()
+        for _ in range(mentions):
+            variant = list(words)
+            if rng.random() < 0.5 and len(variant) > 5:
+                del variant[rng.integers(len(variant))]
+            else:
+                i, j = rng.integers(len(variant), size=2)
+                variant[i], variant[j] = variant[j], variant[i]
+            texts.append(" ".join(variant))
+            fact_of.append(fact)
+    order = rng.permutation(len(texts))
+    return [texts[i] for i in order], [fact_of[i] for i in order]
+
+
+async def measure_memory_search(service, queries, fact_by_text):
+    latencies, distinct = [], []
+    for query in queries:
+        start = time.perf_counter()
+        response = await service.search_memory(
+            app_name="bench", user_id="user", query=query
+        )
+        latencies.append(time.perf_counter() - start)
+        facts = {fact_by_text[m.content.parts[0].text] for m in response.memories}
+        distinct.append(len(facts))
+    return latencies, np.mean(distinct)
+
+
+async def benchmark_memory_consolidation(
+    num_facts: int = 10_000, mentions: int = 5, num_queries: int = 200
+):
+    texts, facts = repeated_facts(num_facts, mentions)
+    fact_by_text = dict(zip(texts, facts))
+    service = BM25MemoryService(top_k=10)
+    service.add_texts(app_name="bench", user_id="user", texts=texts)
+    partition = service._partition("bench", "user")
+    rng = np.random.default_rng(1)
+    queries = [
+        " ".join(rng.choice(text.split(), 3, replace=False))
+        for text in rng.choice(texts, num_queries)
+    ]
+
+    def report(label, latencies, distinct):
+        print(
+            f"{label:>7}: {len(partition) - partition.retired_count:>7,} memories"
+            f"  search p50 {np.percentile(latencies, 50) * 1000:.2f} ms"
+            f"  p99 {np.percentile(latencies, 99) * 1000:.2f} ms"
+            f"  distinct facts in top 10: {distinct:.1f}"
+        )
+
+    report("before", *await measure_memory_search(service, queries, fact_by_text))
+    consolidator = MemoryConsolidator(service)
+    start = time.perf_counter()
+    while consolidator.pending():
+        await consolidator.run_once()
+    seconds = time.perf_counter() - start
+    report("after", *await measure_memory_search(service, queries, fact_by_text))
+    print(
+        f"consolidation: {seconds:.1f} s in {consolidator.passes} passes,"
+        f" {consolidator.merged:,} merged, {consolidator.compactions} compactions,"
+        f" longest lock hold {consolidator.longest_lock_hold * 1000:.0f} ms"
+    )
+
+
+if RUN_BENCHMARKS:
+    await benchmark_memory_consolidation()
+
+# %%
+## Token-Budgeted Memory Retrieval
+# load_memory and preload_memory put everything search_memory returns into the prompt,
+# each memory as its full event text, so a few long model answers add thousands of
+# tokens to every model call. BudgetedMemoryService wraps a memory service, reranks
+# its results by relevance and recency and keeps the best `top_k` that fit in
+# `max_tokens`. Snippets longer than `max_snippet_tokens` (or than what is left of the
+# budget) are cut down to their sentences sharing the most words with the query.
+# Relevance mixes query word coverage with the wrapped service's own ranking, so give
+# that service a larger top_k to rerank from. Tokens injected per turn are logged to
+# the "memory_tokens" logger: start_memory_turn (a before_agent_callback) marks the
+# turn's searches with its invocation id, and log_memory_tokens (an
+# after_agent_callback) logs their total.
+import logging
+import sys
+from contextvars import ContextVar
+
+memory_token_logger = logging.getLogger("memory_tokens")
+memory_token_logger.setLevel(logging.INFO)
+if not memory_token_logger.handlers:  # Re-running the cell adds no second handler
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("[Memory] %(message)s"))
+    memory_token_logger.addHandler(handler)
+
+# Invocation whose turn total search_memory adds to; set by start_memory_turn
+current_memory_invocation: ContextVar[str | None] = ContextVar(
+    "current_memory_invocation", default=None
+)
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token count: about 4 characters per token."""
+    return (len(text) + 3) // 4
+
+
+def memory_text(memory: MemoryEntry) -> str:
+    return " ".join(part.text for part in memory.content.parts or [] if part.text)
+
+
+def fit_snippet(text: str, terms: set[str], max_tokens: int) -> str:
+    """Shorten `text` to `max_tokens`, keeping the sentences most about `terms`."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    sentences = [s for s in SENTENCE_PATTERN.split(text) if s.strip()]
+    overlap = [len(terms.intersection(tokenize(s))) for s in sentences]
+    kept, used = [], 0
+    for i in sorted(range(len(sentences)), key=lambda i: -overlap[i]):
+        cost = estimate_tokens(sentences[i]) + 1  # With the separator
+        if used + cost <= max_tokens:
+            kept.append(i)
+            used += cost
+    if not kept:  # Even the best sentence is too long: cut it at a word boundary
+        best = sentences[max(range(len(sentences)), key=lambda i: overlap[i])]
+        return best[: (max_tokens - 1) * 4].rsplit(" ", 1)[0] + " …"
+    kept.sort()
+    snippet = "" if kept[0] == 0 else "… "
+    for previous, i in zip([None] + kept, kept):
+        if previous is not None:
+            snippet += " " if i == previous + 1 else " … "
+        snippet += sentences[i]
+    return snippet if kept[-1] == len(sentences) - 1 else snippet + " …"
+
+
+class BudgetedMemoryService(BaseMemoryService):
+    """Memory service wrapper that ranks by recency and fits results to a budget."""
+
+    def __init__(
+        self,
+        memory_service: BaseMemoryService,
+        *,
+        max_tokens: int = 512,
+        top_k: int = 5,
+        max_snippet_tokens: int = 128,
+        min_snippet_tokens: int = 16,
+        half_life_days: float = 30.0,
+        recency_weight: float = 0.5,
+    ):
+        self.memory_service = memory_service
+        self.max_tokens = max_tokens
+        self.top_k = top_k
+        self.max_snippet_tokens = max_snippet_tokens
+        self.min_snippet_tokens = min_snippet_tokens
+        self.half_life_days = half_life_days
+        self.recency_weight = recency_weight
+        self.injected: list[int] = []  # Tokens returned by each search
+        self.turns: list[int] = []  # Tokens injected by each finished turn
+        self.truncated = 0
+        self._turn_tokens: dict[str, int] = {}  # Invocation id -> tokens so far
+
+    def rank(self, memories: list[MemoryEntry], terms: set[str]) -> list[MemoryEntry]:
+        """Order memories by relevance times recency decay, best first."""
+        scores = []
+        for position, memory in enumerate(memories):
+            words = set(tokenize(memory_text(memory)))
+            coverage = len(terms & words) / len(terms) if terms else 0.0
+            relevance = 0.5 * coverage + 0.5 / (position + 1)
+            recency = 0.0  # No boost for memories without a timestamp
+            if memory.timestamp:
+                then = datetime.fromisoformat(memory.timestamp)
+                age_days = (datetime.now(then.tzinfo) - then).total_seconds() / 86_400
+                recency = 0.5 ** (max(age_days, 0.0) / self.half_life_days)
+            weight = 1 - self.recency_weight + self.recency_weight * recency
+            scores.append(relevance * weight)
+        order = sorted(range(len(memories)), key=lambda i: -scores[i])
+        return [memories[i] for i in order]
+
+    async def add_session_to_memory(self, session: Session):
+        await self.memory_service.add_session_to_memory(session)
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        response = await self.memory_service.search_memory(
+            app_name=app_name, user_id=user_id, query=query
+        )
+        terms = set(tokenize(query))
+        memories, used, truncated = [], 0, 0
+        for memory in self.rank(response.memories, terms):
+            if len(memories) == self.top_k:
+                break
+            text = memory_text(memory)
+            if not text:
+                continue
+            # The lines preload_memory wraps each memory in count against the budget
+            overhead = estimate_tokens(
+                f"Time: {memory.timestamp or ''}\n{memory.author or ''}: \n"
+            )
+            room = min(self.max_snippet_tokens, self.max_tokens - used - overhead)
+            if room < self.min_snippet_tokens:
+                continue  # A shorter memory further down may still fit
+            snippet = fit_snippet(text, terms, room)
+            if snippet != text:
+                truncated += 1
+                content = types.Content(
+                    role=memory.content.role, parts=[types.Part(text=snippet)]
+                )
+                memory = memory.model_copy(update={"content": content})
+            memories.append(memory)
+            used += overhead + estimate_tokens(snippet)
+
+        self.injected.append(used)
+        self.truncated += truncated
+        invocation_id = current_memory_invocation.get()
+        if invocation_id is not None:
+            self._turn_tokens[invocation_id] = (
+                self._turn_tokens.get(invocation_id, 0) + used
+            )
+        memory_token_logger.debug(
+            f"{used} tokens injected: {len(memories)} of {len(response.memories)}"
+            f" memories, {truncated} truncated"
+        )
+        return SearchMemoryResponse(memories=memories)
+
+    def end_turn(self, invocation_id: str) -> int:
+        """Tokens injected by the searches of a finished invocation."""
+        tokens = self._turn_tokens.pop(invocation_id, 0)
+        self.turns.append(tokens)
+        return tokens
+
+    def stats(self) -> dict[str, float]:
+        injected, turns = self.injected or [0], self.turns or [0]
+        return {
+            "searches": len(self.injected),
+            "tokens_p50": np.percentile(injected, 50),
+            "tokens_max": max(injected),
+            "truncated": self.truncated,
+            "turns": len(self.turns),
+            "tokens_per_turn": np.mean(turns),
+        }
+
+
+async def start_memory_turn(callback_context):
+    """Count this invocation's memory searches toward its own turn, even when the
+    user has several sessions running at once."""
+    current_memory_invocation.set(callback_context.invocation_id)
+
+
+async def log_memory_tokens(callback_context):
+    """Log the memory tokens injected into the model calls of the finished turn."""
+    context = callback_context._invocation_context
+    if isinstance(context.memory_service, BudgetedMemoryService):
+        tokens = context.memory_service.end_turn(context.invocation_id)
+        memory_token_logger.info(
+            f"Turn {context.invocation_id}: {tokens} tokens injected"
+        )
+
+
+print("Token-budgeted memory retrieval defined.")
+
+# %%
+# An old long answer, an old fact and a newer one: the budget keeps the newer fact first
+# and cuts the long answer to the sentences about the query
+recency_memory_service = BM25MemoryService(top_k=20)
+now = time.time()
+for days_ago, author, text in [
+    (200, "user", "My favorite color is blue-green."),
+    (
+        200,
+        "model",
+        "Blue-green is a lovely color. It sits between blue and green on the color"
+        " wheel. Many people find it calm, like shallow sea water over sand. Here is a"
+        " haiku about it: Shallow sea at dawn, blue and green fold into one, quiet"
+        " light on sand.",
+    ),
+    (2, "user", "My favorite color is orange now, I repainted my room."),
+]:
+    recency_memory_service.add_texts(
+        app_name=APP_NAME,
+        user_id=USER_ID,
+        texts=[text],
+        author=author,
+        timestamp=now - days_ago * 86_400,
+    )
+
+for service in [
+    recency_memory_service,
+    BudgetedMemoryService(recency_memory_service, max_tokens=90, top_k=3),
+]:
+    response = await service.search_memory(
+        app_name=APP_NAME, user_id=USER_ID, query="What is my favorite color?"
+    )
+    print(f"{type(service).__name__}:")
+    for memory in response.memories:
+        print(f"  {memory.timestamp[:10]} [{memory.author}]: {memory_text(memory)}")
+
+# %%
+## Benchmark: Memory Tokens per Model Call
+# 20k memories of one user spread over the past year: three quarters are one-sentence
+# user messages, a quarter are model answers of 5-20 sentences. Compares what
+# preload_memory would inject from BM25MemoryService(top_k=5) with a 512-token budget
+# over its top 20: tokens per call, search latency, and how often a memory containing
+# every query word (the query's source) is still returned.
+
+
+def injected_tokens(memories: list[MemoryEntry]) -> int:
+    return sum(
+        estimate_tokens(f"Time: {m.timestamp}\n{m.author}: {memory_text(m)}\n")
+        for m in memories
+    )
+
+
+async def benchmark_memory_budget(
+    num_memories: int = 20_000, num_queries: int = 200, max_tokens: int = 512
+):
+    rng = np.random.default_rng(0)
+    sentences = synthetic_memories(num_memories * 4)
+    now = time.time()
+    raw = BM25MemoryService(top_k=5)
+    candidates = BM25MemoryService(top_k=20)
+    texts = []
+    for _ in range(num_memories):
+        length = 1 if rng.random() < 0.75 else int(rng.integers(5, 21))
+        text = " ".join(f"{next(sentences)}." for _ in range(length))
+        timestamp = now - rng.uniform(0, 365) * 86_400
+        for service in (raw, candidates):
+            service.add_texts(
+                app_name="bench", user_id="user", texts=[text], timestamp=timestamp
+            )
+        texts.append(text)
+    queries = []
+    for text in rng.choice(texts, num_queries):
+        sentence = str(rng.choice(SENTENCE_PATTERN.split(text)))
+        queries.append(" ".join(rng.choice(sentence.split(), 3, replace=False)))
+
+    print(
+        f"{'retrieval':>18} {'tokens p50':>11} {'p99':>6} {'max':>6}"
+        f" {'search p50 ms':>14} {'source kept':>12}"
+    )
+    for name, service in [
+        ("top 5", raw),
+        (
+            f"budget {max_tokens}",
+            BudgetedMemoryService(candidates, max_tokens=max_tokens),
+        ),
+    ]:
+        tokens, latencies, kept = [], [], 0
+        for query in queries:
+            start = time.perf_counter()
+            response = await service.search_memory(
+                app_name="bench", user_id="user", query=query
+            )
+            latencies.append(time.perf_counter() - start)
+            tokens.append(injected_tokens(response.memories))
+            terms = set(tokenize(query))
+            kept += any(
+                terms <= set(tokenize(memory_text(m))) for m in response.memories
+            )
+        print(
+            f"{name:>18} {np.percentile(tokens, 50):>11,.0f}"
+            f" {np.percentile(tokens, 99):>6,.0f} {max(tokens):>6,}"
+            f" {np.percentile(latencies, 50) * 1000:>14.2f}"
+            f" {kept / len(queries):>12.0%}"
+        )
+
+
+if RUN_BENCHMARKS:
+    await benchmark_memory_budget()
+
+# %%
+## Per-Tenant Memory with Quotas
+# When thousands of apps/users share one memory service, one heavy user should not
+# slow down everyone else's searches or use up the memory. TenantMemoryService keeps
+# an index per app/user (a tenant), split into segments of `segment_size` memories.
+# Only the newest segment takes writes; full segments are sealed and never change
+# size again, so searches read them without taking any lock. BM25 statistics are
+# summed over a tenant's segments, so scores match a single index. Each tenant has a
+# quota of `max_memories` (set_quota overrides it per tenant). Past it the tenant's
+# oldest memories are evicted, and a segment is dropped once all of it is evicted.
+# Tenants are created with dict.setdefault, and nothing is locked across tenants.
+
+
+class MemoryTenant:
+    """The memories of one app/user: index segments, quota and ingestion state.
+
+    `lock` guards the newest segment and ingestion. `segments` is replaced, never
+    changed in place, so a search can iterate the list it read without the lock.
+    """
+
+    def __init__(self, max_memories: int):
+        self.lock = threading.Lock()
+        self.segments = [MemoryPartition()]
+        self.max_memories = max_memories
+        self.live = 0  # Memories stored and not evicted
+        self.evicted = 0
+        self.evict_next = 0  # Next memory to evict in segments[0]
+        self.event_ids: set[str] = set()
+        self.watermarks: dict[str, tuple[int, str]] = {}
+
+    def add(self, records, segment_size: int) -> None:
+        """Index (text, role, author, timestamp) records, then apply the quota."""
+        for text, role, author, timestamp in records:
+            if len(self.segments[-1]) >= segment_size:
+                self.segments = [*self.segments, MemoryPartition()]
+            self.segments[-1].add(text, role, author, timestamp)
+            self.live += 1
+        self.evict()
+
+    def evict(self) -> None:
+        """Evict the oldest memories until the tenant is within its quota."""
+        while self.live > self.max_memories:
+            oldest = self.segments[0]
+            stop = min(len(oldest), self.evict_next + self.live - self.max_memories)
+            for memory_id in range(self.evict_next, stop):
+                oldest.retire(memory_id)
+            self.live -= stop - self.evict_next
+            self.evicted += stop - self.evict_next
+            self.evict_next = stop
+            if stop == len(oldest) and len(self.segments) > 1:
+                self.segments = self.segments[1:]
+                self.evict_next = 0
+
+    def usage(self) -> dict[str, int]:
+        return {
+            "memories": self.live,
+            "quota": self.max_memories,
+            "evicted": self.evicted,
+            "segments": len(self.segments),
+            "index_bytes": sum(s.index_bytes() for s in self.segments),
+        }
+
+
+class TenantMemoryService(BaseMemoryService):
+    """Memory service with an isolated, quota-bound BM25 index per app/user."""
+
+    def __init__(
+        self,
+        *,
+        max_memories: int = 10_000,
+        segment_size: int = 4_096,
+        top_k: int = 5,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        self.max_memories = max_memories
+        self.segment_size = segment_size
+        self.top_k = top_k
+        self.k1 = k1
+        self.b = b
+        self._tenants: dict[tuple[str, str], MemoryTenant] = {}
+        self._quotas: dict[tuple[str, str], int] = {}
+
+    def tenant(self, app_name: str, user_id: str) -> MemoryTenant:
+        key = (app_name, user_id)
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            # Racing creators agree on whichever tenant setdefault stored first
+            quota = self._quotas.get(key, self.max_memories)
+            tenant = self._tenants.setdefault(key, MemoryTenant(quota))
+        return tenant
+
+    def set_quota(self, app_name: str, user_id: str, max_memories: int) -> None:
+        """Give one tenant its own quota, evicting at once if it is now over it."""
+        self._quotas[(app_name, user_id)] = max_memories
+        tenant = self.tenant(app_name, user_id)
+        with tenant.lock:
+            tenant.max_memories = max_memories
+            tenant.evict()
+
+    def usage(self, app_name: str, user_id: str) -> dict[str, int]:
+        return self.tenant(app_name, user_id).usage()
+
+    async def add_session_to_memory(self, session: Session):
+        tenant = self.tenant(session.app_name, session.user_id)
+        with tenant.lock:
+            records = []
+            for event, text in new_memory_events(tenant, session):
+                tenant.event_ids.add(event.id)
+                records.append(
+                    (text, event.content.role, event.author, event.timestamp)
+                )
+            tenant.add(records, self.segment_size)
+
+    def add_texts(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        texts,
+        author: str = "user",
+        timestamp: float | None = None,
+    ) -> None:
+        """Index plain texts as memories of one tenant (bulk loading and benchmarks)."""
+        tenant = self.tenant(app_name, user_id)
+        timestamp = time.time() if timestamp is None else timestamp
+        with tenant.lock:
+            tenant.add(
+                ((text, "user", author, timestamp) for text in texts), self.segment_size
+            )
+
+    async def search_memory(
+        self, *, app_name: str, user_id: str, query: str
+    ) -> SearchMemoryResponse:
+        response = SearchMemoryResponse()
+        tenant = self._tenants.get((app_name, user_id))
+        terms = set(tokenize(query))
+        if tenant is None or not terms:
+            return response
+        segments = tenant.segments
+        count = sum(len(segment) for segment in segments)
+        total_length = sum(segment.total_length for segment in segments)
+        if not total_length:
+            return response
+        documents = {
+            term: sum(
+                len(segment.postings[term][0])
+                for segment in segments
+                if term in segment.postings
+            )
+            for term in terms
+        }
+        collection = (count, total_length / count, documents)
+
+        def best(segment):
+            return [
+                (score, segment, memory_id)
+                for memory_id, score in segment.top_k(
+                    terms, self.top_k, self.k1, self.b, collection
+                )
+            ]
+
+        hits = [hit for segment in segments[:-1] for hit in best(segment)]
+        with tenant.lock:  # The newest segment may still be growing
+            hits += best(segments[-1])
+            hits.sort(key=lambda hit: -hit[0])
+            found = [
+                (
+                    segment.texts[i],
+                    segment.roles[i],
+                    segment.authors[i],
+                    segment.timestamps[i],
+                )
+                for _, segment, i in hits[: self.top_k]
+            ]
+        for text, role, author, timestamp in found:
+            response.memories.append(
+                MemoryEntry(
+                    content=types.Content(role=role, parts=[types.Part(text=text)]),
+                    author=author,
+                    timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+                )
+            )
+        return response
+
+
+print("Tenant memory service defined.")
+
+# %%
+# A quota of 3 memories: the oldest events are evicted as the sessions are added
+tenant_memory_service = TenantMemoryService(max_memories=3, segment_size=2)
+await tenant_memory_service.add_session_to_memory(session)
+await tenant_memory_service.add_session_to_memory(birthday_session)
+print(tenant_memory_service.usage(APP_NAME, USER_ID))
+
+for query in ["What is my favorite color?", "When is my birthday?"]:
+    search_response = await tenant_memory_service.search_memory(
+        app_name=APP_NAME, user_id=USER_ID, query=query
+    )
+    print(f"{query} {len(search_response.memories)} memories")
+    for memory in search_response.memories:
+        print(f"  [{memory.author}]: {memory.content.parts[0].text[:80]}")
+
+# %%
+## Benchmark: Search Latency with a Heavy Tenant
+# 1,000 light tenants with 200 memories each share the service with one heavy tenant
+# that stores 500k. Searches arrive in batches of 64 concurrent ones, one in ten from
+# the heavy tenant, so light tenants wait behind heavy searches on the same event loop.
+# Compares BM25MemoryService (one unbounded index per user) with TenantMemoryService
+# under a 20k quota.
+
+
+async def benchmark_tenant_memory(
+    num_tenants: int = 1_000,
+    memories_per_tenant: int = 200,
+    heavy_memories: int = 500_000,
+    quota: int = 20_000,
+    num_batches: int = 50,
+    batch_size: int = 64,
+):
+    rng = np.random.default_rng(2)
+    light_texts = list(synthetic_memories(num_tenants * memories_per_tenant, seed=1))
+    light_queries = []
+    for t in range(num_tenants):
+        own = light_texts[t * memories_per_tenant : (t + 1) * memories_per_tenant]
+        words = str(rng.choice(own)).split()
+        light_queries.append(" ".join(rng.choice(words, 3, replace=False)))
+    heavy_queries = sample_queries(100, heavy_memories)
+    batches = [
+        [
+            (
+                ("heavy", heavy_queries[rng.integers(100)])
+                if rng.random() < 0.1
+                else (f"light-{t}", light_queries[t])
+            )
+            for t in rng.integers(num_tenants, size=batch_size)
+        ]
+        for _ in range(num_batches)
+    ]
+
+    print(
+        f"{'service':>22} {'index/s':>9} {'heavy MB':>9} {'heavy ms':>9}"
+        f" {'light p50 ms':>13} {'light p99 ms':>13}"
+    )
+    for name, service in [
+        ("BM25 (unbounded)", BM25MemoryService(top_k=10)),
+        (
+            f"Tenant (quota {quota // 1000}k)",
+            TenantMemoryService(max_memories=quota, top_k=10),
+        ),
+    ]:
+        for t in range(num_tenants):
+            service.add_texts(
+                app_name="bench",
+                user_id=f"light-{t}",
+                texts=light_texts[
+                    t * memories_per_tenant : (t + 1) * memories_per_tenant
+                ],
+            )
+        start = time.perf_counter()
+        service.add_texts(
+            app_name="bench", user_id="heavy", texts=synthetic_memories(heavy_memories)
+        )
+        rate = heavy_memories / (time.perf_counter() - start)
+        if isinstance(service, TenantMemoryService):
+            heavy_bytes = service.usage("bench", "heavy")["index_bytes"]
+        else:
+            heavy_bytes = service._partition("bench", "heavy").index_bytes()
+
+        heavy_latencies, light_waits = [], []
+
+        async def search(user_id, query, batch_start):
+            await asyncio.sleep(0)  # Queue behind the searches started before
+            start = time.perf_counter()
+            await service.search_memory(app_name="bench", user_id=user_id, query=query)
+            if user_id == "heavy":
+                heavy_latencies.append(time.perf_counter() - start)
+            else:  # From the batch's arrival, including the wait for other searches
+                light_waits.append(time.perf_counter() - batch_start)
+
+        for batch in batches:
+            batch_start = time.perf_counter()
+            await asyncio.gather(
+                *(search(user_id, query, batch_start) for user_id, query in batch)
+            )
+        print(
+            f"{name:>22} {rate:>9,.0f} {heavy_bytes / 1e6:>9.1f}"
+            f" {np.percentile(heavy_latencies, 50) * 1000:>9.2f}"
+            f" {np.percentile(light_waits, 50) * 1000:>13.2f}"
+            f" {np.percentile(light_waits, 99) * 1000:>13.2f}"
+        )
+        del service
+
+
+if RUN_BENCHMARKS:
+    await benchmark_tenant_memory()
+
 # %%
 # Agent with automatic memory saving
+# Each turn only queues the session for ingestion; a background task hands it to the
+# BM25 memory, which indexes just the events added since the session was last saved.
+# Memory searches are prefetched when the user's message arrives and cached per session
+# and what they inject is held to a token budget, logged per turn
 auto_memory_agent = LlmAgent(
     model=Gemini(model="gemini-2.5-flash-lite", retry_options=retry_config),
     name="AutoMemoryAgent",
     instruction="Answer user questions.",
-    tools=[preload_memory],
-    after_agent_callback=auto_save_to_memory,  # Save after each turn!
+    tools=[cached_preload_memory],
+    before_agent_callback=[prefetch_memory, start_memory_turn],
+    after_agent_callback=[
+        auto_save_to_memory_in_background,  # Save after each turn, in the background
+        log_memory_tokens,
+    ],
 )
 
 print("Agent created with automatic memory saving!")
@@ -226,7 +2594,7 @@ auto_runner = Runner(
     agent=auto_memory_agent,  # Use the agent with callback + preload_memory
     app_name=APP_NAME,
     session_service=session_service,  # Same services from Section 3
-    memory_service=memory_service,
+    memory_service=BudgetedMemoryService(PrefetchingMemoryService(bm25_memory_service)),
 )
 
 print("Runner created.")
@@ -240,6 +2608,9 @@ await run_session(
     "auto-save-test",
 )
 
+# Ingestion runs in the background; make sure the first conversation is in memory
+await memory_ingestors[auto_runner.memory_service].drain()
+
 # Test 2: Ask about the gift in a NEW session (second conversation)
 # The agent should retrieve the memory using perload_memory and answer correctly
 await run_session(
@@ -247,3 +2618,9 @@ await run_session(
     "Waht did I gift my nephew?",
     "auto-save-test-2",  # Different session ID - proves memory works across session!
 )
+
+# %%
+# Memory retrieval seen by the model calls of the two sessions above
+print(auto_runner.memory_service.memory_service.stats())
+print(auto_runner.memory_service.stats())
+print(memory_ingestors[auto_runner.memory_service].stats())
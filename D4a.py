@@ -11,6 +11,9 @@ from sqlalchemy.sql.coercions import TruncatedLabelImpl
 load_dotenv()
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 
+# The plugin overhead benchmark runs thousands of simulated turns; set RUN_BENCHMARKS=1 to run it
+RUN_BENCHMARKS = os.getenv("RUN_BENCHMARKS") == "1"
+
 print("Gemini API key setup complete.")
 
 # %%ฃ
@@ -90,6 +93,7 @@ print("----- EXAMPLE PLUGIN - DOES NOTHING -----")
 import logging
 from google.adk.agents.base_agent import BaseAgent
 from google.adk.agents.callback_context import CallbackContext
+from google.adk.agents.invocation_context import InvocationContext
 from google.adk.models.llm_request import LlmRequest
 from google.adk.plugins.base_plugin import BasePlugin
 
@@ -108,7 +112,7 @@ class CountInvocationPlugin(BasePlugin):
     async def before_agent_callback(
         self, *, agent: BaseAgent, callback_context: CallbackContext) -> None:
         """Count agent runs."""
-        self.agent_cont += 1
+        self.agent_count += 1
         logging.info(f"[Plugin] Agent run count: {self.agent_count}")
         
     # Callback 2: Runs before a model is called. You can add any custom logic here.
@@ -118,6 +122,242 @@ class CountInvocationPlugin(BasePlugin):
         
         logging.info(f"[Plugin] LLM request count: {self.llm_request_count}")
 
+# %%
+## Metrics in Production
+# Logs show what happened in one run; metrics show how every run behaves over time.
+# MetricsPlugin records the latency of each agent run, model call and tool call in
+# histograms labelled by agent, model and tool, counts the tokens of each model call
+# and the errors of models and tools. serve() publishes them in the Prometheus text
+# format on a local HTTP endpoint, ready to be scraped.
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+from google.adk.models.llm_response import LlmResponse
+from google.adk.tools.base_tool import BaseTool
+from google.adk.tools.tool_context import ToolContext
+
+# Latency buckets in seconds, from fast tools up to long multi-agent runs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Bucket counts, sum and count of the values observed for one set of labels."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    """Prometheus label set, with backslashes, quotes and newlines escaped."""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class MetricsPlugin(BasePlugin):
+    """A plugin that keeps latency histograms and counters for agents, models and tools."""
+
+    # Metric name -> (type, help text, label names)
+    METRICS = {
+        "adk_agent_duration_seconds": ("histogram", "Agent run latency.", ("agent",)),
+        "adk_model_duration_seconds": ("histogram", "Model call latency.", ("agent", "model")),
+        "adk_tool_duration_seconds": ("histogram", "Tool call latency.", ("agent", "tool")),
+        "adk_model_tokens_total": ("counter", "Tokens of model calls.", ("agent", "model", "type")),
+        "adk_model_errors_total": ("counter", "Failed model calls.", ("agent", "model", "error")),
+        "adk_tool_errors_total": ("counter", "Failed tool calls.", ("agent", "tool", "error")),
+    }
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS, stale_after: float = 600.0) -> None:
+        """Initialize the plugin with empty metrics."""
+        super().__init__(name = "metrics")
+        self.buckets = buckets
+        # Seconds after which a call that never finished is dropped from _started
+        self.stale_after = stale_after
+        self.series: Dict[str, Dict[tuple, Any]] = {name: {} for name in self.METRICS}
+        # Calls in flight: (kind, invocation id, agent or tool call) -> (start, model)
+        self._started: Dict[tuple, Tuple[float, Optional[str]]] = {}
+        # Held briefly by every update, so scrapes from the server thread see whole values
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        with self._lock:
+            histogram = self.series[name].get(labels)
+            if histogram is None:
+                histogram = self.series[name][labels] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name: str, labels: tuple, amount: int = 1) -> None:
+        with self._lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + amount
+
+    def _elapsed(self, key: tuple) -> Tuple[Optional[float], Optional[str]]:
+        start, model = self._started.pop(key, (None, None))
+        return (None if start is None else time.perf_counter() - start), model
+
+    # Runs: calls of a finished or aborted run never close, so their entries are dropped
+    async def before_run_callback(self, *, invocation_context: InvocationContext) -> None:
+        cutoff = time.perf_counter() - self.stale_after
+        for key in [key for key, (start, _) in self._started.items() if start < cutoff]:
+            del self._started[key]
+
+    async def after_run_callback(self, *, invocation_context: InvocationContext) -> None:
+        invocation_id = invocation_context.invocation_id
+        for key in [key for key in self._started if key[1] == invocation_id]:
+            del self._started[key]
+
+    # Agents: timed from before_agent_callback to after_agent_callback
+    async def before_agent_callback(
+        self, *, agent: BaseAgent, callback_context: CallbackContext) -> None:
+        key = ("agent", callback_context.invocation_id, agent.name)
+        self._started[key] = (time.perf_counter(), None)
+
+    async def after_agent_callback(
+        self, *, agent: BaseAgent, callback_context: CallbackContext) -> None:
+        elapsed, _ = self._elapsed(("agent", callback_context.invocation_id, agent.name))
+        if elapsed is not None:
+            self.observe("adk_agent_duration_seconds", (agent.name,), elapsed)
+
+    # Models: an agent waits for one model call at a time
+    async def before_model_callback(
+        self, *, callback_context: CallbackContext, llm_request: LlmRequest) -> None:
+        key = ("model", callback_context.invocation_id, callback_context.agent_name)
+        self._started[key] = (time.perf_counter(), llm_request.model)
+
+    async def after_model_callback(
+        self, *, callback_context: CallbackContext, llm_response: LlmResponse) -> None:
+        if llm_response.partial: # Streamed chunks; the final response closes the call
+            return
+        agent = callback_context.agent_name
+        elapsed, model = self._elapsed(("model", callback_context.invocation_id, agent))
+        model = model or llm_response.model_version or "unknown"
+        if elapsed is not None:
+            self.observe("adk_model_duration_seconds", (agent, model), elapsed)
+        usage = llm_response.usage_metadata
+        if usage:
+            for kind, tokens in [
+                ("prompt", usage.prompt_token_count),
+                ("output", usage.candidates_token_count),
+                ("thoughts", usage.thoughts_token_count),
+                ("cached", usage.cached_content_token_count),
+            ]:
+                if tokens:
+                    self.increment("adk_model_tokens_total", (agent, model, kind), tokens)
+
+    async def on_model_error_callback(
+        self, *, callback_context: CallbackContext, llm_request: LlmRequest, error: Exception) -> None:
+        agent = callback_context.agent_name
+        elapsed, model = self._elapsed(("model", callback_context.invocation_id, agent))
+        model = model or llm_request.model or "unknown"
+        if elapsed is not None:
+            self.observe("adk_model_duration_seconds", (agent, model), elapsed)
+        self.increment("adk_model_errors_total", (agent, model, type(error).__name__))
+
+    # Tools: parallel calls are told apart by their function call id
+    async def before_tool_callback(
+        self, *, tool: BaseTool, tool_args: Dict[str, Any], tool_context: ToolContext) -> None:
+        key = ("tool", tool_context.invocation_id, tool_context.function_call_id, tool.name)
+        self._started[key] = (time.perf_counter(), None)
+
+    async def after_tool_callback(
+        self, *, tool: BaseTool, tool_args: Dict[str, Any], tool_context: ToolContext, result: dict) -> None:
+        key = ("tool", tool_context.invocation_id, tool_context.function_call_id, tool.name)
+        elapsed, _ = self._elapsed(key)
+        if elapsed is not None:
+            self.observe("adk_tool_duration_seconds", (tool_context.agent_name, tool.name), elapsed)
+
+    async def on_tool_error_callback(
+        self, *, tool: BaseTool, tool_args: Dict[str, Any], tool_context: ToolContext, error: Exception) -> None:
+        key = ("tool", tool_context.invocation_id, tool_context.function_call_id, tool.name)
+        elapsed, _ = self._elapsed(key)
+        labels = (tool_context.agent_name, tool.name)
+        if elapsed is not None:
+            self.observe("adk_tool_duration_seconds", labels, elapsed)
+        self.increment("adk_tool_errors_total", (*labels, type(error).__name__))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock: # Copy, then format without holding up the callbacks
+            snapshot = {
+                name: [
+                    (labels, (list(value.counts), value.sum, value.count) if isinstance(value, Histogram) else value)
+                    for labels, value in series.items()
+                ]
+                for name, series in self.series.items()
+            }
+        lines = []
+        for name, (kind, help_text, label_names) in self.METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in snapshot[name]:
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                    cumulative += bucket_count
+                    bucket_labels = format_labels((*label_names, "le"), (*labels, bound))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(label_names, labels)} {total}")
+                lines.append(f"{name}_count{format_labels(label_names, labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1") -> str:
+        """Serve render() at /metrics from a background thread and return its URL."""
+        plugin = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = plugin.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass # Keep scrapes out of logger.log
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target = self._server.serve_forever, daemon = True).start()
+        return f"http://{host}:{self._server.server_port}/metrics"
+
+    def stop(self) -> None:
+        """Shut down the metrics endpoint."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+if "metrics_plugin" in globals(): # Re-running this cell: free port 9464 first
+    metrics_plugin.stop()
+
+metrics_plugin = MetricsPlugin()
+metrics_url = metrics_plugin.serve()
+
+print(f"Metrics plugin serving {metrics_url}")
+
 # %%
 from google.adk.agents import LlmAgent
 from google.adk.models.google_llm import Gemini
@@ -176,7 +416,8 @@ import asyncio
 runner = InMemoryRunner(
     agent = research_agent_with_plugin,
     plugins = [
-        LoggingPlugin()
+        LoggingPlugin(),
+        metrics_plugin, # Latency and token metrics, served at metrics_url
     ], # <---- 2. Add the plugin. Handles standard Observability logging across ALL agents
 )
 
@@ -187,3 +428,84 @@ print("Running agent with LoggingPlugin...")
 print("Watch the comprehensive logging output below:\n")
 
 reponse = await runner.run_debug("Find recent papers on quatum computing")
+
+# %%
+# Scrape the metrics endpoint the way Prometheus would
+!curl -s {metrics_url}
+
+# %%
+## Benchmark: Plugin Callback Overhead
+# Every callback of a plugin runs inline on each agent turn, so its cost adds to every
+# request. Replays a typical turn (one agent run, two model calls and one tool call:
+# eight callbacks) against a do-nothing plugin, CountInvocationPlugin (which logs every
+# count) and MetricsPlugin, with and without a scraper reading the endpoint in a loop.
+import urllib.request
+
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.sessions import InMemorySessionService, Session
+from google.adk.tools.function_tool import FunctionTool
+
+
+async def replay_turns(plugin: BasePlugin, turns: int) -> float:
+    """Seconds spent in the plugin's callbacks over `turns` turns."""
+    session = Session(id = "bench", app_name = "bench", user_id = "bench")
+    tool = FunctionTool(count_papers)
+    llm_request = LlmRequest(model = "gemini-2.5-flash-lite")
+    llm_response = LlmResponse(
+        content = types.Content(role = "model", parts = [types.Part(text = "Found 5 papers.")]),
+        usage_metadata = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count = 1200, candidates_token_count = 80),
+    )
+    contexts = []
+    for turn in range(turns):
+        context = InvocationContext(
+            session_service = InMemorySessionService(),
+            invocation_id = f"inv-{turn}",
+            agent = research_agent_with_plugin,
+            session = session,
+        )
+        contexts.append((CallbackContext(context), ToolContext(context, function_call_id = f"call-{turn}")))
+    start = time.perf_counter()
+    for callback_context, tool_context in contexts:
+        await plugin.before_agent_callback(agent = research_agent_with_plugin, callback_context = callback_context)
+        for _ in range(2):
+            await plugin.before_model_callback(callback_context = callback_context, llm_request = llm_request)
+            await plugin.after_model_callback(callback_context = callback_context, llm_response = llm_response)
+        await plugin.before_tool_callback(tool = tool, tool_args = {}, tool_context = tool_context)
+        await plugin.after_tool_callback(tool = tool, tool_args = {}, tool_context = tool_context, result = {"result": 5})
+        await plugin.after_agent_callback(agent = research_agent_with_plugin, callback_context = callback_context)
+    return time.perf_counter() - start
+
+
+async def benchmark_plugin_overhead(turns: int = 20_000, repeats: int = 5):
+    # Awaiting the callbacks costs something even when they do nothing
+    baseline = min([await replay_turns(BasePlugin(name = "noop"), turns) for _ in range(repeats)])
+    print(f"{'plugin':>26} {'µs/turn':>8} {'µs/callback':>12}")
+    for name, plugin, scrape in [
+        ("CountInvocationPlugin", CountInvocationPlugin(), False),
+        ("MetricsPlugin", MetricsPlugin(), False),
+        ("MetricsPlugin + scraping", MetricsPlugin(), True),
+    ]:
+        scraping = threading.Event()
+        if scrape:
+            url = plugin.serve(port = 0) # Any free port
+            scraping.set()
+
+            def scraper():
+                while scraping.is_set():
+                    urllib.request.urlopen(url).read()
+
+            scraper_thread = threading.Thread(target = scraper, daemon = True)
+            scraper_thread.start()
+        seconds = min([await replay_turns(plugin, turns) for _ in range(repeats)])
+        scraping.clear()
+        if scrape:
+            # Let the last request finish before the port closes
+            scraper_thread.join()
+            plugin.stop()
+        overhead = (seconds - baseline) / turns * 1e6
+        print(f"{name:>26} {overhead:>8.1f} {overhead / 8:>12.2f}")
+
+
+if RUN_BENCHMARKS:
+    await benchmark_plugin_overhead()
@@ -0,0 +1,1715 @@
+"""Session storage used by the D3a notebook, importable by worker processes.
+
+The notebook has top-level `await`s and calls Gemini, so worker processes can't import
+it. The session services it benchmarks live here instead:
+
+- CompactEventCodec and LazyEvent: msgpack + zstd event payloads, decoded on first read.
+- FastInMemorySessionService and FastDatabaseSessionService: single-probe
+  get_or_create_session, tuned SQLite, write-behind batching, windowed loading, event
+  queries and compaction bookkeeping.
+- ShardedSessionService: users spread over several databases by consistent hashing.
+"""
+
+import asyncio
+import bisect
+import copy
+import hashlib
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Any, Iterator, NamedTuple
+
+import msgpack
+import zstandard
+from google.adk.events import Event, EventActions
+from google.adk.sessions import (
+    BaseSessionService,
+    DatabaseSessionService,
+    InMemorySessionService,
+    Session,
+    _session_util,
+)
+from google.adk.sessions.base_session_service import (
+    GetSessionConfig,
+    ListSessionsResponse,
+)
+from google.adk.sessions.database_session_service import (
+    StorageAppState,
+    StorageEvent,
+    StorageSession,
+    StorageUserState,
+    _merge_state,
+)
+from google.genai import types
+from sqlalchemy import (
+    Column,
+    Float,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    and_,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
+
+# Compact event encoding
+# Stored as plain columns so events can be listed/filtered without decoding the payload
+EVENT_HEADER_FIELDS = ("id", "invocation_id", "author", "timestamp")
+
+compact_metadata = MetaData()
+compact_events_table = Table(
+    "compact_events",
+    compact_metadata,
+    Column("app_name", String(128), primary_key=True),
+    Column("user_id", String(128), primary_key=True),
+    Column("session_id", String(128), primary_key=True),
+    Column("id", String(128), primary_key=True),
+    Column("invocation_id", String(256)),
+    Column("author", String(256)),
+    Column("timestamp", Float, nullable=False),
+    Column("dictionary_id", Integer, nullable=False, default=0),  # 0 = no dictionary
+    Column("payload", LargeBinary, nullable=False),
+    Index(
+        "ix_compact_events_session_time",
+        "app_name",
+        "user_id",
+        "session_id",
+        "timestamp",
+    ),
+    Index("ix_compact_events_user_time", "app_name", "user_id", "timestamp"),
+    Index("ix_compact_events_author_time", "app_name", "author", "timestamp"),
+    Index("ix_compact_events_app_time", "app_name", "timestamp"),
+)
+event_dictionaries_table = Table(
+    "event_dictionaries",
+    compact_metadata,
+    Column("app_name", String(128), primary_key=True),
+    Column("user_id", String(128), primary_key=True),
+    Column("session_id", String(128), primary_key=True),
+    Column("dictionary", LargeBinary, nullable=False),
+)
+
+
+class CompactEventCodec:
+    """msgpack + zstd encoding of event payloads with per-session trained dictionaries.
+
+    Args:
+        level: zstd compression level.
+        dictionary_size: Maximum size in bytes of a trained dictionary.
+        train_after: Train a session's dictionary once it has this many events.
+    """
+
+    def __init__(
+        self, level: int = 3, dictionary_size: int = 16 * 1024, train_after: int = 64
+    ):
+        self.level = level
+        self.dictionary_size = dictionary_size
+        self.train_after = train_after
+        self._compression_dicts: dict[bytes, zstandard.ZstdCompressionDict] = {}
+
+    def _dict(self, dictionary: bytes) -> zstandard.ZstdCompressionDict:
+        if dictionary not in self._compression_dicts:
+            self._compression_dicts[dictionary] = zstandard.ZstdCompressionDict(
+                dictionary
+            )
+        return self._compression_dicts[dictionary]
+
+    def pack(self, event: Event) -> bytes:
+        """msgpack the event body (everything except the header columns)."""
+        body = event.model_dump(
+            mode="json",
+            exclude_none=True,
+            exclude_defaults=True,
+            exclude=set(EVENT_HEADER_FIELDS),
+        )
+        return msgpack.packb(body)
+
+    def compress(self, packed: bytes, dictionary: bytes | None = None) -> bytes:
+        if dictionary:
+            return zstandard.ZstdCompressor(
+                level=self.level, dict_data=self._dict(dictionary)
+            ).compress(packed)
+        return zstandard.ZstdCompressor(level=self.level).compress(packed)
+
+    def decompress_raw(self, payload: bytes) -> bytes:
+        """Undo dictionary-less compression (used to re-sample events for training)."""
+        return zstandard.ZstdDecompressor().decompress(payload)
+
+    def decode_body(
+        self, payload: bytes, dictionary: bytes | None = None
+    ) -> dict[str, Any]:
+        if dictionary:
+            decompressor = zstandard.ZstdDecompressor(dict_data=self._dict(dictionary))
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        return msgpack.unpackb(decompressor.decompress(payload))
+
+    def train(self, packed_samples: list[bytes]) -> bytes | None:
+        """Train a dictionary from packed events, or None if there isn't enough to
+        learn from."""
+        try:
+            return zstandard.train_dictionary(
+                self.dictionary_size, packed_samples
+            ).as_bytes()
+        except zstandard.ZstdError:
+            return None
+
+
+class LazyEvent(Event):
+    """An Event whose body is only decoded the first time one of its fields is read.
+
+    Header fields (id, invocation_id, author, timestamp) are available immediately.
+    Note: pydantic serialization reads fields directly, so call `materialize()`
+    before dumping a session that holds lazy events.
+    """
+
+    @classmethod
+    def from_row(
+        cls, row, codec: CompactEventCodec, dictionary: bytes | None
+    ) -> "LazyEvent":
+        event = cls.model_construct(
+            **{name: getattr(row, name) for name in EVENT_HEADER_FIELDS}
+        )
+        for name in cls.model_fields:
+            if name not in EVENT_HEADER_FIELDS:
+                event.__dict__.pop(name, None)
+        event.__dict__["_compact"] = (
+            row.payload,
+            dictionary if row.dictionary_id else None,
+            codec,
+        )
+        return event
+
+    def materialize(self) -> Event:
+        """Decode (if needed) and return a plain Event."""
+        self._decode()
+        return Event.model_validate(
+            {name: getattr(self, name) for name in Event.model_fields}
+        )
+
+    def _decode(self) -> None:
+        compact = self.__dict__.pop("_compact", None)
+        if compact is None:
+            return
+        payload, dictionary, codec = compact
+        header = {name: self.__dict__[name] for name in EVENT_HEADER_FIELDS}
+        decoded = Event.model_validate(
+            {**codec.decode_body(payload, dictionary), **header}
+        )
+        for name in Event.model_fields:
+            if name not in EVENT_HEADER_FIELDS:
+                self.__dict__[name] = decoded.__dict__[name]
+
+    def __deepcopy__(self, memo=None):
+        # ADK deep-copies events; the codec's zstd dictionary can't be copied, the
+        # decoded fields can
+        self._decode()
+        return super().__deepcopy__(memo)
+
+    def __getattr__(self, name: str):
+        if "_compact" in self.__dict__ and name in Event.model_fields:
+            self._decode()
+            return self.__dict__[name]
+        return super().__getattr__(name)
+
+
+# Fast session services
+# Creating a session that already exists raises, so "try create, except get" pays for
+# a failed lookup + exception + a second lookup on every turn. These services
+# resolve both cases with a single operation instead.
+class FastInMemorySessionService(InMemorySessionService):
+    """InMemorySessionService with a single-probe get_or_create_session."""
+
+    async def get_or_create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        state: dict[str, Any] | None = None,
+    ) -> Session:
+        """Return the session, creating it with `state` if it doesn't exist yet."""
+        session = self.sessions.get(app_name, {}).get(user_id, {}).get(session_id)
+        if session is None:
+            return self._create_session_impl(
+                app_name=app_name, user_id=user_id, state=state, session_id=session_id
+            )
+        return self._merge_state(app_name, user_id, copy.deepcopy(session))
+
+
+def tune_sqlite_connection(dbapi_connection, connection_record):
+    """Per-connection PRAGMAs for many concurrent readers and frequent small writes."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # Readers no longer block the writer
+    # fsync at checkpoints, not every commit
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Wait for the write lock instead of failing
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped reads
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+    # Let the service's "begin" hook issue BEGIN itself
+    dbapi_connection.isolation_level = None
+
+
+# True inside a service method that only reads: its transactions begin as WAL snapshots
+read_only_transactions: ContextVar[bool] = ContextVar(
+    "read_only_transactions", default=False
+)
+
+
+def storage_event_to_event(storage_event: StorageEvent) -> Event:
+    """StorageEvent.to_event(), with actions re-validated.
+
+    to_event() copies actions without validation, which leaves nested models such
+    as `actions.compaction` as plain dicts.
+    """
+    event = storage_event.to_event()
+    event.actions = EventActions.model_validate(
+        event.actions.model_dump(warnings=False)
+    )
+    return event
+
+
+class WindowedSessionConfig(GetSessionConfig):
+    """GetSessionConfig that can also skip history already covered by a compaction
+    summary."""
+
+    since_last_compaction: bool = False
+    """Only load events from the start of the newest compaction's range onwards: the
+    summary, the events it overlaps, and everything after it."""
+
+
+# ADK's events primary key starts with the event id, so any lookup by session, user,
+# author or time scans the table. Each index below serves one query_events() filter
+# shape (plus per-session windows and paging) with rows already in timestamp order.
+EVENT_QUERY_INDEXES = [
+    Index(
+        "ix_events_session_time",
+        StorageEvent.app_name,
+        StorageEvent.user_id,
+        StorageEvent.session_id,
+        StorageEvent.timestamp,
+    ),
+    Index(
+        "ix_events_user_time",
+        StorageEvent.app_name,
+        StorageEvent.user_id,
+        StorageEvent.timestamp,
+    ),
+    Index(
+        "ix_events_author_time",
+        StorageEvent.app_name,
+        StorageEvent.author,
+        StorageEvent.timestamp,
+    ),
+    Index("ix_events_app_time", StorageEvent.app_name, StorageEvent.timestamp),
+]
+
+
+# One row per session being compacted. Workers in any process take a session by
+# inserting/claiming its row, so two summarizers never work on the same session.
+compaction_leases_table = Table(
+    "compaction_leases",
+    compact_metadata,
+    Column("app_name", String(128), primary_key=True),
+    Column("user_id", String(128), primary_key=True),
+    Column("session_id", String(128), primary_key=True),
+    Column("owner", String(128), nullable=False),
+    Column("expires_at", Float, nullable=False),
+)
+
+
+# Running estimate of how many tokens each session would put in the model's context:
+# summaries plus every event not yet covered by one. Kept current on every append
+# and compaction, so deciding whether to compact never loads the session.
+session_token_counts_table = Table(
+    "session_token_counts",
+    compact_metadata,
+    Column("app_name", String(128), primary_key=True),
+    Column("user_id", String(128), primary_key=True),
+    Column("session_id", String(128), primary_key=True),
+    Column("live_tokens", Integer, nullable=False, default=0),
+)
+
+
+def estimate_content_tokens(content: types.Content | None) -> int:
+    """Rough token count (~4 characters per token), cheap enough to run on every
+    append."""
+    if not content or not content.parts:
+        return 0
+    characters = 0
+    for part in content.parts:
+        if part.text:
+            characters += len(part.text)
+        elif part.function_call:
+            characters += len(part.function_call.name or "") + len(
+                json.dumps(part.function_call.args or {}, default=str)
+            )
+        elif part.function_response:
+            characters += len(
+                json.dumps(part.function_response.response or {}, default=str)
+            )
+    return characters // 4 + 4  # Plus per-message overhead
+
+
+def estimate_event_tokens(event: Event) -> int:
+    if event.actions and event.actions.compaction:
+        return estimate_content_tokens(event.actions.compaction.compacted_content)
+    if event.usage_metadata and event.usage_metadata.candidates_token_count:
+        return event.usage_metadata.candidates_token_count  # The model's own count
+    return estimate_content_tokens(event.content)
+
+
+def compaction_token_delta(events: list[Event], compaction_event: Event) -> int:
+    """How a session's live tokens change when `compaction_event` is added to `events`:
+    its summary comes in, and the events it covers that no earlier summary did go out.
+    """
+    previous_end = max(
+        (
+            event.actions.compaction.end_timestamp
+            for event in events
+            if event.actions and event.actions.compaction
+        ),
+        default=0.0,
+    )
+    end = compaction_event.actions.compaction.end_timestamp
+    covered = sum(
+        estimate_event_tokens(event)
+        for event in events
+        if not (event.actions and event.actions.compaction)
+        and previous_end < event.timestamp <= end
+    )
+    return estimate_event_tokens(compaction_event) - covered
+
+
+# Where each of a session's summaries starts and ends, keyed so the newest one is a
+# single index probe. Context assembly jumps straight to it instead of scanning events.
+compaction_checkpoints_table = Table(
+    "compaction_checkpoints",
+    compact_metadata,
+    Column("app_name", String(128), primary_key=True),
+    Column("user_id", String(128), primary_key=True),
+    Column("session_id", String(128), primary_key=True),
+    Column("end_timestamp", Float, primary_key=True),
+    Column("start_timestamp", Float, nullable=False),
+    Column("event_id", String(128), nullable=False),
+)
+
+
+class EventRecord(NamedTuple):
+    """One row from query_events(). `content` is only filled in with
+    include_content=True."""
+
+    app_name: str
+    user_id: str
+    session_id: str
+    id: str
+    invocation_id: str
+    author: str
+    timestamp: float
+    content: dict[str, Any] | None
+
+
+class FastDatabaseSessionService(DatabaseSessionService):
+    """DatabaseSessionService with get-or-create, SQLite tuning, write-behind batching
+    and optional compact event encoding.
+
+    Args:
+        db_url: Database URL, e.g. "sqlite:///my_agent_data.db".
+        tune_sqlite: Use WAL mode, a connection pool sized for one connection per
+            worker thread and a larger prepared-statement cache (SQLite only).
+        write_behind: Buffer appended events and group-commit them across sessions.
+        flush_interval: Durability window - the longest an appended event can stay
+            buffered before it is committed.
+        max_batch_size: Flush early once this many events are buffered.
+        event_codec: Store new events in the compact (msgpack + zstd) table instead of
+            as JSON rows. Existing JSON events keep loading; see migrate_event_encoding.
+        lazy_decode: With event_codec, return LazyEvents that decode on first access.
+        default_config: Config used when get_session is called without one (e.g. by
+            the Runner), such as WindowedSessionConfig(since_last_compaction=True).
+        count_tokens: Keep a per-session running token count (see session_token_count),
+            updated in the same transaction as each append.
+        state_cache_size: Keep up to this many `app:`/`user:` states in a write-through
+            LRU cache shared by every session of that app/user (0 = off). Changes are
+            written back with the next commit (the next group commit with write_behind).
+            Assumes this service is the only writer of those states.
+    """
+
+    def __init__(
+        self,
+        db_url: str,
+        *,
+        tune_sqlite: bool = False,
+        write_behind: bool = False,
+        flush_interval: float = 0.05,
+        max_batch_size: int = 500,
+        event_codec: CompactEventCodec | None = None,
+        lazy_decode: bool = True,
+        default_config: GetSessionConfig | None = None,
+        count_tokens: bool = False,
+        state_cache_size: int = 0,
+        **kwargs: Any,
+    ):
+        is_sqlite = db_url.startswith("sqlite")
+        if tune_sqlite and is_sqlite:
+            # Keep enough pooled connections that every worker thread checks out its own
+            kwargs.setdefault("poolclass", QueuePool)
+            kwargs.setdefault("pool_size", 32)
+            kwargs.setdefault("max_overflow", 128)
+            connect_args = kwargs.setdefault("connect_args", {})
+            connect_args.setdefault("check_same_thread", False)
+            # Prepared statements kept per connection
+            connect_args.setdefault("cached_statements", 512)
+        super().__init__(db_url=db_url, **kwargs)
+        if tune_sqlite and is_sqlite:
+            # Tables were created on an untuned connection - drop it so every connection
+            # is tuned
+            self.db_engine.dispose()
+            sqlalchemy_event.listen(self.db_engine, "connect", tune_sqlite_connection)
+            # SQLite allows a single writer. Queue transactions on a Python lock rather
+            # than SQLite's sleep-and-retry busy handler, which starves threads under
+            # contention.
+            self._write_lock = threading.Lock()
+            sqlalchemy_event.listen(self.db_engine, "begin", self._begin_immediate)
+            sqlalchemy_event.listen(self.db_engine, "commit", self._release_write_lock)
+            sqlalchemy_event.listen(
+                self.db_engine, "rollback", self._release_write_lock
+            )
+
+        compact_metadata.create_all(self.db_engine)
+        # create_all() skips existing tables, so indexes added later need their own pass
+        for index in [*EVENT_QUERY_INDEXES, *compact_events_table.indexes]:
+            index.create(self.db_engine, checkfirst=True)
+        self.default_config = default_config
+        self.count_tokens = count_tokens
+        self.state_cache_size = state_cache_size
+        self._state_cache: OrderedDict[tuple[str, ...], dict[str, Any]] = OrderedDict()
+        self._dirty_state: set[tuple[str, ...]] = set()
+        self._state_lock = threading.Lock()
+        self.event_codec = event_codec
+        self.lazy_decode = lazy_decode
+        self._dictionaries: dict[tuple[str, str, str], bytes | None] = {}
+        self._untrained_counts: dict[tuple[str, str, str], int] = {}
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._buffer: list[tuple[tuple[str, str, str], Event, dict[str, Any], int]] = []
+        self._buffer_condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        if write_behind:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+
+    def _begin_immediate(self, connection):
+        """Take the write lock up front. Under WAL, a read transaction that later writes
+        fails instead of waiting if another writer committed in between."""
+        if connection.info.get("read_only") or read_only_transactions.get():
+            connection.exec_driver_sql("BEGIN")  # A WAL snapshot: never blocks writers
+            return
+        self._write_lock.acquire()
+        connection.info["holds_write_lock"] = True
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def _release_write_lock(self, connection):
+        if connection.info.pop("holds_write_lock", False):
+            self._write_lock.release()
+
+    @contextmanager
+    def _reading(self):
+        """Transactions begun inside only read, so they skip the write lock and BEGIN
+        IMMEDIATE."""
+        token = read_only_transactions.set(True)
+        try:
+            yield
+        finally:
+            read_only_transactions.reset(token)
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        is_compaction = bool(event.actions and event.actions.compaction)
+        if (
+            not self.write_behind
+            and not self.event_codec
+            and not self.count_tokens
+            and not self.state_cache_size
+            and not is_compaction
+        ):
+            return await super().append_event(session, event)
+        if event.partial:
+            return event
+
+        event = self._trim_temp_delta_state(event)
+        tokens = 0
+        if self.count_tokens:
+            if is_compaction:
+                tokens = compaction_token_delta(session.events, event)
+            else:
+                tokens = estimate_event_tokens(event)
+        await BaseSessionService.append_event(self, session=session, event=event)
+        session.last_update_time = event.timestamp
+        state_delta = dict(event.actions.state_delta) if event.actions else {}
+        if self.state_cache_size:
+            # Share app:/user: changes with every session now; they're written back with
+            # the next commit
+            deltas = _session_util.extract_state_delta(state_delta)
+            if deltas["app"] or deltas["user"]:
+                with self.database_session_factory() as sql_session:
+                    if deltas["app"]:
+                        self._apply_scoped_delta(
+                            sql_session, ("app", session.app_name), deltas["app"]
+                        )
+                    if deltas["user"]:
+                        self._apply_scoped_delta(
+                            sql_session,
+                            ("user", session.app_name, session.user_id),
+                            deltas["user"],
+                        )
+        item = (
+            (session.app_name, session.user_id, session.id),
+            event,
+            state_delta,
+            tokens,
+        )
+        if not self.write_behind:
+            # Match the stored update_time, so a later append through ADK's path isn't
+            # seen as stale
+            session.last_update_time = self._write_batch([item])
+            return event
+
+        # Persist with the next group commit
+        with self._buffer_condition:
+            self._buffer.append(item)
+            if len(self._buffer) >= self.max_batch_size:
+                self._buffer_condition.notify()
+        return event
+
+    def flush(self) -> int:
+        """Commit every buffered event in one transaction. Returns the number of
+        events written."""
+        with self._flush_lock:
+            with self._buffer_condition:
+                batch, self._buffer = self._buffer, []
+            if batch or self._dirty_state:
+                self._write_batch(batch)
+            return len(batch)
+
+    def close(self) -> None:
+        """Flush outstanding events and stop the background flusher."""
+        if self.write_behind and not self._closed:
+            self._closed = True
+            with self._buffer_condition:
+                self._buffer_condition.notify()
+            self._flusher.join()
+        self.flush()
+
+    def _flush_loop(self) -> None:
+        while not self._closed:
+            with self._buffer_condition:
+                if len(self._buffer) < self.max_batch_size:
+                    self._buffer_condition.wait(timeout=self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Write-behind flush failed")
+
+    def _write_batch(
+        self, batch: list[tuple[tuple[str, str, str], Event, dict[str, Any], int]]
+    ) -> float:
+        """Apply many sessions' state deltas and insert their events in a single commit.
+
+        Returns the update_time written to the sessions, as a timestamp.
+        """
+        app_deltas, user_deltas, session_deltas, token_deltas = {}, {}, {}, {}
+        events_by_session: dict[tuple[str, str, str], list[Event]] = {}
+        for key, event, state_delta, tokens in batch:
+            events_by_session.setdefault(key, []).append(event)
+            token_deltas[key] = token_deltas.get(key, 0) + tokens
+            deltas = _session_util.extract_state_delta(state_delta)
+            app_deltas.setdefault(key[0], {}).update(deltas["app"])
+            user_deltas.setdefault(key[:2], {}).update(deltas["user"])
+            session_deltas.setdefault(key, {}).update(deltas["session"])
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with self.database_session_factory() as sql_session:
+            live_sessions = set()
+            for key, delta in session_deltas.items():
+                storage_session = sql_session.get(StorageSession, key)
+                if storage_session is None:
+                    continue  # Deleted while its events were buffered
+                live_sessions.add(key)
+                storage_session.state = storage_session.state | delta
+                storage_session.update_time = now
+            if (
+                not self.state_cache_size
+            ):  # Otherwise already in the cache (see append_event)
+                for app_name, delta in app_deltas.items():
+                    if delta:
+                        self._apply_scoped_delta(sql_session, ("app", app_name), delta)
+                for user_key, delta in user_deltas.items():
+                    if delta:
+                        self._apply_scoped_delta(
+                            sql_session, ("user", *user_key), delta
+                        )
+            self._write_dirty_state(sql_session)
+            if self.count_tokens:
+                for key in live_sessions:
+                    self._add_tokens(sql_session, key, token_deltas[key])
+            for key in live_sessions:
+                self._insert_events(sql_session, key, events_by_session[key])
+            sql_session.commit()
+        return now.replace(tzinfo=timezone.utc).timestamp()
+
+    def _state_row(self, sql_session, scope_key: tuple[str, ...]):
+        """The app_states / user_states row for ("app", app_name) or ("user",
+        app_name, user_id)."""
+        if scope_key[0] == "app":
+            return sql_session.get(StorageAppState, scope_key[1])
+        return sql_session.get(StorageUserState, scope_key[1:])
+
+    def _cached_state(self, sql_session, scope_key: tuple[str, ...]) -> dict[str, Any]:
+        """The shared cached copy of a scoped state, loaded from its row on a miss."""
+        with self._state_lock:
+            state = self._state_cache.get(scope_key)
+            if state is not None:
+                self._state_cache.move_to_end(scope_key)
+                return state
+        # Read outside the lock: the read may have to wait for the SQLite write lock
+        row = self._state_row(sql_session, scope_key)
+        with self._state_lock:
+            state = self._state_cache.setdefault(
+                scope_key, dict(row.state) if row else {}
+            )
+            # Evict the least recently used states that have already been written back
+            for old_key in list(self._state_cache):
+                if len(self._state_cache) <= self.state_cache_size:
+                    break
+                if old_key not in self._dirty_state:
+                    del self._state_cache[old_key]
+        return state
+
+    def _scoped_state(self, sql_session, scope_key: tuple[str, ...]) -> dict[str, Any]:
+        if not self.state_cache_size:
+            row = self._state_row(sql_session, scope_key)
+            return row.state if row else {}
+        state = self._cached_state(sql_session, scope_key)
+        with self._state_lock:
+            return dict(state)
+
+    def _apply_scoped_delta(
+        self, sql_session, scope_key: tuple[str, ...], delta: dict[str, Any]
+    ) -> None:
+        if not self.state_cache_size:
+            row = self._state_row(sql_session, scope_key) or self._new_state_row(
+                sql_session, scope_key
+            )
+            row.state = row.state | delta
+            return
+        state = self._cached_state(sql_session, scope_key)
+        with self._state_lock:
+            # Every session of this app/user sees the change immediately
+            self._state_cache.setdefault(scope_key, state).update(delta)
+            self._dirty_state.add(scope_key)
+
+    def _write_dirty_state(self, sql_session) -> None:
+        """Write changed cached states back to their rows (committed by the caller)."""
+        if not self._dirty_state:
+            return
+        with self._state_lock:
+            dirty = {
+                scope_key: dict(self._state_cache[scope_key])
+                for scope_key in self._dirty_state
+            }
+            self._dirty_state.clear()
+        for scope_key, state in dirty.items():
+            row = self._state_row(sql_session, scope_key) or self._new_state_row(
+                sql_session, scope_key
+            )
+            row.state = state
+
+    def _new_state_row(self, sql_session, scope_key: tuple[str, ...]):
+        if scope_key[0] == "app":
+            row = StorageAppState(app_name=scope_key[1], state={})
+        else:
+            row = StorageUserState(
+                app_name=scope_key[1], user_id=scope_key[2], state={}
+            )
+        sql_session.add(row)
+        return row
+
+    async def get_app_state(self, *, app_name: str) -> dict[str, Any]:
+        """The app's `app:` state (keys without the prefix), without loading a
+        session."""
+        with self._reading(), self.database_session_factory() as sql_session:
+            return dict(self._scoped_state(sql_session, ("app", app_name)))
+
+    async def get_user_state(self, *, app_name: str, user_id: str) -> dict[str, Any]:
+        """The user's `user:` state (keys without the prefix), without loading a
+        session."""
+        with self._reading(), self.database_session_factory() as sql_session:
+            return dict(self._scoped_state(sql_session, ("user", app_name, user_id)))
+
+    async def update_app_state(
+        self, *, app_name: str, state_delta: dict[str, Any]
+    ) -> None:
+        await self._update_scoped_state(("app", app_name), state_delta)
+
+    async def update_user_state(
+        self, *, app_name: str, user_id: str, state_delta: dict[str, Any]
+    ) -> None:
+        """Merge `state_delta` (keys without the `user:` prefix) into the user's
+        state."""
+        await self._update_scoped_state(("user", app_name, user_id), state_delta)
+
+    async def _update_scoped_state(
+        self, scope_key: tuple[str, ...], state_delta: dict[str, Any]
+    ) -> None:
+        with self.database_session_factory() as sql_session:
+            self._apply_scoped_delta(sql_session, scope_key, state_delta)
+            if not self.write_behind:
+                # Otherwise it goes out with the next group commit
+                self._write_dirty_state(sql_session)
+            sql_session.commit()
+
+    async def create_session(self, **kwargs) -> Session:
+        self.flush()  # ADK's create_session reads and writes the state rows directly
+        session = await super().create_session(**kwargs)
+        with self._state_lock:
+            for scope_key in (
+                ("app", session.app_name),
+                ("user", session.app_name, session.user_id),
+            ):
+                if scope_key not in self._dirty_state:
+                    self._state_cache.pop(scope_key, None)
+        return session
+
+    def _insert_events(
+        self, sql_session, key: tuple[str, str, str], events: list[Event]
+    ) -> None:
+        """Insert events (compact or JSON) and index any compaction checkpoints among
+        them."""
+        if self.event_codec:
+            self._insert_compact_events(sql_session, key, events)
+        else:
+            session_ref = SimpleNamespace(app_name=key[0], user_id=key[1], id=key[2])
+            sql_session.add_all(
+                StorageEvent.from_event(session_ref, event) for event in events
+            )
+        self._insert_checkpoints(sql_session, key, events)
+
+    def _insert_checkpoints(
+        self, sql_session, key: tuple[str, str, str], events: list[Event]
+    ) -> int:
+        checkpoints = 0
+        for event in events:
+            if event.actions and event.actions.compaction:
+                sql_session.execute(
+                    self._insert_ignore(
+                        compaction_checkpoints_table,
+                        app_name=key[0],
+                        user_id=key[1],
+                        session_id=key[2],
+                        end_timestamp=event.actions.compaction.end_timestamp,
+                        start_timestamp=event.actions.compaction.start_timestamp,
+                        event_id=event.id,
+                    )
+                )
+                checkpoints += 1
+        return checkpoints
+
+    def _session_dictionary(
+        self, sql_session, key: tuple[str, str, str]
+    ) -> bytes | None:
+        if key not in self._dictionaries:
+            self._dictionaries[key] = sql_session.execute(
+                select(event_dictionaries_table.c.dictionary).where(
+                    event_dictionaries_table.c.app_name == key[0],
+                    event_dictionaries_table.c.user_id == key[1],
+                    event_dictionaries_table.c.session_id == key[2],
+                )
+            ).scalar()
+        return self._dictionaries[key]
+
+    def _compact_session_filter(self, key: tuple[str, str, str]):
+        return (
+            compact_events_table.c.app_name == key[0],
+            compact_events_table.c.user_id == key[1],
+            compact_events_table.c.session_id == key[2],
+        )
+
+    def _insert_compact_events(
+        self, sql_session, key: tuple[str, str, str], events: list[Event]
+    ) -> None:
+        """Encode and insert events, training the session's dictionary once it has
+        enough samples."""
+        codec = self.event_codec
+        packed = [codec.pack(event) for event in events]
+        dictionary = self._session_dictionary(sql_session, key)
+        if dictionary is None:
+            if key not in self._untrained_counts:
+                self._untrained_counts[key] = sql_session.execute(
+                    select(func.count()).where(*self._compact_session_filter(key))
+                ).scalar()
+            self._untrained_counts[key] += len(events)
+            if self._untrained_counts[key] >= codec.train_after:
+                earlier = sql_session.execute(
+                    select(compact_events_table.c.payload).where(
+                        *self._compact_session_filter(key)
+                    )
+                ).scalars()
+                dictionary = codec.train(
+                    [codec.decompress_raw(p) for p in earlier] + packed
+                )
+                if dictionary:
+                    sql_session.execute(
+                        insert(event_dictionaries_table).values(
+                            app_name=key[0],
+                            user_id=key[1],
+                            session_id=key[2],
+                            dictionary=dictionary,
+                        )
+                    )
+                    self._dictionaries[key] = dictionary
+                    self._untrained_counts.pop(key)
+
+        sql_session.execute(
+            insert(compact_events_table),
+            [
+                {
+                    "app_name": key[0],
+                    "user_id": key[1],
+                    "session_id": key[2],
+                    "id": event.id,
+                    "invocation_id": event.invocation_id,
+                    "author": event.author,
+                    "timestamp": event.timestamp,
+                    "dictionary_id": 1 if dictionary else 0,
+                    "payload": codec.compress(body, dictionary),
+                }
+                for event, body in zip(events, packed)
+            ],
+        )
+
+    def _load_compact_events(
+        self, sql_session, key: tuple[str, str, str], config
+    ) -> list[Event]:
+        query = select(compact_events_table).where(*self._compact_session_filter(key))
+        if config and config.after_timestamp:
+            query = query.where(
+                compact_events_table.c.timestamp >= config.after_timestamp
+            )
+        query = query.order_by(compact_events_table.c.timestamp.desc())
+        if config and config.num_recent_events:
+            query = query.limit(config.num_recent_events)
+        rows = sql_session.execute(query).all()
+        if not rows:
+            return []
+        dictionary = self._session_dictionary(sql_session, key)
+        events = [
+            LazyEvent.from_row(row, self.event_codec, dictionary)
+            for row in reversed(rows)
+        ]
+        if not self.lazy_decode:
+            events = [event.materialize() for event in events]
+        return events
+
+    async def get_session(self, *, app_name, user_id, session_id, config=None):
+        self.flush()  # Read your own buffered writes
+        config = config or self.default_config
+        with self._reading(), self.database_session_factory() as sql_session:
+            storage_session = sql_session.get(
+                StorageSession, (app_name, user_id, session_id)
+            )
+            if storage_session is None:
+                return None
+            return self._load_session(sql_session, storage_session, config)
+
+    async def list_sessions(self, *, app_name, user_id=None):
+        self.flush()
+        with self._reading():
+            return await super().list_sessions(app_name=app_name, user_id=user_id)
+
+    async def delete_session(self, *, app_name, user_id, session_id):
+        self.flush()
+        await super().delete_session(
+            app_name=app_name, user_id=user_id, session_id=session_id
+        )
+        key = (app_name, user_id, session_id)
+        with self.database_session_factory() as sql_session:
+            sql_session.execute(
+                delete(compact_events_table).where(*self._compact_session_filter(key))
+            )
+            sql_session.execute(
+                delete(compaction_checkpoints_table).where(
+                    *self._checkpoint_filter(key)
+                )
+            )
+            sql_session.execute(
+                delete(session_token_counts_table).where(
+                    session_token_counts_table.c.app_name == app_name,
+                    session_token_counts_table.c.user_id == user_id,
+                    session_token_counts_table.c.session_id == session_id,
+                )
+            )
+            sql_session.execute(
+                delete(event_dictionaries_table).where(
+                    event_dictionaries_table.c.app_name == app_name,
+                    event_dictionaries_table.c.user_id == user_id,
+                    event_dictionaries_table.c.session_id == session_id,
+                )
+            )
+            sql_session.commit()
+        self._dictionaries.pop(key, None)
+        self._untrained_counts.pop(key, None)
+
+    def _insert_ignore(self, model, **values):
+        """INSERT that silently does nothing if the primary key already exists."""
+        dialect = self.db_engine.dialect.name
+        if dialect == "sqlite":
+            return sqlite.insert(model).values(**values).on_conflict_do_nothing()
+        if dialect == "postgresql":
+            return postgresql.insert(model).values(**values).on_conflict_do_nothing()
+        return insert(model).values(**values).prefix_with("IGNORE")  # MySQL
+
+    def _event_page(
+        self,
+        sql_session,
+        key: tuple[str, str, str],
+        before: tuple[float, str] | None,
+        limit: int,
+    ) -> list[Event]:
+        """Up to `limit` events older than the (timestamp, id) cursor, oldest first."""
+        legacy_query = sql_session.query(StorageEvent).filter(
+            StorageEvent.app_name == key[0],
+            StorageEvent.user_id == key[1],
+            StorageEvent.session_id == key[2],
+        )
+        if before:
+            before_dt = datetime.fromtimestamp(before[0])
+            legacy_query = legacy_query.filter(
+                or_(
+                    StorageEvent.timestamp < before_dt,
+                    and_(
+                        StorageEvent.timestamp == before_dt, StorageEvent.id < before[1]
+                    ),
+                )
+            )
+        events = [
+            storage_event_to_event(e)
+            for e in legacy_query.order_by(
+                StorageEvent.timestamp.desc(), StorageEvent.id.desc()
+            ).limit(limit)
+        ]
+
+        if self.event_codec:
+            compact_query = select(compact_events_table).where(
+                *self._compact_session_filter(key)
+            )
+            if before:
+                compact_query = compact_query.where(
+                    or_(
+                        compact_events_table.c.timestamp < before[0],
+                        and_(
+                            compact_events_table.c.timestamp == before[0],
+                            compact_events_table.c.id < before[1],
+                        ),
+                    )
+                )
+            rows = sql_session.execute(
+                compact_query.order_by(
+                    compact_events_table.c.timestamp.desc(),
+                    compact_events_table.c.id.desc(),
+                ).limit(limit)
+            ).all()
+            if rows:
+                dictionary = self._session_dictionary(sql_session, key)
+                events += [
+                    LazyEvent.from_row(row, self.event_codec, dictionary)
+                    for row in rows
+                ]
+
+        events.sort(key=lambda event: (event.timestamp, event.id), reverse=True)
+        return events[:limit][::-1]
+
+    def _checkpoint_filter(self, key: tuple[str, str, str]):
+        return (
+            compaction_checkpoints_table.c.app_name == key[0],
+            compaction_checkpoints_table.c.user_id == key[1],
+            compaction_checkpoints_table.c.session_id == key[2],
+        )
+
+    def _latest_checkpoint(self, sql_session, key: tuple[str, str, str]):
+        """The newest compaction of a session, straight from the checkpoint index."""
+        return sql_session.execute(
+            select(compaction_checkpoints_table)
+            .where(*self._checkpoint_filter(key))
+            .order_by(compaction_checkpoints_table.c.end_timestamp.desc())
+            .limit(1)
+        ).first()
+
+    def _load_event(
+        self, sql_session, key: tuple[str, str, str], event_id: str
+    ) -> Event | None:
+        storage_event = sql_session.get(StorageEvent, (event_id, *key))
+        if storage_event is not None:
+            return storage_event_to_event(storage_event)
+        row = sql_session.execute(
+            select(compact_events_table).where(
+                *self._compact_session_filter(key),
+                compact_events_table.c.id == event_id,
+            )
+        ).first()
+        if row is None:
+            return None
+        codec = self.event_codec or CompactEventCodec()
+        return LazyEvent.from_row(
+            row, codec, self._session_dictionary(sql_session, key)
+        ).materialize()
+
+    async def get_latest_compaction(
+        self, *, app_name: str, user_id: str, session_id: str
+    ) -> Event | None:
+        """Return the session's newest compaction event without loading or scanning
+        its history."""
+        self.flush()
+        key = (app_name, user_id, session_id)
+        with self._reading(), self.database_session_factory() as sql_session:
+            checkpoint = self._latest_checkpoint(sql_session, key)
+            return (
+                self._load_event(sql_session, key, checkpoint.event_id)
+                if checkpoint
+                else None
+            )
+
+    async def rebuild_compaction_checkpoints(self) -> int:
+        """Index compaction events written before checkpoints existed. Safe to re-run.
+
+        Returns the number of compaction events found.
+        """
+        self.flush()
+        with self._reading(), self.database_session_factory() as sql_session:
+            keys = sql_session.query(
+                StorageSession.app_name, StorageSession.user_id, StorageSession.id
+            ).all()
+        found = 0
+        for key in keys:
+            async for page in self.iter_event_pages(
+                app_name=key[0], user_id=key[1], session_id=key[2], page_size=500
+            ):
+                with self.database_session_factory() as sql_session:
+                    found += self._insert_checkpoints(sql_session, key, page)
+                    sql_session.commit()
+        return found
+
+    async def iter_event_pages(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        before_timestamp: float | None = None,
+        page_size: int = 100,
+    ):
+        """Page backwards through a session's history on demand.
+
+        Yields lists of at most `page_size` events (each list oldest-first), starting
+        with the newest page, or with the events before `before_timestamp`.
+        """
+        self.flush()
+        key = (app_name, user_id, session_id)
+        before = (before_timestamp, "") if before_timestamp else None
+        while True:
+            with self._reading(), self.database_session_factory() as sql_session:
+                page = self._event_page(sql_session, key, before, page_size)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            before = (page[0].timestamp, page[0].id)
+
+    def _query_event_rows(
+        self, connection, columns, content_column, filters: dict[str, Any]
+    ):
+        """Stream rows from one events table in timestamp order."""
+        query = select(
+            *columns.values(),
+            *([content_column.label("body")] if content_column is not None else []),
+        )
+        for name, value in filters.items():
+            if name == "start_time":
+                query = query.where(columns["timestamp"] >= value)
+            elif name == "end_time":
+                query = query.where(columns["timestamp"] < value)
+            else:
+                query = query.where(columns[name] == value)
+        yield from connection.execute(query.order_by(columns["timestamp"]))
+
+    def query_events(
+        self,
+        *,
+        app_name: str,
+        user_id: str | None = None,
+        session_id: str | None = None,
+        author: str | None = None,
+        start_time: float | None = None,
+        end_time: float | None = None,
+        include_content: bool = False,
+        batch_size: int = 1000,
+    ) -> Iterator[EventRecord]:
+        """Stream stored events matching the filters, oldest first, in constant memory.
+
+        Rows are fetched `batch_size` at a time from a server-side cursor (a deferred,
+        read-only snapshot on SQLite), so the table is never loaded at once. Every
+        combination of app / user / session / author plus a [start_time, end_time)
+        range is served by a composite index. Keep iteration short on busy SQLite
+        databases: an open read transaction stops WAL checkpoints from completing.
+        """
+        self.flush()
+        filters = {
+            "app_name": app_name,
+            "user_id": user_id,
+            "session_id": session_id,
+            "author": author,
+        }
+        filters = {name: value for name, value in filters.items() if value is not None}
+        legacy_filters = dict(filters)
+        if start_time is not None:
+            filters["start_time"] = start_time
+            legacy_filters["start_time"] = datetime.fromtimestamp(start_time)
+        if end_time is not None:
+            filters["end_time"] = end_time
+            legacy_filters["end_time"] = datetime.fromtimestamp(end_time)
+        names = (
+            "app_name",
+            "user_id",
+            "session_id",
+            "id",
+            "invocation_id",
+            "author",
+            "timestamp",
+        )
+        legacy_columns = {name: getattr(StorageEvent, name) for name in names}
+        compact_columns = {
+            name: compact_events_table.c[name] for name in names + ("dictionary_id",)
+        }
+
+        with self.db_engine.connect() as connection:
+            connection.info["read_only"] = True
+            try:
+                connection.execution_options(stream_results=True, yield_per=batch_size)
+                legacy_rows = self._query_event_rows(
+                    connection,
+                    legacy_columns,
+                    StorageEvent.content if include_content else None,
+                    legacy_filters,
+                )
+                compact_rows = self._query_event_rows(
+                    connection,
+                    compact_columns,
+                    compact_events_table.c.payload if include_content else None,
+                    filters,
+                )
+                legacy_records = (
+                    EventRecord(
+                        *row[:6],
+                        row.timestamp.timestamp(),
+                        row.body if include_content else None,
+                    )
+                    for row in legacy_rows
+                )
+                compact_records = (
+                    EventRecord(
+                        *row[:7],
+                        (
+                            self._compact_content(connection, row)
+                            if include_content
+                            else None
+                        ),
+                    )
+                    for row in compact_rows
+                )
+                yield from heapq.merge(
+                    legacy_records, compact_records, key=lambda record: record.timestamp
+                )
+            finally:
+                connection.info.pop("read_only", None)
+
+    def _compact_content(self, connection, row) -> dict[str, Any] | None:
+        key = (row.app_name, row.user_id, row.session_id)
+        dictionary = (
+            self._session_dictionary(connection, key) if row.dictionary_id else None
+        )
+        return (
+            (self.event_codec or CompactEventCodec())
+            .decode_body(row.body, dictionary)
+            .get("content")
+        )
+
+    def _load_session(
+        self,
+        sql_session,
+        storage_session: StorageSession,
+        config: GetSessionConfig | None = None,
+    ) -> Session:
+        """Build a Session (events + merged state) from its storage row."""
+        app_name, user_id = storage_session.app_name, storage_session.user_id
+        if getattr(config, "since_last_compaction", False):
+            checkpoint = self._latest_checkpoint(
+                sql_session, (app_name, user_id, storage_session.id)
+            )
+            if checkpoint is not None:
+                config = config.model_copy(
+                    update={
+                        "after_timestamp": max(
+                            checkpoint.start_timestamp, config.after_timestamp or 0.0
+                        )
+                    }
+                )
+        query = sql_session.query(StorageEvent).filter(
+            StorageEvent.app_name == app_name,
+            StorageEvent.user_id == user_id,
+            StorageEvent.session_id == storage_session.id,
+        )
+        if config and config.after_timestamp:
+            after_dt = datetime.fromtimestamp(config.after_timestamp)
+            query = query.filter(StorageEvent.timestamp >= after_dt)
+        storage_events = (
+            query.order_by(StorageEvent.timestamp.desc())
+            .limit(
+                config.num_recent_events
+                if config and config.num_recent_events
+                else None
+            )
+            .all()
+        )
+
+        merged_state = _merge_state(
+            self._scoped_state(sql_session, ("app", app_name)),
+            self._scoped_state(sql_session, ("user", app_name, user_id)),
+            storage_session.state,
+        )
+        events = [storage_event_to_event(e) for e in reversed(storage_events)]
+        if self.event_codec:
+            # Sessions may hold both JSON events (written before the codec) and compact
+            # ones
+            key = (app_name, user_id, storage_session.id)
+            events = sorted(
+                events + self._load_compact_events(sql_session, key, config),
+                key=lambda event: event.timestamp,
+            )
+            if config and config.num_recent_events:
+                events = events[-config.num_recent_events :]
+        return storage_session.to_session(state=merged_state, events=events)
+
+    def _add_tokens(self, sql_session, key: tuple[str, str, str], tokens: int) -> None:
+        sql_session.execute(
+            self._insert_ignore(
+                session_token_counts_table,
+                app_name=key[0],
+                user_id=key[1],
+                session_id=key[2],
+                live_tokens=0,
+            )
+        )
+        sql_session.execute(
+            update(session_token_counts_table)
+            .where(
+                session_token_counts_table.c.app_name == key[0],
+                session_token_counts_table.c.user_id == key[1],
+                session_token_counts_table.c.session_id == key[2],
+            )
+            .values(live_tokens=session_token_counts_table.c.live_tokens + tokens)
+        )
+
+    def session_token_count(
+        self, *, app_name: str, user_id: str, session_id: str
+    ) -> int:
+        """Estimated tokens the session currently puts in context (requires
+        count_tokens=True)."""
+        self.flush()
+        with self._reading(), self.database_session_factory() as sql_session:
+            return (
+                sql_session.execute(
+                    select(session_token_counts_table.c.live_tokens).where(
+                        session_token_counts_table.c.app_name == app_name,
+                        session_token_counts_table.c.user_id == user_id,
+                        session_token_counts_table.c.session_id == session_id,
+                    )
+                ).scalar()
+                or 0
+            )
+
+    def _lease_filter(self, key: tuple[str, str, str]):
+        return (
+            compaction_leases_table.c.app_name == key[0],
+            compaction_leases_table.c.user_id == key[1],
+            compaction_leases_table.c.session_id == key[2],
+        )
+
+    def acquire_compaction_lease(
+        self, key: tuple[str, str, str], owner: str, lease_seconds: float
+    ) -> bool:
+        """Claim a session for compaction. Fails while another owner's lease is
+        unexpired."""
+        now = time.time()
+        with self.database_session_factory() as sql_session:
+            sql_session.execute(
+                self._insert_ignore(
+                    compaction_leases_table,
+                    app_name=key[0],
+                    user_id=key[1],
+                    session_id=key[2],
+                    owner=owner,
+                    expires_at=now + lease_seconds,
+                )
+            )
+            sql_session.execute(
+                update(compaction_leases_table)
+                .where(*self._lease_filter(key))
+                .where(
+                    or_(
+                        compaction_leases_table.c.owner == owner,
+                        compaction_leases_table.c.expires_at < now,
+                    )
+                )
+                .values(owner=owner, expires_at=now + lease_seconds)
+            )
+            holder = sql_session.execute(
+                select(compaction_leases_table.c.owner).where(*self._lease_filter(key))
+            ).scalar()
+            sql_session.commit()
+        return holder == owner
+
+    def release_compaction_lease(self, key: tuple[str, str, str], owner: str) -> None:
+        with self.database_session_factory() as sql_session:
+            sql_session.execute(
+                delete(compaction_leases_table)
+                .where(*self._lease_filter(key))
+                .where(compaction_leases_table.c.owner == owner)
+            )
+            sql_session.commit()
+
+    def publish_compaction_event(
+        self, key: tuple[str, str, str], event: Event, owner: str, token_delta: int = 0
+    ) -> bool:
+        """Insert a compaction event and release the lease in one transaction.
+
+        `token_delta` (summary tokens minus the tokens of the events it newly covers)
+        is applied to the session's token count in the same transaction. Nothing is
+        published if the lease expired and was taken over in the meantime.
+        The session's update_time is left alone, so turns already in flight don't
+        fail the stale-session check because a summary landed behind them.
+        """
+        with self.database_session_factory() as sql_session:
+            holder = sql_session.execute(
+                select(compaction_leases_table.c.owner).where(*self._lease_filter(key))
+            ).scalar()
+            if holder != owner:
+                sql_session.rollback()
+                return False
+            self._insert_events(sql_session, key, [event])
+            if self.count_tokens:
+                self._add_tokens(sql_session, key, token_delta)
+            sql_session.execute(
+                delete(compaction_leases_table).where(*self._lease_filter(key))
+            )
+            sql_session.commit()
+        return True
+
+    async def get_or_create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        state: dict[str, Any] | None = None,
+        config: GetSessionConfig | None = None,
+    ) -> Session:
+        """Return the session, creating it with `state` if it doesn't exist yet.
+
+        Existing sessions cost a single read-only SELECT, so the per-turn path never
+        takes the write lock. Missing ones are inserted with INSERT ... ON CONFLICT DO
+        NOTHING, so two concurrent first turns can't fail. Like get_session, it falls
+        back to `default_config` when no config is given.
+        """
+        self.flush()
+        config = config or self.default_config
+        key = (app_name, user_id, session_id)
+        with self._reading(), self.database_session_factory() as sql_session:
+            storage_session = sql_session.get(StorageSession, key)
+            if storage_session is not None:
+                return self._load_session(sql_session, storage_session, config)
+        # Missing: only now open a write transaction. Another turn may have created the
+        # session since, so look again under the write lock
+        with self.database_session_factory() as sql_session:
+            storage_session = sql_session.get(StorageSession, key)
+            if storage_session is None:
+                state_deltas = _session_util.extract_state_delta(state)
+                sql_session.execute(
+                    self._insert_ignore(StorageAppState, app_name=app_name, state={})
+                )
+                sql_session.execute(
+                    self._insert_ignore(
+                        StorageUserState, app_name=app_name, user_id=user_id, state={}
+                    )
+                )
+                created = sql_session.execute(
+                    self._insert_ignore(
+                        StorageSession,
+                        app_name=app_name,
+                        user_id=user_id,
+                        id=session_id,
+                        state=state_deltas["session"],
+                    )
+                ).rowcount
+                if created and state_deltas["app"]:
+                    self._apply_scoped_delta(
+                        sql_session, ("app", app_name), state_deltas["app"]
+                    )
+                if created and state_deltas["user"]:
+                    self._apply_scoped_delta(
+                        sql_session, ("user", app_name, user_id), state_deltas["user"]
+                    )
+                self._write_dirty_state(sql_session)
+                sql_session.commit()
+                storage_session = sql_session.get(StorageSession, key)
+            return self._load_session(sql_session, storage_session, config)
+
+
+# Sharded session storage
+class ConsistentHashRing:
+    """Maps keys to nodes; each node owns `virtual_nodes` points on the ring to even
+    out the load."""
+
+    def __init__(self, nodes: list[str], virtual_nodes: int = 64):
+        self._points = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+        )
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+def shard_key(app_name: str, user_id: str) -> str:
+    return f"{app_name}/{user_id}"
+
+
+class ShardedSessionService(BaseSessionService):
+    """Spreads users over several FastDatabaseSessionServices, one database per shard.
+
+    Args:
+        db_urls: One database URL per shard. Their order doesn't matter, only the set.
+        virtual_nodes: Ring points per shard.
+        **service_kwargs: Passed to every shard's FastDatabaseSessionService
+            (tune_sqlite, write_behind, event_codec, ...).
+
+    `app:` state is shared by users on every shard, so its changes are applied to all
+    of them.
+    """
+
+    def __init__(
+        self, db_urls: list[str], *, virtual_nodes: int = 64, **service_kwargs: Any
+    ):
+        self.shards = {
+            url: FastDatabaseSessionService(db_url=url, **service_kwargs)
+            for url in db_urls
+        }
+        self._ring = ConsistentHashRing(list(self.shards), virtual_nodes)
+
+    def shard_for(self, app_name: str, user_id: str) -> FastDatabaseSessionService:
+        return self.shards[self._ring.node_for(shard_key(app_name, user_id))]
+
+    async def _share_app_state(
+        self, home: FastDatabaseSessionService, app_name: str, state: dict | None
+    ) -> None:
+        app_delta = _session_util.extract_state_delta(state)["app"]
+        if app_delta:
+            for shard in self.shards.values():
+                if shard is not home:
+                    await shard.update_app_state(
+                        app_name=app_name, state_delta=app_delta
+                    )
+
+    async def create_session(
+        self, *, app_name, user_id, state=None, session_id=None
+    ) -> Session:
+        shard = self.shard_for(app_name, user_id)
+        session = await shard.create_session(
+            app_name=app_name, user_id=user_id, state=state, session_id=session_id
+        )
+        await self._share_app_state(shard, app_name, state)
+        return session
+
+    async def get_or_create_session(
+        self, *, app_name, user_id, session_id, state=None
+    ) -> Session:
+        shard = self.shard_for(app_name, user_id)
+        if _session_util.extract_state_delta(state)["app"]:
+            # `state` only applies to a new session, so only then is there app: state to
+            # share
+            with shard._reading(), shard.database_session_factory() as sql_session:
+                exists = (
+                    sql_session.get(StorageSession, (app_name, user_id, session_id))
+                    is not None
+                )
+            if not exists:
+                return await self.create_session(
+                    app_name=app_name,
+                    user_id=user_id,
+                    state=state,
+                    session_id=session_id,
+                )
+        return await shard.get_or_create_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, state=state
+        )
+
+    async def get_session(self, *, app_name, user_id, session_id, config=None):
+        return await self.shard_for(app_name, user_id).get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, config=config
+        )
+
+    async def list_sessions(self, *, app_name, user_id=None) -> ListSessionsResponse:
+        if user_id is not None:
+            return await self.shard_for(app_name, user_id).list_sessions(
+                app_name=app_name, user_id=user_id
+            )
+        # Every shard holds some of the app's users
+        responses = await asyncio.gather(
+            *(shard.list_sessions(app_name=app_name) for shard in self.shards.values())
+        )
+        return ListSessionsResponse(
+            sessions=[
+                session for response in responses for session in response.sessions
+            ]
+        )
+
+    async def delete_session(self, *, app_name, user_id, session_id) -> None:
+        await self.shard_for(app_name, user_id).delete_session(
+            app_name=app_name, user_id=user_id, session_id=session_id
+        )
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        shard = self.shard_for(session.app_name, session.user_id)
+        event = await shard.append_event(session, event)
+        if not event.partial and event.actions:
+            await self._share_app_state(
+                shard, session.app_name, event.actions.state_delta
+            )
+        return event
+
+    def flush(self) -> int:
+        return sum(shard.flush() for shard in self.shards.values())
+
+    def close(self) -> None:
+        for shard in self.shards.values():
+            shard.close()
+
+
+def user_scoped_tables() -> list[Table]:
+    """Every table in the session schema whose rows belong to a single (app_name,
+    user_id)."""
+    tables = [*StorageSession.metadata.sorted_tables, *compact_metadata.sorted_tables]
+    return [table for table in tables if "app_name" in table.c and "user_id" in table.c]
+
+
+def rebalance_shards(
+    old_urls: list[str],
+    new_urls: list[str],
+    *,
+    virtual_nodes: int = 64,
+    batch_size: int = 1000,
+) -> int:
+    """Move users whose home shard changes between two shard sets. Returns how many.
+
+    Run it while no service is writing to the shards. Each user is copied to its new
+    shard (replacing any partial copy left by an interrupted run) before it's deleted
+    from the old one, so an interrupted rebalance can simply be run again.
+    """
+    old_ring = ConsistentHashRing(old_urls, virtual_nodes)
+    new_ring = ConsistentHashRing(new_urls, virtual_nodes)
+    services = {
+        url: FastDatabaseSessionService(db_url=url) for url in {*old_urls, *new_urls}
+    }
+    engines = {url: service.db_engine for url, service in services.items()}
+    tables = user_scoped_tables()
+
+    # app: state is kept on every shard - seed shards that are new to the set
+    with engines[old_urls[0]].connect() as source:
+        app_states = source.execute(select(StorageAppState.__table__)).mappings().all()
+    for url in set(new_urls) - set(old_urls):
+        with engines[url].begin() as target:
+            for app_state in app_states:
+                target.execute(
+                    delete(StorageAppState.__table__).where(
+                        StorageAppState.app_name == app_state["app_name"]
+                    )
+                )
+                target.execute(insert(StorageAppState.__table__), [dict(app_state)])
+
+    moved = 0
+    for url in old_urls:
+        with engines[url].connect() as source:
+            users = source.execute(
+                select(StorageUserState.app_name, StorageUserState.user_id).union(
+                    select(StorageSession.app_name, StorageSession.user_id)
+                )
+            ).all()
+        for app_name, user_id in users:
+            key = shard_key(app_name, user_id)
+            if old_ring.node_for(key) != url or new_ring.node_for(key) == url:
+                continue
+            target_url = new_ring.node_for(key)
+            with engines[url].connect() as source, engines[
+                target_url
+            ].begin() as target:
+                for table in tables:
+                    owned = (table.c.app_name == app_name, table.c.user_id == user_id)
+                    target.execute(delete(table).where(*owned))
+                    rows = source.execute(select(table).where(*owned))
+                    while batch := rows.mappings().fetchmany(batch_size):
+                        target.execute(insert(table), [dict(row) for row in batch])
+            with engines[url].begin() as source:
+                for table in reversed(
+                    tables
+                ):  # Events before the sessions they reference
+                    source.execute(
+                        delete(table).where(
+                            table.c.app_name == app_name, table.c.user_id == user_id
+                        )
+                    )
+            moved += 1
+
+    for service in services.values():
+        service.close()
+        service.db_engine.dispose()
+    return moved